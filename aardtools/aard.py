@@ -19,6 +19,9 @@ def total(inputfile, options):
     d.close()
     return len(d)
 
+#article count is read from volume header
+estimate = total
+
 def collect_articles(input_file, options, compiler):
     p = AardParser(compiler)
     p.parse(input_file)
@@ -0,0 +1,286 @@
+# This file is part of Aard Dictionary Tools <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2008-2009  Igor Tkach
+
+""" Persistent caches of converted articles and parsed templates.
+
+Articles are found by hash of title, article source and converter
+version, so articles that didn't change since previous compilation
+don't need to be converted again.
+
+Cache directory contains index (cdb mapping keys to locations of
+cached articles) and segment files with cached articles. Worker
+processes append every article they convert or find in cache to their
+own segment in session directory, when compilation is finished these
+segments replace segments in cache directory (see `update_cache`), so
+cache contains articles from last compilation only.
+
+Parsed templates are found by hash of template name and source (see
+`TemplateCache`), rendered math images - by hash of renderer and
+equation (see `MathCache`).
+"""
+
+from __future__ import with_statement
+import os
+import glob
+import shutil
+import struct
+import hashlib
+import logging
+import uuid
+import tempfile
+import cPickle as pickle
+
+from mwlib import cdb, lrucache
+
+log = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.cdb'
+SEGMENT_PREFIX = 'cache-'
+SEGMENT_EXT = '.seg'
+KEY_SIZE = 20
+LENGTH_FORMAT = '>L'
+LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)
+
+
+def new_segment_name(session_dir):
+    return os.path.join(session_dir,
+                        SEGMENT_PREFIX + uuid.uuid4().hex + SEGMENT_EXT)
+
+def write_atomically(file_name, data):
+    """ Write `data` to `file_name` so that other processes see either
+    complete file or no file.
+    """
+    dir_name = os.path.dirname(file_name)
+    if not os.path.exists(dir_name):
+        try:
+            os.makedirs(dir_name)
+        except OSError:
+            #other process created it
+            pass
+    fd, tmp_name = tempfile.mkstemp(dir=dir_name)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_name, file_name)
+
+def read_segment(file_name):
+    """ Return generator that produces (key, position, length)
+    tuples for records in segment file. Incomplete record at the end
+    of the file (written by a process that was killed) is ignored.
+    """
+    with open(file_name, 'rb') as f:
+        while True:
+            header = f.read(KEY_SIZE + LENGTH_SIZE)
+            if len(header) < KEY_SIZE + LENGTH_SIZE:
+                break
+            key = header[:KEY_SIZE]
+            length, = struct.unpack(LENGTH_FORMAT, header[KEY_SIZE:])
+            pos = f.tell()
+            f.seek(length, os.SEEK_CUR)
+            if f.tell() > os.fstat(f.fileno()).st_size:
+                break
+            yield key, pos, length
+
+
+class ArticleCache(object):
+    """ Cache of converted articles in `cache_dir`. Values are byte
+    strings. If `segment_name` is specified values found in cache
+    and values added to it are written to this segment.
+    """
+
+    def __init__(self, cache_dir, version, segment_name=None):
+        self.cache_dir = cache_dir
+        self.version = version
+        index_name = os.path.join(cache_dir, INDEX_FILE)
+        if os.path.exists(index_name):
+            self.index = cdb.Cdb(open(index_name, 'rb'))
+        else:
+            self.index = None
+        self.segments = {}
+        self.segment = open(segment_name, 'ab', 0) if segment_name else None
+
+    def key(self, title, text):
+        sha1 = hashlib.sha1(self.version)
+        sha1.update('\0')
+        sha1.update(title.encode('utf8'))
+        sha1.update('\0')
+        sha1.update(text.encode('utf8'))
+        return sha1.digest()
+
+    def get(self, key):
+        """ Return value for `key` or None if it's not in cache. """
+        if self.index is None:
+            return None
+        location = self.index.get(key)
+        if location is None:
+            return None
+        segment_name, pos, length = location.split()
+        segment = self.segments.get(segment_name)
+        if segment is None:
+            segment = open(os.path.join(self.cache_dir, segment_name), 'rb')
+            self.segments[segment_name] = segment
+        segment.seek(int(pos))
+        value = segment.read(int(length))
+        if len(value) != int(length):
+            log.warn('Cache segment %s is truncated', segment_name)
+            return None
+        self.write(key, value)
+        return value
+
+    def add(self, key, value):
+        self.write(key, value)
+
+    def write(self, key, value):
+        if self.segment:
+            #one write per record, so records are complete unless
+            #process is killed while writing
+            self.segment.write(key + struct.pack(LENGTH_FORMAT, len(value)) +
+                               value)
+
+    def close(self):
+        if self.index:
+            self.index.close()
+            self.index.fp.close()
+        for segment in self.segments.itervalues():
+            segment.close()
+        if self.segment:
+            self.segment.close()
+
+
+def update_cache(cache_dir, session_dir):
+    """ Replace cached articles in `cache_dir` with articles from
+    segments written to `session_dir`. Return number of cached
+    articles.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    count = 0
+    index_name = os.path.join(cache_dir, INDEX_FILE)
+    segments = set()
+    with open(index_name + '.tmp', 'wb') as f:
+        index = cdb.CdbMake(f)
+        for name in glob.glob(os.path.join(session_dir, SEGMENT_PREFIX +
+                                           '*' + SEGMENT_EXT)):
+            segment_name = os.path.basename(name)
+            for key, pos, length in read_segment(name):
+                index.add(key, '%s %d %d' % (segment_name, pos, length))
+                count += 1
+            shutil.move(name, os.path.join(cache_dir, segment_name))
+            segments.add(segment_name)
+        index.finish()
+    os.rename(index_name + '.tmp', index_name)
+    for name in glob.glob(os.path.join(cache_dir, SEGMENT_PREFIX +
+                                       '*' + SEGMENT_EXT)):
+        if os.path.basename(name) not in segments:
+            os.remove(name)
+    log.info('Article cache in %s updated, %d articles', cache_dir, count)
+    return count
+
+
+class TemplateCache(object):
+    """ Cache of parsed templates. Most recently used `size` templates
+    are kept in memory. If `cache_dir` is specified parsed templates
+    are also pickled to files in this directory named by template key,
+    so they are shared with other processes and with subsequent
+    compilations.
+    """
+
+    def __init__(self, cache_dir, version, size):
+        self.cache_dir = cache_dir
+        self.version = version
+        self.memory = lrucache.lrucache(size)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, name, raw):
+        sha1 = hashlib.sha1(self.version)
+        sha1.update('\0')
+        sha1.update(name.encode('utf8'))
+        sha1.update('\0')
+        sha1.update(raw.encode('utf8'))
+        return sha1.hexdigest()
+
+    def file_name(self, key):
+        return os.path.join(self.cache_dir, key[:2], key[2:])
+
+    def get(self, key):
+        """ Return parsed template for `key` or None if it's not in
+        cache.
+        """
+        try:
+            parsed = self.memory[key]
+        except KeyError:
+            parsed = self.load(key)
+            if parsed is None:
+                self.misses += 1
+                return None
+            self.memory[key] = parsed
+        self.hits += 1
+        return parsed
+
+    def load(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self.file_name(key), 'rb') as f:
+                return pickle.load(f)
+        except IOError:
+            return None
+        except Exception:
+            log.warn('Failed to read cached template %s', key, exc_info=1)
+            return None
+
+    def add(self, key, parsed):
+        self.memory[key] = parsed
+        if not self.cache_dir:
+            return
+        write_atomically(self.file_name(key),
+                         pickle.dumps(parsed, pickle.HIGHEST_PROTOCOL))
+
+
+class MathCache(object):
+    """ Cache of rendered math images (base64 encoded PNG) in
+    `cache_dir`, shared by worker processes and subsequent
+    compilations. Failures to render equation are cached too, as
+    empty images.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, renderer, equation):
+        sha1 = hashlib.sha1(renderer)
+        sha1.update('\0')
+        sha1.update(equation.encode('utf8'))
+        return sha1.hexdigest()
+
+    def file_name(self, key):
+        return os.path.join(self.cache_dir, key[:2], key[2:])
+
+    def get(self, key):
+        """ Return image for `key`, empty string if renderer failed
+        or None if it's not in cache.
+        """
+        try:
+            with open(self.file_name(key), 'rb') as f:
+                imgdata = f.read()
+        except IOError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return imgdata
+
+    def add(self, key, imgdata):
+        write_atomically(self.file_name(key), imgdata)
@@ -25,7 +25,11 @@ import tempfile
 import optparse
 import functools
 import time
+import hashlib
 import shutil
+import glob
+import bisect
+from array import array
 from datetime import timedelta
 
 from PyICU import Locale, Collator
@@ -35,7 +39,7 @@ try:
 except ImportError:
     import simplejson as json
 
-from aarddict.dictionary import HEADER_SPEC, spec_len, calcsha1, collation_key
+from aarddict.dictionary import HEADER_SPEC, spec_len, collation_key
 import aardtools
 
 
@@ -49,8 +53,13 @@ KEY_LENGTH_FORMAT = '>H'
 ARTICLE_LENGTH_FORMAT = '>L'
 INDEX1_ITEM_FORMAT = '>LL'
 
+#articles up to this size (compressed) are written once per volume
+#if several index items have identical articles
+DEDUP_MAX_SIZE = 1024
+
 def make_opt_parser():
-    usage = "Usage: %prog [options] (wiki|xdxf|aard) FILE"
+    usage = ("Usage: %prog [options] (wiki|xdxf|aard) FILE\n"
+             "       %prog [options] merge SHARD...")
     parser = optparse.OptionParser(version="%prog "+aardtools.__version__, usage=usage)
     parser.add_option(
         '-o', '--output-file',
@@ -141,6 +150,17 @@ def make_opt_parser():
         help='End article, stop processing at this article. Default: %default'
         )
 
+    parser.add_option(
+        '--sorted-shard',
+        action='store_true',
+        default=False,
+        help='Write converted articles (usually a range selected with '
+        '--start and --end) to a sorted shard file instead of .aar files. '
+        'Shards converted separately, for example on different machines, '
+        'are combined into dictionary with "merge" command: '
+        '%prog [options] merge SHARD...'
+        )
+
     parser.add_option(
         '--dict-ver',
         help='Version of the compiled dictionary'
@@ -165,12 +185,40 @@ def make_opt_parser():
         '--mp-chunk-size',
         default=10000,
         type='int',
-        help='This value defines maximum number articles to be processed by pool'
-        'of worker processes before it is closed and new pool is created. Typically'
-        'there should be no need to change the default value.'
+        help='This value defines maximum number of articles to be processed by '
+        'a worker process before it is stopped and new worker is started. '
+        'Typically there should be no need to change the default value. '
+        'Default: %default'
+        )
+
+    parser.add_option(
+        '--mp-batch-time',
+        default=0.2,
+        type='float',
+        help='Articles are sent to worker processes in batches sized so '
+        'that converting a batch takes about this many seconds (based on '
+        'average conversion time so far). Use 0 to send articles one by one. '
         'Default: %default'
         )
 
+    parser.add_option(
+        '--worker-memory',
+        default='1G',
+        help='Worker process is replaced with a new one after it finishes '
+        'a batch of articles if its resident memory size exceeds this amount '
+        '(in bytes, kilobytes(K), megabytes(M) or gigabytes(G)). '
+        'Use 0 for no limit. Default: %default'
+        )
+
+    parser.add_option(
+        '--worker-address-space',
+        default='0',
+        help='Limit address space of worker processes to this amount '
+        '(in bytes, kilobytes(K), megabytes(M) or gigabytes(G)). Articles '
+        'that need more memory fail and worker is replaced. '
+        'Use 0 for no limit. Default: %default'
+        )
+
     parser.add_option(
         '--show-legend',
         action='store_true',
@@ -185,6 +233,23 @@ def make_opt_parser():
                       action='store_true',
                       help='Remove session directory after compilation.')
 
+    parser.add_option(
+        '--checkpoint-interval',
+        default=300,
+        type='float',
+        help='Save compilation state to session directory every this many '
+        'seconds so that interrupted compilation can be resumed with '
+        '--resume. Use 0 to disable. Default: %default'
+        )
+
+    parser.add_option(
+        '--resume',
+        metavar='SESSION_DIR',
+        help='Resume interrupted compilation from last checkpoint saved in '
+        'session directory SESSION_DIR. Input files and options given '
+        'when compilation started are used, other arguments are ignored.'
+        )
+
     parser.add_option(
         '--lang-links',
         help='Add Wikipedia language links to index for these languages '
@@ -205,9 +270,135 @@ def make_opt_parser():
               'some XDXF dictionaries already inlude title in article text and '
               'needs this to avoid title duplication'))
 
+    parser.add_option(
+        '--sort-memory',
+        default='256M',
+        help='Approximate amount of memory to use for sorting article titles '
+        'in bytes, kilobytes(K), megabytes(M) or gigabytes(G). Sorted runs '
+        'of this size are written to session directory and merged. '
+        'Use 0 to sort all titles in memory. Default: %default'
+        )
+
+    parser.add_option(
+        '--compression-policy',
+        default='best',
+        choices=['fast', 'best', 'auto'],
+        help='fast - compress articles with zlib only; best - compress with '
+        'both zlib and bz2 and keep smaller result; auto - do not compress '
+        'small articles, pick compression for others based on what worked '
+        'best for articles of similar size. Default: %default'
+        )
+    parser.add_option(
+        '--parallel-volumes',
+        action='store_true',
+        default=False,
+        help='Plan volume boundaries after articles are sorted and then '
+        'write all volumes at the same time, one worker process per volume. '
+        'Ignored if --nomp is specified.'
+        )
+    parser.add_option(
+        '--count-total',
+        action='store_true',
+        default=False,
+        help='Count articles with a full pass over input before conversion '
+        'starts. This may take a long time for large inputs. By default '
+        'total number of articles is estimated from a sample of input, '
+        'or taken from count saved next to input by previous compilation.'
+        )
+
     parser.add_option('--siteinfo',
                       help='Mediawiki JSON-formatted site info file')
 
+    parser.add_option(
+        '--article-cache',
+        metavar='DIR',
+        help='Directory with converted Wikipedia articles cached by previous '
+        'compilation. Articles whose source didn\'t change are taken from '
+        'cache instead of being converted again. Cache is replaced with '
+        'articles from this compilation unless only part of input is '
+        'compiled (with --start, --end or --article-count).'
+        )
+
+    parser.add_option(
+        '--template-cache',
+        metavar='DIR',
+        help='Directory where parsed Wikipedia templates are stored, '
+        'templates parsed by one worker process are used by others and '
+        'by subsequent compilations. Default: %default'
+        )
+
+    parser.add_option(
+        '--template-cache-size',
+        default=1000,
+        type='int',
+        help='Number of most recently used parsed templates kept in memory '
+        'by each worker process. Default: %default'
+        )
+
+    parser.add_option(
+        '--template-memo-size',
+        default=0,
+        type='int',
+        help='Number of most recently used template expansion results kept '
+        'in memory by each worker process. Template invocations with the '
+        'same arguments reuse expansion result if expansion did not depend '
+        'on the page being converted. Use 0 to disable. Default: %default'
+        )
+
+    parser.add_option(
+        '--template-memo-allowlist',
+        metavar='NAMES',
+        help='Only memoize expansions of these templates (comma separated '
+        'list of template names). By default all templates are considered.'
+        )
+
+    parser.add_option(
+        '--math-cache',
+        metavar='DIR',
+        help='Directory where rendered math images are stored, shared by '
+        'worker processes and subsequent compilations. Renderers that '
+        'failed to render an equation are remembered and not tried again.'
+        )
+
+    parser.add_option(
+        '--math-processes',
+        default=0,
+        type='int',
+        help='Number of processes in math rendering service. Math is '
+        'rendered by the service while article worker processes write '
+        'articles. Use 0 to render math in article worker processes. '
+        'Ignored if --nomp is specified. Default: %default'
+        )
+
+    parser.add_option(
+        '--math-timeout',
+        type='float',
+        help='Stop rendering equation with a renderer if it takes longer '
+        'than the amount of time specified. By default 2 seconds if math '
+        'is rendered by math rendering service (see --math-processes), '
+        'no time limit otherwise'
+        )
+
+    parser.add_option(
+        '--math-wait',
+        type='float',
+        help='Time article worker waits for math rendered by math rendering '
+        'service, per equation, including time equations wait for a '
+        'renderer. Math that is not rendered in time is written as text. '
+        'Article worker doesn\'t wait past article timeout (--timeout). '
+        'By default equals --math-timeout multiplied by number of math '
+        'renderers'
+        )
+
+    parser.add_option(
+        '--math-format',
+        default='png',
+        choices=['png', 'mathml'],
+        help='png - render math as images; mathml - convert math to MathML '
+        'in article worker processes, only render math that can\'t be '
+        'converted as images. Default: %default'
+        )
+
 
     parser.add_option('--rtl',
                       action="store_true",
@@ -230,61 +421,74 @@ def utf8(func):
     return f
 
 class Volume(object):
+    """ Volume plan: range of sorted article positions from `start`
+    to `end` and sizes of volume sections.
+    """
 
     class ExceedsMaxSize(Exception): pass
 
-    number = 0
-
-    def __init__(self, header_meta_len, max_file_size, work_dir):
+    def __init__(self, number, start, header_meta_len, max_file_size):
+        self.number = number
+        self.start = start
+        self.end = start
         self.header_meta_len = header_meta_len
         self.max_file_size = max_file_size
-        self.index1 = tempfile.NamedTemporaryFile(prefix='index1',
-                                                  dir=work_dir)
-        log.info('Creating temporary index 1 file %s', self.index1.name)
-        self.index2 = tempfile.NamedTemporaryFile(prefix='index2',
-                                                  dir=work_dir)
-        log.info('Creating temporary index 2 file %s', self.index2.name)
-        self.articles =  tempfile.NamedTemporaryFile(prefix='articles',
-                                                     dir=work_dir)
-        log.info('Creating temporary articles file %s', self.articles.name)
         self.index1Length = 0
         self.index2Length = 0
         self.articles_len = 0
         self.index_count = 0
-        Volume.number += 1
+        self.digests = set()
+        self.dedup_count = 0
 
-    def add(self, index1_unit, index2_unit, article_unit):
+    def add(self, title_len, article_len, digest=None):
+        """ Account for index items and article. If article with the
+        same `digest` was already added to this volume index item will
+        point to it and article is not counted again.
+        """
+        index1_unit_len = struct.calcsize(INDEX1_ITEM_FORMAT)
+        index2_unit_len = struct.calcsize(KEY_LENGTH_FORMAT) + title_len
+        if digest and digest in self.digests:
+            article_unit_len = 0
+        else:
+            article_unit_len = (struct.calcsize(ARTICLE_LENGTH_FORMAT) +
+                                article_len)
         if sum((self.header_meta_len,
                 self.index1Length,
                 self.index2Length,
                 self.articles_len,
-                len(index1_unit),
-                len(index2_unit),
-                len(article_unit)
+                index1_unit_len,
+                index2_unit_len,
+                article_unit_len
                 )) > self.max_file_size:
             raise Volume.ExceedsMaxSize
-        self.index1.write(index1_unit)
-        self.index1Length += len(index1_unit)
-        self.index2.write(index2_unit)
-        self.index2Length += len(index2_unit)
+        self.index1Length += index1_unit_len
+        self.index2Length += index2_unit_len
         self.index_count += 1
-        self.articles.write(article_unit)
-        self.articles_len += len(article_unit)
-
+        self.end += 1
+        self.articles_len += article_unit_len
+        if not article_unit_len:
+            self.dedup_count += 1
+        elif digest:
+            self.digests.add(digest)
 
-    def flush(self):
-        self.index1.flush()
-        self.index2.flush()
-        self.articles.flush()
+    def close(self):
+        #digests are only needed while planning
+        self.digests = None
 
-    def totuple(self):
-        return (self.index1, self.index1Length, self.index2,
-                self.index2Length, self.articles, self.articles_len,
-                self.index_count)
+    def file_size(self):
+        return (self.header_meta_len + self.index1Length +
+                self.index2Length + self.articles_len)
 
 import threading
 article_add_lock = threading.RLock()
 
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import deque
+
+#number of articles sent to compression worker at once
+COMPRESS_BATCH_SIZE = 256
+
 class Stats(object):
 
     def __init__(self):
@@ -295,6 +499,14 @@ class Stats(object):
         self.timedout = 0
         self.articles = 0
         self.redirects = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.template_hits = 0
+        self.template_misses = 0
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.memo_saved_time = 0.0
+        self.estimated = False
         self.start_time = time.time()
 
     processed = property(lambda self: (self.articles +
@@ -311,129 +523,814 @@ class Stats(object):
     elapsed = property(lambda self: timedelta(seconds=(int(time.time() -
                                                            self.start_time))))
 
+    @property
+    def eta(self):
+        average = self.average
+        if not self.total or not average:
+            return None
+        remaining = max(self.total - self.processed, 0)
+        return timedelta(seconds=int(remaining/average))
+
     def __str__(self):
         return ('total: %d, skipped: %d, failed: %d, '
                 'empty: %d, timed out: %d, articles: %d, '
-                'redirects: %d, average: %.2f/s '
-                'elapsed: %s' % (self.total,
-                                 self.skipped,
-                                 self.failed,
-                                 self.empty,
-                                 self.timedout,
-                                 self.articles,
-                                 self.redirects,
-                                 self.average,
-                                 self.elapsed))
+                'redirects: %d, cache hits: %d, cache misses: %d, '
+                'template cache hits: %d, template cache misses: %d, '
+                'average: %.2f/s elapsed: %s' % (self.total,
+                                                 self.skipped,
+                                                 self.failed,
+                                                 self.empty,
+                                                 self.timedout,
+                                                 self.articles,
+                                                 self.redirects,
+                                                 self.cache_hits,
+                                                 self.cache_misses,
+                                                 self.template_hits,
+                                                 self.template_misses,
+                                                 self.average,
+                                                 self.elapsed))
 
 
 import mmap
+import heapq
+from contextlib import contextmanager
+
+#approximate per item memory overhead of a (key, position) tuple in a sort run
+SORT_ITEM_OVERHEAD = 80
+#maximum number of sorted runs merged at once
+MAX_MERGE_FANIN = 64
+
+RUN_KEY_LENGTH_FORMAT = '>H'
+RUN_POS_FORMAT = '>Q'
+ORDER_POS_FORMAT = '>Q'
+
+def write_run(items, work_dir):
+    """ Write (key, pos) pairs to a temporary run file and return its
+    name. Keys must be byte strings.
+    """
+    fd, run_name = tempfile.mkstemp(prefix='aa-', suffix='.run', dir=work_dir)
+    pack_key_len = functools.partial(struct.pack, RUN_KEY_LENGTH_FORMAT)
+    pack_pos = functools.partial(struct.pack, RUN_POS_FORMAT)
+    with os.fdopen(fd, 'wb', 1024*1024) as run:
+        for key, pos in items:
+            run.write(pack_key_len(len(key)))
+            run.write(key)
+            run.write(pack_pos(pos))
+    return run_name
+
+def read_run(run_name):
+    """ Return generator that produces (key, pos) pairs from run file
+    written by `write_run` and removes the file when exhausted.
+    """
+    key_len_size = struct.calcsize(RUN_KEY_LENGTH_FORMAT)
+    pos_size = struct.calcsize(RUN_POS_FORMAT)
+    with open(run_name, 'rb', 1024*1024) as run:
+        while True:
+            key_len_str = run.read(key_len_size)
+            if not key_len_str:
+                break
+            key_len, = struct.unpack(RUN_KEY_LENGTH_FORMAT, key_len_str)
+            key = run.read(key_len)
+            pos, = struct.unpack(RUN_POS_FORMAT, run.read(pos_size))
+            yield key, pos
+    os.remove(run_name)
+
+def merge_sort(items, max_memory=None, work_dir=None):
+    """ Return generator that produces (key, pos) pairs from `items`
+    sorted by key and then by pos.
+
+    If `max_memory` (in bytes) is specified items are sorted in runs
+    of bounded size, runs are spilled to temporary files in `work_dir`
+    and then merged.
+    """
+    if max_memory is None:
+        for item in sorted(items):
+            yield item
+        return
+
+    runs = []
+    run = []
+    run_size = 0
+    for key, pos in items:
+        run.append((key, pos))
+        run_size += len(key) + SORT_ITEM_OVERHEAD
+        if run_size > max_memory:
+            run.sort()
+            runs.append(write_run(run, work_dir))
+            log.debug('Wrote sort run %s (%d items)', runs[-1], len(run))
+            run = []
+            run_size = 0
+    run.sort()
+
+    if not runs:
+        for item in run:
+            yield item
+        return
+
+    if run:
+        runs.append(write_run(run, work_dir))
+    del run
+
+    log.info('Merging %d sorted runs', len(runs))
+    while len(runs) > MAX_MERGE_FANIN:
+        merged_runs = []
+        for i in xrange(0, len(runs), MAX_MERGE_FANIN):
+            group = runs[i:i+MAX_MERGE_FANIN]
+            merged_runs.append(write_run(heapq.merge(*[read_run(name)
+                                                       for name in group]),
+                                         work_dir))
+        runs = merged_runs
+
+    for item in heapq.merge(*[read_run(name) for name in runs]):
+        yield item
+
+
+STORE_SUFFIXES = ('.titles', '.index', '.articles', '.keys')
+
+SHARD_PREFIX = 'shard-'
+
+def shard_name(session_dir, slot):
+    return os.path.join(session_dir, SHARD_PREFIX + str(slot))
+
+def new_shard(session_dir, slot, count=0):
+    """ Open article store for articles converted by worker process
+    in pool slot `slot`. Compiler reads articles from it after they
+    are registered with `Compiler.add_shard`. Worker that replaces
+    another one in the same slot continues the same store after first
+    `count` (registered) articles, so number of shards doesn't grow
+    as workers are replaced.
+    """
+    name = shard_name(session_dir, slot)
+    if count:
+        return TempArticleStore.reopen_shard(name, count, session_dir)
+    return TempArticleStore(session_dir, None, name)
 
 class TempArticleStore(object):
+    """ Temporary storage for articles. Articles from other stores
+    (shards, see `add_shard`) are included when articles are sorted
+    and read.
+    """
 
-    def __init__(self, work_dir=None):
-        fd, self.title_store_name = tempfile.mkstemp(prefix='aa-', suffix='.titles', dir=work_dir)
-        self.title_store = os.fdopen(fd, 'w')
-        fd, self.store_idx_name = tempfile.mkstemp(suffix='.index',
-                                                   prefix='aa-', 
-                                                   dir=work_dir)
-        self.store_idx = os.fdopen(fd, 'wb')
+    def __init__(self, work_dir=None, max_sort_memory=None, name=None):
+        self.work_dir = work_dir
+        self.max_sort_memory = max_sort_memory
+        if name is None:
+            fd, self.title_store_name = tempfile.mkstemp(prefix='aa-', suffix='.titles', dir=work_dir)
+            self.title_store = os.fdopen(fd, 'w')
+            fd, self.store_idx_name = tempfile.mkstemp(suffix='.index',
+                                                       prefix='aa-',
+                                                       dir=work_dir)
+            self.store_idx = os.fdopen(fd, 'wb')
+
+            fd, self.article_store_name = tempfile.mkstemp(suffix='.articles',
+                                                            prefix='aa-',
+                                                            dir=work_dir)
+            self.article_store = os.fdopen(fd, 'wb')
+
+            fd, self.key_store_name = tempfile.mkstemp(suffix='.keys',
+                                                       prefix='aa-',
+                                                       dir=work_dir)
+            self.key_store = os.fdopen(fd, 'wb')
+            self.name = self.store_idx_name[:-len('.index')]
+        else:
+            self.name = name
+            self.set_file_names()
+            self.title_store = open(self.title_store_name, 'wb')
+            self.store_idx = open(self.store_idx_name, 'wb')
+            self.article_store = open(self.article_store_name, 'wb')
+            self.key_store = open(self.key_store_name, 'wb')
 
-        fd, self.article_store_name = tempfile.mkstemp(suffix='.articles',
-                                                        prefix='aa-', 
-                                                        dir=work_dir)
-        self.article_store = os.fdopen(fd, 'wb')
+        self.order_name = self.name + '.order'
+        self.count = None
+        self.shards = []
 
         self.title_start = 0
         self.article_start = 0
-        idx_format = '>IHQI'
+        self.key_start = 0
+        self.init_format()
+
+    def set_file_names(self):
+        (self.title_store_name, self.store_idx_name,
+         self.article_store_name, self.key_store_name) = [
+            self.name + suffix for suffix in STORE_SUFFIXES]
+
+    def init_format(self):
+        idx_format = '>IHQIQH'
         self.pack = functools.partial(struct.pack, idx_format)
         self.unpack = functools.partial(struct.unpack, idx_format)
         self.fmt_size = struct.calcsize(idx_format)
 
-    def append(self, title, article):
+    @classmethod
+    def open_shard(cls, name, count):
+        """ Open existing store `name` for reading. Only first
+        `count` articles are used, anything written after them
+        is ignored.
+        """
+        store = cls.__new__(cls)
+        store.name = name
+        store.set_file_names()
+        store.title_store = store.store_idx = None
+        store.article_store = store.key_store = None
+        store.order_name = None
+        store.count = count
+        store.shards = []
+        store.init_format()
+        return store
+
+    @classmethod
+    def reopen_shard(cls, name, count, work_dir=None):
+        """ Open existing store `name` for appending after first
+        `count` articles, anything written after them is discarded.
+        """
+        store = cls.open_shard(name, count)
+        with open(store.store_idx_name, 'rb') as store_idx:
+            store_idx.seek((count - 1)*store.fmt_size)
+            (title_start, title_len, article_start, article_len,
+             key_start, key_len) = store.unpack(store_idx.read(store.fmt_size))
+        return cls.reopen(dict(name=name,
+                               file_names=[store.title_store_name,
+                                           store.store_idx_name,
+                                           store.article_store_name,
+                                           store.key_store_name],
+                               count=count,
+                               title_start=title_start + title_len,
+                               article_start=article_start + article_len,
+                               key_start=key_start + key_len),
+                          work_dir)
+
+    def add_shard(self, name, count):
+        self.shards.append(TempArticleStore.open_shard(name, count))
+
+    def state(self):
+        """ Return dictionary describing content written to this store
+        so far (not including shards) that can be given to `reopen`.
+        """
+        self.flush()
+        return dict(name=self.name,
+                    file_names=[self.title_store_name, self.store_idx_name,
+                                self.article_store_name, self.key_store_name],
+                    count=self.own_len(),
+                    title_start=self.title_start,
+                    article_start=self.article_start,
+                    key_start=self.key_start)
+
+    @classmethod
+    def reopen(cls, state, work_dir=None, max_sort_memory=None):
+        """ Open store described by `state` (see `state`) for appending,
+        anything written after the state was taken is discarded.
+        """
+        store = cls.__new__(cls)
+        store.work_dir = work_dir
+        store.max_sort_memory = max_sort_memory
+        store.name = state['name']
+        (store.title_store_name, store.store_idx_name,
+         store.article_store_name, store.key_store_name) = state['file_names']
+        store.init_format()
+        store.title_start = state['title_start']
+        store.article_start = state['article_start']
+        store.key_start = state['key_start']
+        def open_at(name, size):
+            f = open(name, 'r+b')
+            f.truncate(size)
+            f.seek(size)
+            return f
+        store.title_store = open_at(store.title_store_name, store.title_start)
+        store.store_idx = open_at(store.store_idx_name,
+                                  state['count']*store.fmt_size)
+        store.article_store = open_at(store.article_store_name,
+                                      store.article_start)
+        store.key_store = open_at(store.key_store_name, store.key_start)
+        store.order_name = store.name + '.order'
+        store.count = None
+        store.shards = []
+        return store
+
+    def append(self, title, article, sort_key=''):
         self.title_store.write(title)
         title_len = len(title)        
         
         self.article_store.write(article)
         article_len = len(article)        
-        
+
+        self.key_store.write(sort_key)
+        key_len = len(sort_key)
+
         self.store_idx.write(self.pack(self.title_start, title_len, 
-                                       self.article_start, article_len))
+                                       self.article_start, article_len,
+                                       self.key_start, key_len))
 
         self.title_start += title_len
         self.article_start += article_len
-        
+        self.key_start += key_len
 
-    def sorted(self, key=None):
-        """ Return generator that produces ordered (title, article) 
-        pairs sorted by title.
 
-        :param key: function of one argument that takes article title 
-                    and returns sort key for this title, title itself is used 
-                    as key if key function is None        
+    def flush(self):
+        if self.count is None:
+            self.title_store.flush()
+            self.article_store.flush()
+            self.key_store.flush()
+            self.store_idx.flush()
+
+    def own_len(self):
+        if self.count is not None:
+            return self.count
+        return self.store_idx.tell()/self.fmt_size
+
+    def __len__(self):
+        return self.own_len() + sum(len(shard) for shard in self.shards)
+
+    @property
+    def stores(self):
+        return [self] + self.shards
+
+    @contextmanager
+    def mapped(self, keys=False):
+        """ Context manager that provides list of read-only memory
+        maps of title store, article store, index and (if `keys` is
+        True) key store for this store and each shard.
         """
+        self.flush()
+        files = []
+        maps = []
+        try:
+            for store in self.stores:
+                store_maps = []
+                names = [store.title_store_name, store.article_store_name,
+                         store.store_idx_name]
+                if keys:
+                    names.append(store.key_store_name)
+                for name in names:
+                    f = open(name, 'rb')
+                    files.append(f)
+                    #empty file can't be mapped
+                    if os.fstat(f.fileno()).st_size:
+                        store_maps.append(mmap.mmap(f.fileno(), 0,
+                                                    access=mmap.ACCESS_READ))
+                    else:
+                        store_maps.append('')
+                maps.append(store_maps)
+            yield maps
+        finally:
+            for store_maps in maps:
+                for m in store_maps:
+                    if m:
+                        m.close()
+            for f in files:
+                f.close()
+
+    def index_item_at(self, store_idx, pos):
+        pos_start = pos*self.fmt_size
+        pos_end = pos_start + self.fmt_size
+        return self.unpack(store_idx[pos_start:pos_end])
+
+    def keys(self, title_store, store_idx, key=None):
+        """ Return generator that produces (sort key, position) pairs
+        for articles in this store (not including shards).
+        """
+        index_item_at = functools.partial(self.index_item_at, store_idx)
+        if key:
+            for i in xrange(self.own_len()):
+                title_start, title_len = index_item_at(i)[:2]
+                yield key(title_store[title_start:title_start+title_len]), i
+            return
+        #keys are stored in the same order as index items
+        with open(self.key_store_name, 'rb', 1024*1024) as key_store:
+            for i in xrange(self.own_len()):
+                index_item = index_item_at(i)
+                key_len = index_item[5]
+                if key_len:
+                    yield key_store.read(key_len), i
+                else:
+                    title_start, title_len = index_item[:2]
+                    yield title_store[title_start:title_start+title_len], i
 
-        self.title_store.flush()
-        self.article_store.flush()
-        self.store_idx.flush()
-
-        if key is None:
-            key = lambda x: x
-
-        with open(self.title_store_name, 'r+') as title_store_f:
-            with open(self.article_store_name, 'r+') as article_store_f:
-                with open(self.store_idx_name, 'r+b') as store_idx_f:
-
-                    title_store = mmap.mmap(title_store_f.fileno(), 0)
-                    article_store = mmap.mmap(article_store_f.fileno(), 0)
-                    store_idx = mmap.mmap(store_idx_f.fileno(), 0)
+    def sort(self, key=None, presorted=False):
+        """ Sort stored articles by title. Sorted order is written to
+        order file and is used by `items` and `sizes`.
 
-                    def index_item_at(pos):
-                        pos_start = pos*self.fmt_size
-                        pos_end = pos_start + self.fmt_size
-                        return self.unpack(store_idx[pos_start:pos_end])
+        :param key: function of one argument that takes article title
+                    and returns sort key (byte string) for this title. If
+                    key function is None sort keys given to `append` are
+                    used, or title itself if no sort key was given
 
+        :param presorted: if True articles were appended to this store
+                          (which has no shards) in sorted order and
+                          only need to be read in the same order
 
-                    def realkey(x):
-                        index_item = index_item_at(x)
-                        title_start = index_item[0]
-                        title_len = index_item[1]
-                        title_end = title_start+title_len
-                        title = title_store[title_start:title_end]
-                        return key(title)
+        If store was created with `max_sort_memory` sorting is done
+        with external merge sort using no more than approximately
+        this many bytes for sort keys.
+        """
+        pack_pos = functools.partial(struct.pack, ORDER_POS_FORMAT)
+        if presorted:
+            assert not self.shards
+            with open(self.order_name, 'wb', 1024*1024) as order:
+                for i in xrange(len(self)):
+                    order.write(pack_pos(i))
+            return
+
+        with self.mapped() as maps:
+
+            def keys():
+                #position includes number of the store it refers to
+                for n, store in enumerate(self.stores):
+                    title_store, article_store, store_idx = maps[n]
+                    for sort_key, i in store.keys(title_store,
+                                                  store_idx, key):
+                        yield sort_key, n << 32 | i
+
+            with open(self.order_name, 'wb', 1024*1024) as order:
+                for _, pos in merge_sort(keys(),
+                                         self.max_sort_memory,
+                                         self.work_dir):
+                    order.write(pack_pos(pos))
+
+    def sorted_index(self, start, end, maps):
+        """ Return generator that produces (maps, index item) pairs
+        for sorted positions from `start` to `end`.
+        """
+        if end is None:
+            end = len(self)
+        pos_size = struct.calcsize(ORDER_POS_FORMAT)
+        with open(self.order_name, 'rb', 1024*1024) as order:
+            order.seek(start*pos_size)
+            for _ in xrange(end - start):
+                pos, = struct.unpack(ORDER_POS_FORMAT, order.read(pos_size))
+                store_maps = maps[pos >> 32]
+                yield store_maps, self.index_item_at(store_maps[2],
+                                                     pos & 0xffffffff)
+
+    def items(self, start=0, end=None):
+        """ Return generator that produces (title, article) pairs
+        in sorted order (see `sort`), optionally only from
+        `start` to `end` sorted position.
+        """
+        with self.mapped() as maps:
+            for store_maps, index_item in self.sorted_index(start, end, maps):
+                title_store, article_store = store_maps[:2]
+                (title_start, title_len,
+                 article_start, article_len) = index_item[:4]
+                yield (title_store[title_start:title_start+title_len],
+                       article_store[article_start:article_start+article_len])
+
+    def keyed_items(self, start=0, end=None):
+        """ Return generator that produces (sort key, title, article)
+        tuples in sorted order (see `sort`), optionally only from
+        `start` to `end` sorted position. Sort key is title itself
+        if article was appended without one.
+        """
+        with self.mapped(keys=True) as maps:
+            for store_maps, index_item in self.sorted_index(start, end, maps):
+                title_store, article_store, _, key_store = store_maps
+                (title_start, title_len, article_start, article_len,
+                 key_start, key_len) = index_item
+                title = title_store[title_start:title_start+title_len]
+                if key_len:
+                    sort_key = key_store[key_start:key_start+key_len]
+                else:
+                    sort_key = title
+                yield (sort_key, title,
+                       article_store[article_start:article_start+article_len])
+
+    def titles(self, start=0, end=None):
+        """ Return generator that produces titles in sorted order
+        (see `sort`), optionally only from `start` to `end` sorted
+        position.
+        """
+        with self.mapped() as maps:
+            for store_maps, index_item in self.sorted_index(start, end, maps):
+                title_store = store_maps[0]
+                title_start, title_len = index_item[:2]
+                yield title_store[title_start:title_start+title_len]
+
+    def sizes(self, max_article_size=0, start=0, end=None):
+        """ Return generator that produces (title length, article
+        length, article) tuples in sorted order (see `sort`),
+        optionally only from `start` to `end` sorted position. Article
+        is only read if it is not longer than `max_article_size`,
+        otherwise it is None.
+        """
+        with self.mapped() as maps:
+            for store_maps, index_item in self.sorted_index(start, end, maps):
+                article_store = store_maps[1]
+                (title_start, title_len,
+                 article_start, article_len) = index_item[:4]
+                if article_len <= max_article_size:
+                    article = article_store[article_start:
+                                            article_start+article_len]
+                else:
+                    article = None
+                yield title_len, article_len, article
 
-                    for i in sorted(xrange(len(store_idx)/self.fmt_size),
-                                    key=realkey):
-                        title_start, title_len, article_start, article_len = index_item_at(i)
-                        yield (title_store[title_start:title_start+title_len], 
-                               article_store[article_start:article_start+article_len])
+    def sorted(self, key=None):
+        """ Sort articles (see `sort`) and return generator that
+        produces ordered (title, article) pairs.
+        """
+        self.sort(key)
+        return self.items()
 
     def close(self):
-        self.title_store.close()
-        self.article_store.close()
-        self.store_idx.close()
+        for f in (self.title_store, self.article_store,
+                  self.key_store, self.store_idx):
+            if f:
+                f.close()
         os.remove(self.title_store_name)
         os.remove(self.article_store_name)
-        os.remove(self.store_idx_name)        
+        os.remove(self.key_store_name)
+        os.remove(self.store_idx_name)
+        if self.order_name and os.path.exists(self.order_name):
+            os.remove(self.order_name)
+        for shard in self.shards:
+            shard.close()
+
+
+SORTED_SHARD_MAGIC = 'aardshard1'
+SORTED_SHARD_HEADER_LENGTH_FORMAT = '>L'
+SORTED_SHARD_RECORD_FORMAT = '>HHL'
+
+def write_sorted_shard(file_name, header, items):
+    """ Write sorted shard file: `header` (JSON serializable
+    dictionary) followed by (sort key, title, article) tuples produced
+    by `items`, which must be in sorted order. File is written under
+    temporary name and renamed when complete.
+    """
+    pack_record = functools.partial(struct.pack, SORTED_SHARD_RECORD_FORMAT)
+    with open(file_name + '.tmp', 'wb', 1024*1024) as f:
+        f.write(SORTED_SHARD_MAGIC)
+        header = tojson(header).encode('utf8')
+        f.write(struct.pack(SORTED_SHARD_HEADER_LENGTH_FORMAT, len(header)))
+        f.write(header)
+        for sort_key, title, article in items:
+            f.write(pack_record(len(sort_key), len(title), len(article)))
+            f.write(sort_key)
+            f.write(title)
+            f.write(article)
+    os.rename(file_name + '.tmp', file_name)
+
+def read_sorted_shard_header(f):
+    magic = f.read(len(SORTED_SHARD_MAGIC))
+    if magic != SORTED_SHARD_MAGIC:
+        raise ValueError('%s is not a sorted shard file' % f.name)
+    length_size = struct.calcsize(SORTED_SHARD_HEADER_LENGTH_FORMAT)
+    length, = struct.unpack(SORTED_SHARD_HEADER_LENGTH_FORMAT,
+                            f.read(length_size))
+    return json.loads(f.read(length))
+
+def read_sorted_shard(file_name):
+    """ Return (header, records) pair for sorted shard file written
+    by `write_sorted_shard`, where records is a generator that
+    produces (sort key, title, article) tuples.
+    """
+    f = open(file_name, 'rb', 1024*1024)
+    header = read_sorted_shard_header(f)
+    record_size = struct.calcsize(SORTED_SHARD_RECORD_FORMAT)
+    def records():
+        with f:
+            while True:
+                record = f.read(record_size)
+                if not record:
+                    break
+                key_len, title_len, article_len = struct.unpack(
+                    SORTED_SHARD_RECORD_FORMAT, record)
+                yield (f.read(key_len), f.read(title_len),
+                       f.read(article_len))
+    return header, records()
+
+
+HASH_TYPECODE = 'L'
+HASH_MASK = (1 << 8*array(HASH_TYPECODE).itemsize) - 1
+
+def title_hash(title):
+    """ Return 64-bit hash of a title (byte string), or 32-bit on
+    platforms where unsigned long is 32 bits.
+    """
+    h, = struct.unpack('>Q', hashlib.sha1(title).digest()[:8])
+    return h & HASH_MASK
+
+class TitleHashSet(object):
+    """ Compact read-only set of titles represented by sorted array
+    of title hashes (see `title_hash`). Hash collisions are unlikely
+    enough to be ignored.
+
+    >>> titles = TitleHashSet(['a', 'b', 'c'])
+    >>> len(titles)
+    3
+    >>> 'b' in titles
+    True
+    >>> 'd' in titles
+    False
+    >>> '' in TitleHashSet()
+    False
+    """
+
+    def __init__(self, titles=()):
+        self.hashes = array(HASH_TYPECODE,
+                            sorted(title_hash(title) for title in titles))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, title):
+        h = title_hash(title)
+        i = bisect.bisect_left(self.hashes, h)
+        return i < len(self.hashes) and self.hashes[i] == h
+
+
+def read_lines(file_name, size):
+    """ Return generator that produces lines (without line end) from
+    first `size` bytes of file `file_name`.
+    """
+    with open(file_name, 'rb') as f:
+        for line in f:
+            size -= len(line)
+            if size < 0:
+                break
+            yield line[:-1]
+
+CHECKPOINT_FILE = 'checkpoint.json'
+ARGS_FILE = 'args.json'
+
+#options that specify file or directory names
+PATH_OPTIONS = ('output_file', 'templates', 'metadata', 'license',
+                'copyright', 'work_dir', 'log_file', 'siteinfo',
+                'article_cache', 'template_cache', 'math_cache')
+
+def absolute_paths(options, args):
+    """ Replace file and directory names in parsed command line
+    `options` with absolute paths and return command line `args` with
+    absolute input file names, so that compilation can be resumed
+    from a different directory.
+    """
+    for name in PATH_OPTIONS:
+        value = getattr(options, name, None)
+        if value:
+            setattr(options, name, os.path.abspath(value))
+    return args[:1] + [arg if arg == '-' else os.path.abspath(arg)
+                       for arg in args[1:]]
+
+def write_args(session_dir, options, args):
+    with open(os.path.join(session_dir, ARGS_FILE), 'w') as f:
+        json.dump(dict(options=options.__dict__, args=args), f)
+
+def read_args(session_dir):
+    """ Return (options, args) pair saved with `write_args`. """
+    def utf8(value):
+        return value.encode('utf8') if isinstance(value, unicode) else value
+    with open(os.path.join(session_dir, ARGS_FILE)) as f:
+        saved = json.load(f)
+    options = optparse.Values(dict((str(key), utf8(value)) for key, value
+                                   in saved['options'].iteritems()))
+    return options, [utf8(arg) for arg in saved['args']]
+
+def read_checkpoint(session_dir):
+    """ Return compiler state saved in `session_dir` or None if there
+    is no checkpoint.
+    """
+    file_name = os.path.join(session_dir, CHECKPOINT_FILE)
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name) as f:
+        return json.load(f)
 
 class Compiler(object):
+    """ Collects articles and compiles them into .aar volumes.
+
+    If `checkpoint_interval` (in seconds) is specified compiler state
+    is periodically saved in session dir (see `checkpoint`). Compiler
+    created with `resume` state (see `read_checkpoint`) continues from
+    that checkpoint: articles written to temporary store after it are
+    discarded, first articles given to `add_article` that were added
+    before checkpoint are skipped (input is expected to produce
+    articles in the same order), titles processed before checkpoint
+    are listed in done.txt and can be checked with `is_done`.
+    """
 
-    def __init__(self, output_file_name, max_file_size, session_dir, metadata=None):
+    def __init__(self, output_file_name, max_file_size, session_dir,
+                 metadata=None, max_sort_memory=None, compress_processes=0,
+                 volume_processes=None, checkpoint_interval=0, resume=None):
         self.uuid = uuid.uuid4()
         self.output_file_name = output_file_name
         self.max_file_size = max_file_size
         self.index_count = 0
         self.session_dir = session_dir
-        self.failed_articles = open(os.path.join(self.session_dir, "failed.txt"), 'w')
-        self.empty_articles = open(os.path.join(self.session_dir, "empty.txt"), 'w')
-        self.skipped_articles = open(os.path.join(self.session_dir, "skipped.txt"), 'w')
+        self.resume = resume
+        self.lists = {}
+        self.failed_articles = self.open_list("failed.txt")
+        self.empty_articles = self.open_list("empty.txt")
+        self.skipped_articles = self.open_list("skipped.txt")
+        self.timedout_articles = self.open_list("timedout.txt")
+        self.done_articles = self.open_list("done.txt")
         self.metadata = metadata if metadata is not None else {}
         self.file_names = []
         self.stats = Stats()
         self.last_stat_update = 0
-        self.article_store = TempArticleStore(self.session_dir)
+        self.compress_processes = compress_processes
+        self.compress_pool = None
+        self.compress_batch = []
+        self.compress_results = deque()
+        self.volume_processes = volume_processes
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = time.time()
+        self.add_count = 0
+        self.compile_state = dict(sorted=False, volumes={})
+        if resume:
+            self.uuid = uuid.UUID(resume['uuid'])
+            self.article_store = TempArticleStore.reopen(resume['store'],
+                                                         self.session_dir,
+                                                         max_sort_memory)
+            self.shards = dict(resume['shards'])
+            for key, value in resume['stats'].iteritems():
+                setattr(self.stats, key, value)
+            self.stats.start_time -= resume['elapsed']
+            compress_counts.update(resume['compress_counts'])
+            self.skip_count = resume['add_count']
+            self.done_titles = TitleHashSet(
+                read_lines(os.path.join(self.session_dir, "done.txt"),
+                           resume['lists']["done.txt"]))
+            if resume['phase'] != 'collect':
+                #converter doesn't run again, so metadata it added
+                #is restored too
+                self.metadata = resume['metadata']
+                self.compile_state = resume['compile']
+            log.info('Resuming from checkpoint, %d titles done, '
+                     '%d articles in temporary store',
+                     len(self.done_titles), len(self.article_store))
+        else:
+            self.article_store = TempArticleStore(self.session_dir,
+                                                  max_sort_memory)
+            self.shards = {}
+            self.skip_count = 0
+            self.done_titles = None
         log.info('Collecting articles')
 
+    def open_list(self, name):
+        """ Open file in session dir listing article titles. When
+        resuming anything written after checkpoint is discarded.
+        """
+        file_name = os.path.join(self.session_dir, name)
+        if self.resume:
+            f = open(file_name, 'r+b')
+            f.truncate(self.resume['lists'][name])
+            f.seek(0, os.SEEK_END)
+        else:
+            f = open(file_name, 'wb')
+        self.lists[name] = f
+        return f
+
+    @utf8
+    def is_done(self, title):
+        """ Return True if article `title` was processed before
+        checkpoint compilation is resumed from.
+        """
+        return self.done_titles is not None and title in self.done_titles
+
+    def checkpoint(self, phase='collect'):
+        """ Save compiler state to session dir. Articles appended to
+        temporary store and titles logged so far are part of the
+        state, so it must be called when articles being compressed
+        or converted are accounted for (see `maybe_checkpoint`).
+        """
+        sizes = {}
+        for name, f in self.lists.iteritems():
+            if not f.closed:
+                f.flush()
+            sizes[name] = os.path.getsize(f.name)
+        state = dict(phase=phase,
+                     uuid=self.uuid.hex,
+                     store=self.article_store.state(),
+                     shards=self.shards,
+                     stats=dict((key, getattr(self.stats, key))
+                                for key in ('skipped', 'failed', 'empty',
+                                            'timedout', 'articles',
+                                            'redirects', 'cache_hits',
+                                            'cache_misses', 'template_hits',
+                                            'template_misses', 'memo_hits',
+                                            'memo_misses',
+                                            'memo_saved_time')),
+                     elapsed=time.time() - self.stats.start_time,
+                     compress_counts=compress_counts,
+                     add_count=self.add_count,
+                     lists=sizes,
+                     metadata=self.metadata,
+                     compile=self.compile_state)
+        file_name = os.path.join(self.session_dir, CHECKPOINT_FILE)
+        #checkpoint file is replaced atomically so it is either
+        #old or new, never partially written
+        with open(file_name+'.tmp', 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(file_name+'.tmp', file_name)
+        self.last_checkpoint = time.time()
+        log.info('Saved checkpoint (%s, %d articles)',
+                 phase, self.stats.processed)
+
+    def maybe_checkpoint(self):
+        if (self.checkpoint_interval and
+            time.time() - self.last_checkpoint > self.checkpoint_interval):
+            self.drain_compression()
+            self.checkpoint()
+
     def add_metadata(self, key, value):
         if key not in self.metadata:
             self.metadata[key] = value
@@ -443,8 +1340,14 @@ class Compiler(object):
                      key, value)
 
     @utf8
-    def add_article(self, title, serialized_article, redirect=False, count=True):
+    def add_article(self, title, serialized_article, redirect=False, count=True,
+                    sort_key=None):
         with article_add_lock:
+            self.maybe_checkpoint()
+            self.add_count += 1
+            if self.add_count <= self.skip_count:
+                log.debug('Skipping "%s", added before checkpoint', title)
+                return
             if not title:
                 log.warn('Blank title, ignoring article "%s"',
                          serialized_article)
@@ -453,34 +1356,147 @@ class Compiler(object):
                 self.empty_article(title)
                 return
             log.debug('Adding article for "%s"', title)
-            self.article_store.append(title, compress(serialized_article))
+            if self.compress_processes:
+                self.compress_batch.append((title, serialized_article, sort_key))
+                if len(self.compress_batch) >= COMPRESS_BATCH_SIZE:
+                    self.submit_compress_batch()
+            else:
+                if sort_key is None:
+                    sort_key = sortkey(title)
+                compressed_article, codec = compress_article(serialized_article)
+                self.append_compressed(title, compressed_article, codec, sort_key)
+            self.count_article(title, redirect, count)
+
+    @utf8
+    def add_compressed_article(self, title, compressed_article, codec,
+                               redirect=False, count=True, sort_key=None):
+        """ Add article already compressed with `compress_article`
+        (for example, by a worker process).
+        """
+        with article_add_lock:
             if count:
-                if not redirect:
-                    self.stats.articles += 1
-                else:
-                    self.stats.redirects += 1
-            self.print_stats()
+                self.maybe_checkpoint()
+            if not title:
+                log.warn('Blank title, ignoring compressed article')
+                return
+            if not compressed_article:
+                self.empty_article(title)
+                return
+            log.debug('Adding compressed article for "%s"', title)
+            if sort_key is None:
+                sort_key = sortkey(title)
+            self.append_compressed(title, compressed_article, codec, sort_key)
+            self.count_article(title, redirect, count)
+
+    @utf8
+    def add_shard_article(self, title, codec, redirect=False, count=True):
+        """ Account for article that was compressed and stored in a
+        shard store (see `new_shard`) by a worker process.
+        """
+        with article_add_lock:
+            log.debug('Article for "%s" added to shard', title)
+            compress_counts[codec] += 1
+            self.count_article(title, redirect, count)
+
+    def add_shard(self, name, count):
+        """ Set number of articles in shard store `name` that are to
+        be included in compiled dictionary.
+        """
+        #articles from shard's previous batches are accounted for
+        self.maybe_checkpoint()
+        self.shards[name] = count
+
+    def append_compressed(self, title, compressed_article, codec, sort_key):
+        compress_counts[codec] += 1
+        self.article_store.append(title, compressed_article, sort_key)
+
+    def count_article(self, title, redirect, count):
+        if count:
+            self.done_articles.write(title+'\n')
+            if not redirect:
+                self.stats.articles += 1
+            else:
+                self.stats.redirects += 1
+        self.print_stats()
+
+    def count_cached(self, cached, template_hits=0, template_misses=0,
+                     memo_hits=0, memo_misses=0, memo_saved_time=0.0):
+        """ Account for article cache lookup: `cached` is True if
+        article was found in cache, False if not and None if cache
+        wasn't used. Template cache and template memo hits and misses
+        and time saved by template memo are counted too.
+        """
+        if cached:
+            self.stats.cache_hits += 1
+        elif cached is not None:
+            self.stats.cache_misses += 1
+        self.stats.template_hits += template_hits
+        self.stats.template_misses += template_misses
+        self.stats.memo_hits += memo_hits
+        self.stats.memo_misses += memo_misses
+        self.stats.memo_saved_time += memo_saved_time
+
+    def submit_compress_batch(self):
+        if self.compress_pool is None:
+            log.info('Creating compression worker pool')
+            self.compress_pool = multiprocessing.Pool(self.compress_processes)
+        self.compress_results.append(
+            self.compress_pool.apply_async(compress_batch,
+                                           (self.compress_batch,)))
+        self.compress_batch = []
+        #keep a few batches in flight, append compressed articles in
+        #the order they were added
+        while len(self.compress_results) > 2*self.compress_processes:
+            self.append_compressed_batch(self.compress_results.popleft().get())
+
+    def append_compressed_batch(self, batch):
+        for title, compressed_article, codec, sort_key in batch:
+            self.append_compressed(title, compressed_article, codec, sort_key)
+
+    def drain_compression(self):
+        """ Wait for articles being compressed and append them to
+        temporary store.
+        """
+        with article_add_lock:
+            if self.compress_batch:
+                self.submit_compress_batch()
+            while self.compress_results:
+                self.append_compressed_batch(self.compress_results.popleft().get())
+
+    def finish_compression(self):
+        with article_add_lock:
+            self.drain_compression()
+            if self.compress_pool:
+                self.compress_pool.close()
+                self.compress_pool.join()
+                self.compress_pool = None
 
     @utf8
     def fail_article(self, title):
         self.stats.failed += 1
         self.failed_articles.write(title+'\n')
+        self.done_articles.write(title+'\n')
         self.print_stats()
 
     @utf8
     def empty_article(self, title):
         self.stats.empty += 1
         self.empty_articles.write(title+'\n')
+        self.done_articles.write(title+'\n')
         self.print_stats()
 
     @utf8
     def skip_article(self, title):
         self.stats.skipped += 1
         self.skipped_articles.write(title+'\n')
+        self.done_articles.write(title+'\n')
         self.print_stats()
 
-    def timedout(self, count=1):
-        self.stats.timedout += count
+    @utf8
+    def timedout(self, title):
+        self.stats.timedout += 1
+        self.timedout_articles.write(title+'\n')
+        self.done_articles.write(title+'\n')
         self.print_stats()
 
     def print_stats(self):
@@ -489,63 +1505,170 @@ class Compiler(object):
             self.last_stat_update = t
             print_progress(self.stats)
 
-    def compile(self):
+    def finish_collecting(self):
+        self.finish_compression()
         print_progress(self.stats)
         writeln()
-        self.failed_articles.close()
-        self.empty_articles.close()
-        self.skipped_articles.close()
+        for f in self.lists.itervalues():
+            f.close()
+        self.open_shards()
+
+    def sort_articles(self):
+        if self.compile_state['sorted']:
+            log.info('Articles are already sorted')
+        else:
+            self.article_store.sort()
+            self.compile_state['sorted'] = True
+            self.checkpoint('compile')
+
+    def merge_sorted_shards(self, file_names):
+        """ Merge articles from sorted shard files (see
+        `write_sorted_shard`) into temporary store in sorted order,
+        so they don't need to be sorted again.
+        """
+        shards = [read_sorted_shard(file_name) for file_name in file_names]
+        for file_name, (header, records) in zip(file_names, shards):
+            log.info('Merging %d articles and %d redirects from %s',
+                     header['articles'], header['redirects'], file_name)
+            for key, value in header['metadata'].iteritems():
+                if self.metadata.get(key) != value:
+                    self.add_metadata(key, value)
+            for codec, count in header['compress_counts'].iteritems():
+                compress_counts[str(codec)] += count
+        #shard number and position in shard are part of merged items,
+        #so articles with equal keys are never compared
+        def numbered(n, records):
+            for i, (sort_key, title, article) in enumerate(records):
+                yield sort_key, n, i, title, article
+        merged = heapq.merge(*[numbered(n, records)
+                               for n, (header, records) in enumerate(shards)])
+        for sort_key, n, i, title, article in merged:
+            self.article_store.append(title, article, sort_key)
+        for header, records in shards:
+            self.stats.articles += header['articles']
+            self.stats.redirects += header['redirects']
+        self.print_stats()
+        self.article_store.sort(presorted=True)
+        self.compile_state['sorted'] = True
+
+    def write_sorted_shard(self):
+        """ Sort collected articles and write them to sorted shard
+        file instead of compiling .aar volumes. Shards are combined
+        into a dictionary with `merge_sorted_shards`.
+        """
+        self.finish_collecting()
+        writeln('Writing sorted shard')
+        self.sort_articles()
+        header = dict(metadata=self.metadata,
+                      articles=self.stats.articles,
+                      redirects=self.stats.redirects,
+                      compress_counts=compress_counts)
+        write_sorted_shard(self.output_file_name, header,
+                           self.article_store.keyed_items())
+        self.file_names = [self.output_file_name]
+        log.info('Wrote sorted shard %s', self.output_file_name)
+        display.write('Created ').bold(self.output_file_name).writeln()
+        self.checkpoint('done')
+        self.article_store.close()
+
+    def compile(self):
+        self.finish_collecting()
         writeln('Compiling .aar files')
-        self.add_metadata("article_count", self.stats.articles)
-        articles = self.article_store.sorted(key=lambda x:
-                                                 collation_key(x).getByteArray())
+        if not self.resume or self.resume['phase'] == 'collect':
+            self.add_metadata("article_count", self.stats.articles)
         log.info('Compiling %s', self.output_file_name)
-        metadata = compress(tojson(self.metadata).encode('utf8'))
+        #volumes written before resume must have the same metadata
+        if 'metadata' in self.compile_state:
+            metadata = self.compile_state['metadata'].decode('base64')
+        else:
+            metadata = compress(tojson(self.metadata).encode('utf8'))
+            self.compile_state['metadata'] = metadata.encode('base64')
+            self.checkpoint('compile')
         header_meta_len = spec_len(HEADER_SPEC) + len(metadata)
-        create_volume_func = functools.partial(self.create_volume,
-                                               header_meta_len)
-        for volume in self.make_volumes(create_volume_func, articles):
-            m = "Creating volume %d" % volume.number
-            log.info(m)
-            writeln(m).flush()
-            file_name = self.make_aar(volume)
-            self.file_names.append(file_name)
-            m = "Wrote volume %d" % volume.number
+        self.sort_articles()
+        #sizes of all volume sections are known before anything is
+        #written, so each volume is written directly to its .aar
+        #file and volumes can be written at the same time
+        volumes = self.plan_volumes(header_meta_len)
+        total_volumes = len(volumes)
+        #volumes written before compilation was resumed
+        written = self.compile_state['volumes']
+        for volume in volumes:
+            m = "Planned volume %d (%d articles)" % (volume.number,
+                                                     volume.index_count)
+            if str(volume.number) in written:
+                m += ', already written'
             log.info(m)
             writeln(m).flush()
-        self.article_store.close()
-        self.write_volume_count()
-        self.write_sha1sum()
+            self.log_dedup(volume)
+        tasks = [(volume, metadata, total_volumes) for volume in volumes
+                 if str(volume.number) not in written]
+        if tasks:
+            if self.volume_processes:
+                pool = multiprocessing.Pool(min(len(tasks),
+                                                self.volume_processes),
+                                            initializer=_init_volume_writer,
+                                            initargs=[self])
+                make_aar = write_volume
+            else:
+                pool = ThreadPool(min(len(tasks), multiprocessing.cpu_count()))
+                make_aar = lambda task: self.make_aar(*task)
+            try:
+                for number, file_name in pool.imap_unordered(make_aar,
+                                                             tasks, 1):
+                    written[str(number)] = file_name
+                    self.checkpoint('compile')
+            finally:
+                pool.close()
+                pool.join()
+        self.file_names = [written[str(volume.number)]
+                           for volume in volumes]
         rename_files(self.file_names)
+        self.checkpoint('done')
+        self.article_store.close()
 
-    def create_volume(self, header_meta_len):
-        return Volume(header_meta_len, self.max_file_size, self.session_dir)
-
-    def make_volumes(self, create_volume_func, articles):
-        volume = create_volume_func()
-        for title, serialized_article in articles:
-            index1Unit = struct.pack(INDEX1_ITEM_FORMAT,
-                                     volume.index2Length,
-                                     volume.articles_len)
-            index2Unit = struct.pack(KEY_LENGTH_FORMAT, len(title)) + title
-            article_unit = (struct.pack(ARTICLE_LENGTH_FORMAT,
-                                       len(serialized_article)) +
-                            serialized_article)
+    def open_shards(self):
+        for name in glob.glob(os.path.join(self.session_dir,
+                                           SHARD_PREFIX+'*.index')):
+            name = name[:-len('.index')]
+            if name in self.shards:
+                log.info('Reading %d articles from shard %s',
+                         self.shards[name], name)
+                self.article_store.add_shard(name, self.shards[name])
+            else:
+                log.debug('Removing unused shard %s', name)
+                for suffix in STORE_SUFFIXES:
+                    os.remove(name+suffix)
+
+    def plan_volumes(self, header_meta_len):
+        """ Split sorted articles into volumes no bigger than maximum
+        file size using only title and article lengths (and digests
+        of small articles). Return list of `Volume` objects.
+        """
+        volumes = []
+        volume = Volume(1, 0, header_meta_len, self.max_file_size)
+        sizes = self.article_store.sizes(DEDUP_MAX_SIZE)
+        for title_len, article_len, article in sizes:
+            digest = article_digest(article)
             try:
-                volume.add(index1Unit, index2Unit, article_unit)
+                volume.add(title_len, article_len, digest)
             except Volume.ExceedsMaxSize:
-                volume.flush()
-                yield volume
-                volume = create_volume_func()
-                index1Unit = struct.pack(INDEX1_ITEM_FORMAT,
-                                         volume.index2Length,
-                                         volume.articles_len)
-                volume.add(index1Unit, index2Unit, article_unit)
-        volume.flush()
-        yield volume
+                volume.close()
+                volumes.append(volume)
+                volume = Volume(volume.number + 1, volume.end,
+                                header_meta_len, self.max_file_size)
+                volume.add(title_len, article_len, digest)
+        volume.close()
+        volumes.append(volume)
+        return volumes
+
+    def log_dedup(self, volume):
+        log.info('Volume %d: %d of %d index items point to '
+                 'previously written identical articles',
+                 volume.number, volume.dedup_count, volume.index_count)
 
     def write_header(self, output_file, meta_length, index1Length,
-                     index2Length, index_count, volume):
+                     index2Length, index_count, volume, total_volumes):
         article_offset = (spec_len(HEADER_SPEC) + meta_length +
                           index1Length + index2Length)
         values = dict(signature='aard',
@@ -553,118 +1676,143 @@ class Compiler(object):
                       version=1,
                       uuid=self.uuid.bytes,
                       volume=volume,
-                      of=0,
-                      total_volumes=0,
+                      total_volumes=total_volumes,
                       meta_length=meta_length,
                       index_count=index_count,
                       article_offset=article_offset,
                       index1_item_format=INDEX1_ITEM_FORMAT,
                       key_length_format=KEY_LENGTH_FORMAT,
                       article_length_format=ARTICLE_LENGTH_FORMAT)
-        for name, fmt in HEADER_SPEC:
-            output_file.write(struct.pack(fmt, values[name]))
+        header = ''.join(struct.pack(fmt, values[name])
+                         for name, fmt in HEADER_SPEC)
+        output_file.write(header)
+        return header
 
     def write_meta(self, output_file, metadata):
         output_file.write(metadata)
 
-    def write_index1(self, output_file, index1):
-        log.debug('Writing index 1')
-        index1.seek(0)
-        count = 0
-        while True:
-            unit = index1.read(struct.calcsize(INDEX1_ITEM_FORMAT))
-            if len(unit) == 0:
-                break
-            index2ptr, offset = struct.unpack(INDEX1_ITEM_FORMAT, unit)
-            unit = struct.pack(INDEX1_ITEM_FORMAT, index2ptr, offset)
-            output_file.write(unit)
-            count += 1
-        log.debug('Wrote %d items to index 1', count)
-        index1.close()
-
-    def write_index2(self, output_file, index2):
-        log.debug('Writing index 2')
-        index2.seek(0)
-        count = 0
-        while True:
-            unitLengthString = index2.read(struct.calcsize(KEY_LENGTH_FORMAT))
-            if len(unitLengthString) == 0:
-                break
-            count += 1
-            unitLength, = struct.unpack(KEY_LENGTH_FORMAT, unitLengthString)
-            unit = index2.read(unitLength)
-            output_file.write(unitLengthString + unit)
-        log.debug('Wrote %d items to index 2', count)
-        index2.close()
-
-    def write_articles(self, output_file, articles):
-        articles.seek(0)
-        count = 0
-        while True:
-            unitLengthString = articles.read(struct.
-                                             calcsize(ARTICLE_LENGTH_FORMAT))
-            if len(unitLengthString) == 0:
-                break
-            count += 1
-            unitLength, = struct.unpack(ARTICLE_LENGTH_FORMAT,
-                                        unitLengthString)
-            unit = articles.read(unitLength)
-            output_file.write(unitLengthString + unit)
-        log.debug('Wrote %d items to articles', count)
-        articles.close()
-
-    def write_sha1sum(self):
-        for file_name in self.file_names:
-            msg = "Calculating checksum for %s" % file_name
-            log.info(msg)
-            offset = spec_len(HEADER_SPEC[:2])
-            st_size = os.stat(file_name).st_size
-            size = float(st_size - offset)
-            for pos, sha1sum in calcsha1(file_name, offset):
-                (display.erase_line().cr()
-                .write(msg).write(': ').write('%.1f%%' % (100*pos/size)))
-            sha1sum = sha1sum.hexdigest()
-            msg = "%s sha1: %s" % (file_name, sha1sum)
-            log.info(msg)
-            display.erase_line().cr().writeln(msg)
-            output_file = open(file_name, "r+b")
-            output_file.seek(spec_len(HEADER_SPEC[:1]))
-            output_file.write(sha1sum)
-            output_file.close()
-
-    def make_aar(self, volume):
-        (index1, index1Length, index2, index2Length, articles,
-         articles_len, index_count) = volume.totuple()
-        file_name = '%s.%d' % (self.output_file_name, Volume.number)
-        output_file = open(file_name, "wb", 8192)
-        metadata = compress(tojson(self.metadata).encode('utf8'))
-        self.write_header(output_file, len(metadata), index1Length,
-                          index2Length, index_count, Volume.number)
+    def write_section(self, output_file, units, length, name, sha1):
+        log.debug('Writing %s (%d bytes)', name, length)
+        written = write_units(output_file, units, sha1)
+        if written != length:
+            raise IOError('Expected to write %d bytes of %s, wrote %d' %
+                          (length, name, written))
+
+    def index1_units(self, volume, duplicates):
+        """ Generate index 1 items for `volume`, mark positions of
+        articles that point to previously written identical articles
+        in `duplicates`.
+        """
+        key_length_len = struct.calcsize(KEY_LENGTH_FORMAT)
+        article_length_len = struct.calcsize(ARTICLE_LENGTH_FORMAT)
+        index2_offset = 0
+        articles_len = 0
+        article_offsets = {}
+        sizes = self.article_store.sizes(DEDUP_MAX_SIZE,
+                                         volume.start, volume.end)
+        for i, (title_len, article_len, article) in enumerate(sizes):
+            digest = article_digest(article)
+            offset = article_offsets.get(digest) if digest else None
+            if offset is None:
+                offset = articles_len
+                articles_len += article_length_len + article_len
+                if digest:
+                    article_offsets[digest] = offset
+            else:
+                duplicates[i] = 1
+            yield struct.pack(INDEX1_ITEM_FORMAT, index2_offset, offset)
+            index2_offset += key_length_len + title_len
+
+    def index2_units(self, volume):
+        for title in self.article_store.titles(volume.start, volume.end):
+            yield struct.pack(KEY_LENGTH_FORMAT, len(title)) + title
+
+    def article_units(self, volume, duplicates):
+        articles = self.article_store.items(volume.start, volume.end)
+        for i, (title, serialized_article) in enumerate(articles):
+            if not duplicates[i]:
+                yield (struct.pack(ARTICLE_LENGTH_FORMAT,
+                                   len(serialized_article)) +
+                       serialized_article)
+
+    def make_aar(self, volume, metadata, total_volumes):
+        file_name = '%s.%d' % (self.output_file_name, volume.number)
+        output_file = open(file_name, "w+b", WRITE_BUFFER_SIZE)
+        header = self.write_header(output_file, len(metadata),
+                                   volume.index1Length, volume.index2Length,
+                                   volume.index_count, volume.number,
+                                   total_volumes)
+        #checksum covers everything after signature and sha1 fields
+        sha1 = hashlib.sha1(header[spec_len(HEADER_SPEC[:2]):])
         self.write_meta(output_file, metadata)
-        self.write_index1(output_file, index1)
-        self.write_index2(output_file, index2)
-        self.write_articles(output_file, articles)
+        sha1.update(metadata)
+        duplicates = bytearray(volume.index_count)
+        self.write_section(output_file,
+                           self.index1_units(volume, duplicates),
+                           volume.index1Length, 'index 1', sha1)
+        self.write_section(output_file, self.index2_units(volume),
+                           volume.index2Length, 'index 2', sha1)
+        self.write_section(output_file,
+                           self.article_units(volume, duplicates),
+                           volume.articles_len, 'articles', sha1)
+        sha1sum = sha1.hexdigest()
+        output_file.seek(spec_len(HEADER_SPEC[:1]))
+        output_file.write(sha1sum)
         output_file.close()
-        log.info("Done with %s", file_name)
-        return file_name
-
-    def write_volume_count(self):
-        name, fmt = HEADER_SPEC[5]
-        log.info("Writing volume count %d to all volumes as %s",
-                 Volume.number, fmt)
-        log.debug('Writing' )
-        for file_name in self.file_names:
-            output_file = open(file_name, "r+b")
-            output_file.seek(spec_len(HEADER_SPEC[:5]))
-            output_file.write(struct.pack(fmt, Volume.number))
-            output_file.close()
+        m = "Wrote volume %d, sha1: %s" % (volume.number, sha1sum)
+        log.info(m)
+        writeln(m).flush()
+        return volume.number, file_name
+
+def article_digest(serialized_article):
+    """ Return digest identifying duplicate articles or None if
+    article is not given or is too big to be deduplicated.
+    """
+    if (serialized_article is not None and
+        len(serialized_article) <= DEDUP_MAX_SIZE):
+        return hashlib.sha1(serialized_article).digest()
+    return None
+
+volume_writer = None
+
+def _init_volume_writer(compiler):
+    global volume_writer
+    volume_writer = compiler
+
+def write_volume(task):
+    return volume_writer.make_aar(*task)
+
+WRITE_BUFFER_SIZE = 16*1024*1024
+
+def write_units(output_file, units, sha1):
+    """ Write strings produced by `units` to `output_file` in large
+    blocks, update `sha1` with written data and return number of
+    bytes written.
+    """
+    written = 0
+    block = []
+    block_len = 0
+    for unit in units:
+        block.append(unit)
+        block_len += len(unit)
+        if block_len >= WRITE_BUFFER_SIZE:
+            data = ''.join(block)
+            output_file.write(data)
+            sha1.update(data)
+            written += block_len
+            block = []
+            block_len = 0
+    data = ''.join(block)
+    output_file.write(data)
+    sha1.update(data)
+    written += block_len
+    return written
 
 def rename_files(file_names):
     """
     >>> from minimock import mock
     >>> import compiler
     >>> mock('compiler.rename_file', returns_func=lambda f, p, args: None)
-    >>> Volume.number = 2
     >>> rename_files(['enwiki-20090530-2.aar.1'])
     Called compiler.rename_file(
         'enwiki-20090530-2.aar.1',
@@ -700,14 +1848,18 @@ def rename_files(file_names):
             ext = 'aar'
         else:
             base, ext, vol = file_name.rsplit('.', 2)
-        args = (base, ext) if one else (base, vol, Volume.number, ext)
+        args = (base, ext) if one else (base, vol, len(file_names), ext)
         rename_file(file_name, pattern, args)
 
 def rename_file(file_name, newname_pattern, args):
     newname = newname_pattern % args
-    log.info('Renaming %s ==> %s', file_name, newname)
+    if not os.path.exists(file_name) and os.path.exists(newname):
+        #compilation was interrupted after renaming and then resumed
+        log.info('%s is already renamed to %s', file_name, newname)
+    else:
+        log.info('Renaming %s ==> %s', file_name, newname)
+        os.rename(file_name, newname)
     display.write('Created ').bold(newname).writeln()
-    os.rename(file_name, newname)
 
 
 import zlib
@@ -722,25 +1874,184 @@ def _bz2(s):
 from collections import defaultdict
 compress_counts = defaultdict(int)
 
+import math
+
+class CompressionPolicy(object):
+    """ Decides which compression functions are applied to an article.
+    Runs all compression functions and keeps the smallest result,
+    subclasses skip some of them.
+
+    Time spent by compression functions is measured to estimate CPU
+    time saved by not running some of them. Estimate is accumulated in
+    shared value so that it includes time saved in worker processes.
+    """
+
+    name = 'best'
+    codecs = (_zlib, _bz2)
+
+    def __init__(self):
+        self.saved_time = multiprocessing.Value('d', 0.0)
+        self.codec_time = defaultdict(float)
+        self.codec_bytes = defaultdict(int)
+
+    def compress(self, text):
+        return self.run(text, self.codecs)
+
+    def run(self, text, codecs):
+        """ Return tuple of smallest compressed text produced by
+        `codecs` and name of the codec ('none' if text is left
+        uncompressed).
+        """
+        compressed = text
+        cfunc = None
+        for func in codecs:
+            t0 = time.clock()
+            c = func(text)
+            self.codec_time[func.__name__] += time.clock() - t0
+            self.codec_bytes[func.__name__] += len(text)
+            if len(c) < len(compressed):
+                compressed = c
+                cfunc = func
+        return compressed, cfunc.__name__ if cfunc else 'none'
+
+    def skip(self, text, codecs):
+        """ Record that `codecs` were not run for `text`. """
+        saved = 0.0
+        for func in codecs:
+            codec_bytes = self.codec_bytes[func.__name__]
+            if codec_bytes:
+                saved += (len(text)*self.codec_time[func.__name__] /
+                          codec_bytes)
+        if saved:
+            with self.saved_time.get_lock():
+                self.saved_time.value += saved
+
+
+class BestCompression(CompressionPolicy):
+    """ Run all compression functions, keep the smallest result. """
+
+
+class FastCompression(CompressionPolicy):
+    """ Compress with zlib only. bz2 is never run, so time saved by
+    not running it is not estimated.
+    """
+
+    name = 'fast'
+
+    def compress(self, text):
+        return self.run(text, (_zlib,))
+
+
+class AutoCompression(CompressionPolicy):
+    """ Do not compress small articles, for others pick compression
+    functions based on how often each one produced the smallest
+    result for articles of similar size (size buckets are powers of
+    two).
+    """
+
+    name = 'auto'
+    min_size = 64
+    #number of articles in a bucket compressed with all functions
+    #before relying on win rates
+    learn_count = 50
+    #run all functions on every n-th article in a bucket
+    relearn_interval = 100
+    #run winning function alone if its win rate is at least this
+    alone_rate = 0.95
+
+    def __init__(self):
+        CompressionPolicy.__init__(self)
+        self.bucket_totals = defaultdict(int)
+        self.bucket_counts = defaultdict(int)
+        self.bucket_ratios = defaultdict(float)
+
+    def learn(self, bucket, text, compressed, codec):
+        self.bucket_totals[bucket] += 1
+        self.bucket_counts[(bucket, codec)] += 1
+        self.bucket_ratios[(bucket, codec)] += len(compressed)/float(len(text))
+
+    def average_ratio(self, bucket, codec):
+        count = self.bucket_counts[(bucket, codec)]
+        return self.bucket_ratios[(bucket, codec)]/count if count else 1.0
+
+    def compress(self, text):
+        size = len(text)
+        if size < self.min_size:
+            self.skip(text, self.codecs)
+            return text, 'none'
+        bucket = int(math.log(size, 2))
+        total = self.bucket_totals[bucket]
+        if total < self.learn_count or total % self.relearn_interval == 0:
+            compressed, codec = self.run(text, self.codecs)
+            self.learn(bucket, text, compressed, codec)
+            return compressed, codec
+
+        ranked = sorted(self.codecs + (None,),
+                        key=lambda func: -self.bucket_counts[
+                            (bucket, func.__name__ if func else 'none')])
+        first = ranked[0]
+        first_name = first.__name__ if first else 'none'
+        if self.bucket_counts[(bucket, first_name)] >= self.alone_rate*total:
+            codecs = (first,) if first else ()
+        else:
+            codecs = tuple(func for func in ranked if func)
+        compressed, codec = self.run(text, codecs[:1])
+        #try others only if first one did worse than they usually do
+        ratio = len(compressed)/float(size)
+        rest = [func for func in codecs[1:]
+                if self.average_ratio(bucket, func.__name__) < ratio]
+        if rest:
+            compressed_rest, codec_rest = self.run(text, rest)
+            if len(compressed_rest) < len(compressed):
+                compressed, codec = compressed_rest, codec_rest
+        self.skip(text, [func for func in self.codecs
+                         if func not in codecs[:1] and func not in rest])
+        self.learn(bucket, text, compressed, codec)
+        return compressed, codec
+
+
+compression_policies = dict((policy.name, policy) for policy in
+                            (BestCompression, FastCompression, AutoCompression))
+
+compression_policy = BestCompression()
+
+def set_compression_policy(name):
+    global compression_policy
+    compression_policy = compression_policies[name]()
+    return compression_policy
+
+def compress_article(text):
+    """ Return tuple of compressed text and name of compression
+    function that produced it ('none' if text is left uncompressed).
+    """
+    return compression_policy.compress(text)
+
 def compress(text):
-    compressed = text
-    cfunc = None
-    for func in (_zlib, _bz2):
-        c = func(text)
-        if len(c) < len(compressed):
-            compressed = c
-            cfunc = func
-    if cfunc:
-        compress_counts[cfunc.__name__] += 1
-    else:
-        compress_counts['none'] += 1
+    compressed, codec = compress_article(text)
+    compress_counts[codec] += 1
     return compressed
 
+def compress_batch(batch):
+    """ Compress list of (title, serialized article, sort key)
+    tuples, computing missing sort keys. Runs in compression worker
+    processes.
+    """
+    result = []
+    for title, serialized_article, sort_key in batch:
+        if sort_key is None:
+            sort_key = sortkey(title)
+        compressed_article, codec = compress_article(serialized_article)
+        result.append((title, compressed_article, codec, sort_key))
+    return result
+
 
 collator = Collator.createInstance(Locale(''))
 collator.setStrength(Collator.QUATERNARY)
 collation_key = collator.getCollationKey
 
+def sortkey(title):
+    return collation_key(title).getByteArray()
+
 
 def make_output_file_name(input_file, options):
     """
@@ -769,6 +2080,35 @@ def make_output_file_name(input_file, options):
         output_file += '.aar'
     return output_file
 
+def make_sorted_shard_file_name(input_file, options):
+    """
+    Return sorted shard file name based on input file name and
+    range of converted articles.
+
+    >>> from minimock import Mock
+    >>> opts = Mock('options')
+    >>> opts.output_file = None
+    >>> opts.start = 0
+    >>> opts.end = 1000
+    >>> make_sorted_shard_file_name('abc.cdb', opts)
+    'abc.0-1000.shard'
+
+    >>> opts.start = 1000
+    >>> opts.end = None
+    >>> make_sorted_shard_file_name('abc.cdb', opts)
+    'abc.1000-end.shard'
+
+    >>> opts.output_file = 'abc'
+    >>> make_sorted_shard_file_name('abc.cdb', opts)
+    'abc'
+
+    """
+    if options.output_file:
+        return options.output_file
+    end = 'end' if options.end is None else options.end
+    return '%s.%s-%s.shard' % (strip_ext(input_file.rstrip(os.path.sep)),
+                               options.start, end)
+
 def strip_ext(fname):
     """
     Return file name with one or two extension stripped
@@ -805,7 +2145,7 @@ def parse_size(s):
     if s.endswith('M'):
         return int(s.strip('M'))*1024*1024
     elif s.endswith('G'):
-        return int(s.strip('G'))**1024*1024*1024
+        return int(s.strip('G'))*1024*1024*1024
     elif s.endswith('K'):
         return int(s.strip('K'))*1024
     elif s.endswith('m'):
@@ -875,22 +2215,32 @@ writeln = display.writeln
 def print_legend():
     (display
     .bold('t').writeln(' - time elapsed')
+    .bold('eta').writeln(' - estimated time remaining')
     .bold('avg').writeln(' - average number of articles processed per second')
     .ok('a').writeln(' - number of processed articles')
     .ok('r').writeln(' - number of processed redirects')
     .warn('s').writeln(' - number of skipped articles')
     .warn('e').writeln(' - number of articles with no text (empty)')
-    .fail('to').writeln(' - approximate number of articles that couldn\'t be converted fast enough (timed out)')
+    .fail('to').writeln(' - number of articles that couldn\'t be converted fast enough (timed out)')
     .fail('f').writeln(' - number of articles that couldn\'t be converted (failed)'))
 
 
 def print_progress(stats):
     try:
-        progress = '%.2f' % (100*float(stats.processed)/stats.total) if stats.total else '?'
+        if stats.total:
+            progress = 100*float(stats.processed)/stats.total
+            if stats.estimated:
+                progress = '~%.2f' % min(progress, 99.99)
+            else:
+                progress = '%.2f' % progress
+        else:
+            progress = '?'
+        eta = stats.eta
         (display
          .erase_line()
          .bold('%s%% ' % progress)
          .bold('t: %s ' % stats.elapsed)
+         .bold('eta: %s ' % (eta if eta is not None else '?'))
          .bold('avg: %.1f/s ' % stats.average)
          .ok('a: %d r: %d ' % (stats.articles, stats.redirects))
          .warn('s: %d ' % stats.skipped)
@@ -902,6 +2252,47 @@ def print_progress(stats):
         display.reset_att()
 
 
+TOTAL_FILE_EXT = '.aarcount'
+
+def total_file_name(input_file_name):
+    return input_file_name.rstrip(os.sep) + TOTAL_FILE_EXT
+
+def total_key(input_file_name, options):
+    """ Return identity of input and options that affect number of
+    articles, saved with article count.
+    """
+    st = os.stat(input_file_name)
+    return dict(size=st.st_size, mtime=st.st_mtime,
+                start=options.start, end=options.end,
+                article_count=options.article_count)
+
+def read_total(input_file_name, options):
+    """ Return article count saved next to input file, or None if
+    there is no saved count or it was saved for different input or
+    options.
+    """
+    if input_file_name == '-':
+        return None
+    try:
+        with open(total_file_name(input_file_name)) as f:
+            saved = json.load(f)
+        if saved['key'] == total_key(input_file_name, options):
+            return saved['total']
+    except (IOError, ValueError, KeyError), e:
+        log.debug('No saved article count for %s (%s)', input_file_name, e)
+    return None
+
+def save_total(input_file_name, options, total):
+    if input_file_name == '-':
+        return
+    try:
+        with open(total_file_name(input_file_name), 'w') as f:
+            json.dump(dict(key=total_key(input_file_name, options),
+                           total=total), f)
+    except IOError, e:
+        log.warn('Failed to save article count for %s: %s',
+                 input_file_name, e)
+
 def guess_version(input_file_name):
     """ Guess dictionary version from input file name.
 
@@ -961,10 +2352,27 @@ def main():
     opt_parser = make_opt_parser()
     options, args = opt_parser.parse_args()
 
+    resume = None
+    if options.resume:
+        session_dir = options.resume
+        resume = read_checkpoint(session_dir)
+        if resume is None:
+            sys.stderr.write('No checkpoint found in %s, '
+                             'can\'t resume\n' % session_dir)
+            raise SystemExit(1)
+        if resume['phase'] == 'done':
+            sys.stderr.write('Compilation in %s is already '
+                             'finished\n' % session_dir)
+            raise SystemExit(1)
+        options, args = read_args(session_dir)
+
     if not args:
         opt_parser.print_help()
         raise SystemExit(1)
 
+    if not resume:
+        args = absolute_paths(options, args)
+
     if len(args) < 2:
         sys.stderr.write('Not enough parameters\n')
         opt_parser.print_help()
@@ -987,16 +2395,21 @@ def main():
             sys.stderr.write('No such file: %s\n' % input_file)
             raise SystemExit(1)
 
-    session_dir = os.path.join(options.work_dir,
-                               'aardc-'+('%.2f' % time.time()).replace('.','-'))
-
-    if os.path.exists(session_dir):
-        sys.stderr.write('Session directory %s already'
-                         ' exists, can\'t proceed\n' % session_dir)
-        raise SystemExit(1)
+    if resume:
+        display.write('Resuming compilation in ').bold(session_dir).writeln()
     else:
-        os.mkdir(session_dir)
-        display.write('Session dir ').bold(session_dir).writeln()
+        session_dir = os.path.join(options.work_dir,
+                                   'aardc-'+('%.2f' % time.time()).replace('.','-'))
+
+        if os.path.exists(session_dir):
+            sys.stderr.write('Session directory %s already'
+                             ' exists, can\'t proceed\n' % session_dir)
+            raise SystemExit(1)
+        else:
+            os.mkdir(session_dir)
+            display.write('Session dir ').bold(session_dir).writeln()
+        #options and arguments are used again when compilation is resumed
+        write_args(session_dir, options, args)
 
 
     try:
@@ -1006,7 +2419,10 @@ def main():
         opt_parser.print_help()
         raise SystemExit(1)
 
-    output_file_name = make_output_file_name(input_files[0], options)
+    if options.sorted_shard:
+        output_file_name = make_sorted_shard_file_name(input_files[0], options)
+    else:
+        output_file_name = make_output_file_name(input_files[0], options)
 
     if options.quite:
         log_level = logging.ERROR
@@ -1072,26 +2488,82 @@ def main():
     log.debug('Metadata: %s', metadata)
 
 
+    max_sort_memory = parse_size(options.sort_memory)
+    if max_sort_memory:
+        log.info('Maximum memory for sorting is %d bytes', max_sort_memory)
+    else:
+        max_sort_memory = None
+        log.info('Sorting in memory')
+
+    policy = set_compression_policy(options.compression_policy)
+    log.info('Compression policy: %s', policy.name)
+
+    if options.nomp:
+        compress_processes = 0
+    else:
+        compress_processes = options.processes or multiprocessing.cpu_count()
+
+    if options.parallel_volumes and not options.nomp:
+        volume_processes = options.processes or multiprocessing.cpu_count()
+    else:
+        volume_processes = None
+
     compiler = Compiler(output_file_name, max_volume_size,
-                        session_dir, metadata)
+                        session_dir, metadata, max_sort_memory,
+                        compress_processes, volume_processes,
+                        options.checkpoint_interval, resume)
 
 
     t0 = time.time()
     display.write('Converting ').bold(', '.join(input_files)).writeln()
 
-    if hasattr(converter, 'total'):
-        display.write('Calculating total number of articles...').cr().flush()
-        for input_file in input_files:
-            compiler.stats.total += converter.total(converter.make_input(input_file), options)
-    display.erase_line().writeln('total: %d' % compiler.stats.total)
+    #only converter is run again when resuming collection
+    collect = not resume or resume['phase'] == 'collect'
+
+    for input_file in (input_files if collect else ()):
+        total = read_total(input_file, options)
+        if total is not None:
+            log.info('Using article count %d saved for %s', total, input_file)
+        elif options.count_total and hasattr(converter, 'total'):
+            display.write('Calculating total number of articles...').cr().flush()
+            total = converter.total(converter.make_input(input_file), options)
+            save_total(input_file, options, total)
+        elif hasattr(converter, 'estimate'):
+            display.write('Estimating total number of articles...').cr().flush()
+            total = converter.estimate(converter.make_input(input_file), options)
+            compiler.stats.estimated = True
+        if total is None:
+            compiler.stats.total = 0
+            break
+        compiler.stats.total += total
+    if not collect:
+        compiler.stats.total = compiler.stats.processed
+    if compiler.stats.total:
+        display.erase_line().writeln('total: %s%d' % ('~' if compiler.stats.estimated
+                                                     else '', compiler.stats.total))
+    else:
+        display.erase_line().writeln('total: unknown')
 
     if options.show_legend:
         print_legend()
 
-    for input_file in input_files:
-        log.info('Collecting articles in %s', input_file)
-        converter.collect_articles(converter.make_input(input_file), options, compiler)
-    compiler.compile()
+    if collect and hasattr(converter, 'collect_all_articles'):
+        #converter reads all input files at once
+        log.info('Collecting articles in %s', ', '.join(input_files))
+        converter.collect_all_articles([converter.make_input(input_file)
+                                        for input_file in input_files],
+                                       options, compiler)
+    else:
+        for input_file in (input_files if collect else ()):
+            log.info('Collecting articles in %s', input_file)
+            processed = compiler.stats.processed
+            converter.collect_articles(converter.make_input(input_file), options, compiler)
+            if not resume:
+                save_total(input_file, options, compiler.stats.processed - processed)
+    if options.sorted_shard:
+        compiler.write_sorted_shard()
+    else:
+        compiler.compile()
     if options.remove_session_dir:
         writeln('Removing session dir')
         shutil.rmtree(session_dir)
@@ -1099,6 +2571,28 @@ def main():
     log.info('Compression: %s',
              ', '.join('%s - %d' % item
                       for item in compress_counts.iteritems()))
+    if policy.saved_time.value:
+        m = ('Compression policy %s saved approximately %.1f seconds '
+             'of CPU time' % (policy.name, policy.saved_time.value))
+        log.info(m)
+        writeln(m)
+    stats = compiler.stats
+    if stats.cache_hits or stats.cache_misses:
+        writeln('Article cache: %d hits, %d misses' % (stats.cache_hits,
+                                                      stats.cache_misses))
+    template_lookups = stats.template_hits + stats.template_misses
+    if template_lookups:
+        m = ('Template cache: %d hits, %d misses (%.1f%% hit rate)' %
+             (stats.template_hits, stats.template_misses,
+              100.0*stats.template_hits/template_lookups))
+        log.info(m)
+        writeln(m)
+    if stats.memo_hits or stats.memo_misses:
+        m = ('Template memo: %d hits, %d misses, saved approximately '
+             '%.1f seconds' % (stats.memo_hits, stats.memo_misses,
+                               stats.memo_saved_time))
+        log.info(m)
+        writeln(m)
     log.info('Compilation took %s', timedelta(seconds=time.time() - t0))
     writeln('Compilation took %s' % timedelta(seconds=int(time.time() - t0)))
 
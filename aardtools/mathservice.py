@@ -0,0 +1,280 @@
+# This file is part of Aard Dictionary Tools <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2008-2009  Igor Tkach
+
+""" Math rendering service: process with its own pool of worker
+processes that render math for article worker processes. Article
+worker submits all equations of an article before writing it (see
+`MathClient`) and collects rendered images when it's done, so math is
+rendered while article is being written and slow equations don't take
+up article conversion time. Equations are found in parsed article, so
+rendering doesn't overlap with parsing.
+"""
+
+from __future__ import with_statement
+import itertools
+import logging
+import multiprocessing
+import threading
+import Queue
+import time
+from collections import deque
+from multiprocessing.connection import Listener, Client, arbitrary_address
+
+import mwaardhtmlwriter as writer
+import tex
+from cache import MathCache
+
+log = logging.getLogger(__name__)
+
+#first message sent to service by each connection
+CLIENT = 'client'
+STOP = 'stop'
+#requests sent by clients
+RENDER = 'render'
+CANCEL = 'cancel'
+
+
+def _init_renderer(cache_dir, timeout):
+    if cache_dir:
+        writer.math_cache = MathCache(cache_dir)
+    tex.timeout = timeout
+
+def _render(equations, title):
+    try:
+        return writer.render_math(equations, title)
+    except Exception:
+        #dispatcher needs a reply to know renderer is free
+        log.exception('Failed to render math in %r', title)
+        return {}
+
+
+def serve(address, ready, processes, cache_dir, timeout):
+    listener = Listener(address, 'AF_UNIX', backlog=64)
+    pool = multiprocessing.Pool(processes, initializer=_init_renderer,
+                                initargs=[cache_dir, timeout])
+    dispatcher = Dispatcher(pool, processes)
+    ready.set()
+    try:
+        while True:
+            conn = listener.accept()
+            if conn.recv() == STOP:
+                conn.close()
+                break
+            thread = threading.Thread(target=Handler(conn, dispatcher).run)
+            thread.daemon = True
+            thread.start()
+    finally:
+        listener.close()
+        pool.terminate()
+        pool.join()
+
+
+class Dispatcher(object):
+    """ Gives render requests to renderer `pool` no faster than its
+    `processes` take them, so that requests cancelled while waiting
+    for a renderer are dropped instead of rendered.
+    """
+
+    def __init__(self, pool, processes):
+        self.pool = pool
+        self.free = processes
+        self.pending = deque()
+        self.cond = threading.Condition()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, request):
+        """ Queue `request`, list of equations, title and function
+        that sends rendered images to client.
+        """
+        with self.cond:
+            self.pending.append(request)
+            self.cond.notify()
+
+    def cancel(self, request):
+        with self.cond:
+            for i, pending in enumerate(self.pending):
+                if pending is request:
+                    del self.pending[i]
+                    log.debug('Cancelled math request for %r', request[1])
+                    break
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not (self.pending and self.free):
+                    self.cond.wait()
+                equations, title, send = self.pending.popleft()
+                self.free -= 1
+            self.pool.apply_async(_render, (equations, title),
+                                  callback=self.done(send))
+
+    def done(self, send):
+        #runs in pool's result handler thread, `send` must not block
+        def callback(images):
+            with self.cond:
+                self.free += 1
+                self.cond.notify()
+            send(images)
+        return callback
+
+
+class Handler(object):
+    """ Receive requests from client connection `conn`: (`RENDER`,
+    request id, equations, title) and (`CANCEL`, request id), and send
+    back (request id, images) replies as soon as equations are
+    rendered (see `writer.render_math`). Client only waits for its
+    last request, so requests submitted before it are cancelled and
+    their images are not sent. Replies are sent by connection's own
+    thread, pool's result handler only queues them.
+    """
+
+    def __init__(self, conn, dispatcher):
+        self.conn = conn
+        self.dispatcher = dispatcher
+        self.lock = threading.Lock()
+        #(request id, request) client waits for
+        self.current = None
+        self.replies = Queue.Queue()
+
+    def reply(self, request_id):
+        def send(images):
+            with self.lock:
+                if self.current is None or self.current[0] != request_id:
+                    log.debug('Dropped images for math request %d',
+                              request_id)
+                    return
+                self.current = None
+            self.replies.put((request_id, images))
+        return send
+
+    def cancel(self):
+        with self.lock:
+            current, self.current = self.current, None
+        if current is not None:
+            self.dispatcher.cancel(current[1])
+
+    def send_replies(self):
+        while True:
+            reply = self.replies.get()
+            if reply is None:
+                break
+            try:
+                self.conn.send(reply)
+            except Exception:
+                #client is gone
+                pass
+
+    def run(self):
+        sender = threading.Thread(target=self.send_replies)
+        sender.daemon = True
+        sender.start()
+        try:
+            while True:
+                message = self.conn.recv()
+                #both new request and cancel request mean that client
+                #doesn't wait for its last request anymore
+                self.cancel()
+                if message[0] == RENDER:
+                    _, request_id, equations, title = message
+                    request = (equations, title, self.reply(request_id))
+                    with self.lock:
+                        self.current = (request_id, request)
+                    self.dispatcher.submit(request)
+        except (EOFError, IOError):
+            self.cancel()
+        finally:
+            self.replies.put(None)
+
+
+class MathService(object):
+    """ Math rendering service with `processes` renderer
+    processes. Renderer command is killed if it takes more than
+    `timeout` seconds per equation (see `tex.timeout`).
+    """
+
+    def __init__(self, processes, cache_dir=None, timeout=None):
+        self.address = arbitrary_address('AF_UNIX')
+        ready = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=serve,
+                                               args=(self.address, ready,
+                                                     processes, cache_dir,
+                                                     timeout),
+                                               name='MathService')
+        self.process.start()
+        ready.wait()
+        log.info('Started math rendering service with %d processes',
+                 processes)
+
+    def stop(self):
+        conn = Client(self.address, 'AF_UNIX')
+        conn.send(STOP)
+        conn.close()
+        self.process.join()
+        log.info('Stopped math rendering service')
+
+
+class MathClient(object):
+    """ Connection to math rendering service at `address`. Waits for
+    rendered images at most `wait` seconds per equation since they
+    were submitted, but not past `deadline` (time in seconds since
+    the epoch) if it is set.
+    """
+
+    def __init__(self, address, wait):
+        self.conn = Client(address, 'AF_UNIX')
+        self.conn.send(CLIENT)
+        self.wait = wait
+        self.deadline = None
+        self.request_ids = itertools.count()
+        self.request_id = None
+        self.submit_time = None
+        self.count = 0
+
+    def submit(self, equations, title):
+        self.request_id = next(self.request_ids)
+        self.submit_time = time.time()
+        self.count = len(equations)
+        self.conn.send((RENDER, self.request_id, equations, title))
+
+    def cancel(self):
+        """ Tell service that images for equations submitted last are
+        not needed.
+        """
+        if self.request_id is not None:
+            self.conn.send((CANCEL, self.request_id))
+            self.request_id = None
+
+    def result(self):
+        """ Return images for equations submitted last (see
+        `writer.render_math`) or None if they were not rendered in
+        time.
+        """
+        deadline = self.submit_time + self.wait*self.count
+        if self.deadline:
+            deadline = min(deadline, self.deadline)
+        while True:
+            wait = deadline - time.time()
+            if wait <= 0 or not self.conn.poll(wait):
+                log.warn('Math for request %d (%d equations) was not '
+                         'rendered in %.1fs', self.request_id, self.count,
+                         time.time() - self.submit_time)
+                self.cancel()
+                return None
+            request_id, images = self.conn.recv()
+            #replies to requests that were not waited for are dropped
+            if request_id == self.request_id:
+                self.request_id = None
+                return images
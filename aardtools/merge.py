@@ -0,0 +1,35 @@
+# This file is part of Aard Dictionary Tools <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2008-2009  Igor Tkach
+
+""" Combine sorted shard files written by compilations with
+--sorted-shard into one dictionary.
+"""
+
+from __future__ import with_statement
+
+from compiler import read_sorted_shard_header
+
+def total(input_file, options):
+    with open(input_file, 'rb') as f:
+        header = read_sorted_shard_header(f)
+    return header['articles'] + header['redirects']
+
+#article count is read from shard header
+estimate = total
+
+def collect_all_articles(input_files, options, compiler):
+    compiler.merge_sorted_shards(input_files)
+
+def make_input(input_file_name):
+    return input_file_name
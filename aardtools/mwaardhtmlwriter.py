@@ -1,3 +1,4 @@
+import copy
 import logging
 import xml.etree.ElementTree as ET
 
@@ -6,9 +7,11 @@ from collections import defaultdict
 from mwlib.xhtmlwriter import MWXHTMLWriter, SkipChildren
 from mwlib import xmltreecleaner
 from mwlib.advtree import Reference
+from mwlib.parser import Math
 xmltreecleaner.childlessOK.append(Reference)
 
 import tex
+from texmathml import tomathml, UnsupportedTeX
 
 EXCLUDE_CLASSES = frozenset(('navbox', 'collapsible', 'autocollapse',
                              'plainlinksneverexpand', 'navbar', 'metadata',
@@ -35,6 +38,63 @@ log = logging.getLogger(__name__)
 #doesn't looks as good as latex or blahtex
 mathcmds = ('latex', 'blahtex', 'texvc')
 
+#cache.MathCache with rendered math images, if set
+math_cache = None
+#mathservice.MathClient, if set math is rendered by math rendering
+#service while article is being written
+math_service = None
+#'mathml' to convert math to MathML (see texmathml), only math that
+#can't be converted is rendered as image
+math_format = 'png'
+
+def render_math(equations, title):
+    """ Render `equations` trying math renderers in turn and return
+    dictionary mapping each equation to base64 encoded PNG image, or
+    to None if none of the renderers could render it. Each renderer
+    gets all equations it has to render at once (see `tex.toimgs`).
+    """
+    images = {}
+    pending = sorted(set(equations))
+    for cmd in mathcmds:
+        if not pending:
+            break
+        keys = {}
+        equations = []
+        for equation in pending:
+            if math_cache:
+                keys[equation] = math_cache.key(cmd, equation)
+                imgdata = math_cache.get(keys[equation])
+                if imgdata:
+                    images[equation] = imgdata
+                    continue
+                if imgdata == '':
+                    log.debug('Skipping %r for math %r, it failed before',
+                              cmd, equation)
+                    continue
+            equations.append(equation)
+        results = tex.toimgs(equations, cmd) if equations else []
+        for equation, result in zip(equations, results):
+            if isinstance(result, tex.MathRenderingFailed):
+                log.warn('Could not render math in %r with %r: %s',
+                         title, cmd, result)
+                if math_cache:
+                    math_cache.add(keys[equation], '')
+            elif isinstance(result, Exception):
+                #not cached, failure may have nothing to do with
+                #equation (renderer is not installed, for example)
+                log.warn('Could not render math in %r with %r: %r',
+                         title, cmd, result)
+            else:
+                images[equation] = result
+                if math_cache:
+                    math_cache.add(keys[equation], result)
+        pending = [equation for equation in pending
+                   if equation not in images]
+    for equation in pending:
+        log.error('Failed to render math %r in %r', equation, title)
+        images[equation] = None
+    return images
+
 class XHTMLWriter(MWXHTMLWriter):
 
     paratag = 'p'
@@ -46,6 +106,28 @@ class XHTMLWriter(MWXHTMLWriter):
         #also keep named reference positions, separate for each group
         #map named reference to 2-tuple of position first seen and count
         self.namedrefs = defaultdict(dict)
+        #rendered math images, see render_math
+        self.math_images = {}
+        #(element, equation) pairs for math rendered by math service
+        self.deferred_math = None
+        #False if some math is written as text
+        self.math_complete = True
+        #MathML elements for equations, None if equation can't be
+        #converted to MathML
+        self.mathml = {}
+        #equations with MathML element already in the article
+        self.mathml_written = set()
+
+    def convert_mathml(self, equation):
+        """ Return MathML element for `equation` or None if it can't
+        be converted, each equation is converted once.
+        """
+        if equation not in self.mathml:
+            try:
+                self.mathml[equation] = tomathml(equation)
+            except UnsupportedTeX:
+                self.mathml[equation] = None
+        return self.mathml[equation]
 
     def xwriteArticle(self, a):
         e = ET.Element("div")
@@ -85,25 +167,29 @@ class XHTMLWriter(MWXHTMLWriter):
         return s
 
     def xwriteMath(self, obj):
-        for cmd in mathcmds:
-            try:
-                imgurl = 'data:image/png;base64,' + tex.toimg(obj.caption, cmd)
-            except tex.MathRenderingFailed, e:
-                log.warn('Could not render math in %r with %r: %s',
-                         obj.getParents()[0].caption, cmd, e)
-            except:
-                log.warn('Could not render math in %r with %r',
-                         obj.getParents()[0].caption, cmd, exc_info=1)
-            else:
-                s = ET.Element("img")
-                s.set("src", imgurl)
-                s.set("class", "tex")
-                return s
-        log.error('Failed to render math %r in %r',
-                  obj.caption, obj.getParents()[0].caption)
+        if math_format == 'mathml':
+            element = self.convert_mathml(obj.caption)
+            if element is not None:
+                if obj.caption in self.mathml_written:
+                    #same equation appears more than once
+                    return copy.deepcopy(element)
+                self.mathml_written.add(obj.caption)
+                return element
         s = ET.Element("span")
         s.text = obj.caption
         s.set("class", "tex")
+        if self.deferred_math is not None:
+            #replaced with image when (and if) it is rendered
+            self.deferred_math.append((s, obj.caption))
+            return s
+        if obj.caption not in self.math_images:
+            self.math_images.update(render_math([obj.caption],
+                                                obj.getParents()[0].caption))
+        imgdata = self.math_images[obj.caption]
+        if imgdata:
+            set_math_image(s, imgdata)
+        else:
+            self.math_complete = False
         return s
 
     def xwriteURL(self, obj):
@@ -343,6 +429,12 @@ class XHTMLWriter(MWXHTMLWriter):
         return e
 
 
+def set_math_image(element, imgdata):
+    element.tag = "img"
+    element.text = None
+    element.set("src", 'data:image/png;base64,' + imgdata)
+
+
 def remove_childless_elements(element, parent=None):
     """
     Remove elements that are supposed to have children but are empty
@@ -358,8 +450,33 @@ def remove_childless_elements(element, parent=None):
 
 
 def convert(obj, rtl=False):
+    """ Return (text, tags, language links, math complete) tuple for
+    parsed article `obj`, math complete is False if some math is
+    written as text because it was not rendered.
+    """
     w = XHTMLWriter()
+    #all math in article is rendered at once
+    equations = [math.caption for math in obj.find(Math)]
+    if math_format == 'mathml':
+        equations = [equation for equation in equations
+                     if w.convert_mathml(equation) is None]
+    if equations and math_service:
+        math_service.submit(equations, obj.caption)
+        w.deferred_math = []
+    else:
+        w.math_images = render_math(equations, obj.caption)
     e = w.write(obj)
+    if w.deferred_math:
+        images = math_service.result() or {}
+        for element, equation in w.deferred_math:
+            imgdata = images.get(equation)
+            if imgdata:
+                set_math_image(element, imgdata)
+            else:
+                w.math_complete = False
+    elif w.deferred_math is not None:
+        #math was in elements that are not written
+        math_service.cancel()
     remove_childless_elements(e)
     if rtl:
         e.set("dir", "rtl")
@@ -369,4 +486,4 @@ def convert(obj, rtl=False):
         languagelinks = []
     w.languagelinks = []
     text = ET.tostring(e, encoding='utf-8')
-    return text, [], languagelinks
+    return text, [], languagelinks, w.math_complete
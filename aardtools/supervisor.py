@@ -0,0 +1,358 @@
+# This file is part of Aard Dictionary Tools <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2008-2009  Igor Tkach
+
+""" Pool of worker processes that tracks which task each worker is
+running. Worker that doesn't finish its task in time is killed and
+replaced, other workers keep running.
+"""
+
+import os
+import time
+import select
+import signal
+import logging
+import multiprocessing
+from collections import deque
+from itertools import islice
+
+log = logging.getLogger(__name__)
+
+
+class TaskError(Exception):
+
+    def __init__(self, task):
+        Exception.__init__(self, task)
+        self.task = task
+
+
+class TaskTimedOut(TaskError): pass
+
+
+class WorkerDied(TaskError): pass
+
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def rss():
+    """ Return resident set size of current process in bytes. """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*PAGE_SIZE
+    except (IOError, IndexError, ValueError):
+        import resource
+        #peak resident set size (in kilobytes on Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def _worker_main(conn, state, func, initializer, initargs,
+                 max_rss, address_space, batch_done):
+    #parent handles keyboard interrupt and stops workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if address_space:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (address_space, address_space))
+    if initializer:
+        initializer(*initargs)
+    conn.send(('ready', None, False, None))
+    while True:
+        try:
+            batch = conn.recv()
+        except EOFError:
+            break
+        if batch is None:
+            break
+        results = []
+        retire = False
+        for i, task in enumerate(batch):
+            #parent reads index and start time of current task
+            #to detect timeouts
+            state[0] = i
+            state[1] = time.time()
+            try:
+                result = func(task)
+            except MemoryError, e:
+                results.append((task, None, e))
+                retire = True
+                break
+            except Exception, e:
+                results.append((task, None, e))
+            else:
+                results.append((task, result, None))
+        #memory is returned to the system when process exits,
+        #parent starts new worker
+        retire = retire or bool(max_rss and rss() > max_rss)
+        info = batch_done() if batch_done else None
+        conn.send(('done', results, retire, info))
+        if retire:
+            break
+    conn.close()
+
+
+class Worker(object):
+
+    number = 0
+
+    def __init__(self, func, initializer=None, initargs=(),
+                 max_rss=None, address_space=None, batch_done=None):
+        Worker.number += 1
+        self.name = 'worker-%d' % Worker.number
+        self.conn, child_conn = multiprocessing.Pipe()
+        #index of current task in batch and its start time
+        self.state = multiprocessing.RawArray('d', 2)
+        self.process = multiprocessing.Process(target=_worker_main,
+                                               name=self.name,
+                                               args=(child_conn, self.state,
+                                                     func, initializer,
+                                                     initargs, max_rss,
+                                                     address_space,
+                                                     batch_done))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.batch = None
+        self.batch_start = None
+        self.task_count = 0
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def send(self, batch):
+        self.batch = batch
+        self.batch_start = time.time()
+        self.state[0] = 0
+        self.state[1] = self.batch_start
+        self.task_count += len(batch)
+        self.conn.send(batch)
+
+    def recv(self):
+        message = self.conn.recv()
+        self.batch = None
+        self.batch_start = None
+        return message
+
+    busy = property(lambda self: self.batch_start is not None)
+
+    idle = property(lambda self: self.ready and not self.busy)
+
+    @property
+    def task_start(self):
+        return self.state[1]
+
+    @property
+    def current(self):
+        """ Split batch into task being run, tasks before it and
+        tasks after it.
+        """
+        i = int(self.state[0])
+        return self.batch[i], self.batch[:i], self.batch[i+1:]
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except IOError:
+            pass
+        self.process.join()
+        self.conn.close()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+class SupervisedPool(object):
+    """ Pool of worker processes running `func`. Each worker is given
+    one batch of tasks at a time. If worker doesn't finish a task
+    within `timeout` seconds it is killed and a new worker is started,
+    so tasks given to other workers are not lost, and other tasks from
+    the batch are given to workers again. Workers are replaced after
+    `max_tasks` tasks (if specified). Worker retires and is replaced
+    when its resident set size exceeds `max_rss` bytes after a batch
+    or when task runs out of memory. If `address_space` is specified
+    workers' address space is limited to this many bytes.
+
+    If `batch_time` is specified batch size is chosen so that a batch
+    takes about this many seconds given average time per task measured
+    so far (but no more than `max_batch_size` tasks), otherwise tasks
+    are given to workers one by one.
+
+    If `batch_done` is specified it is called in worker process after
+    each batch, value it returns is passed to `on_batch_done` in
+    parent process before batch results are produced.
+
+    If `slot_initargs` is specified it is called with worker's slot
+    number (from 0 to `processes` - 1, worker that replaces another
+    one gets the same slot) when worker is started, `initializer` gets
+    arguments it returns after `initargs`.
+    """
+
+    def __init__(self, func, processes=None, initializer=None, initargs=(),
+                 timeout=None, max_tasks=None, max_rss=None,
+                 address_space=None, batch_time=None, max_batch_size=256,
+                 batch_done=None, on_batch_done=None, slot_initargs=None):
+        self.func = func
+        self.processes = processes or multiprocessing.cpu_count()
+        self.initializer = initializer
+        self.initargs = initargs
+        self.timeout = timeout
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.address_space = address_space
+        self.batch_time = batch_time
+        self.max_batch_size = max_batch_size
+        self.batch_done = batch_done
+        self.on_batch_done = on_batch_done
+        self.slot_initargs = slot_initargs
+        self.task_time = None
+        self.retired_count = 0
+        self.workers = [self.new_worker(i) for i in range(self.processes)]
+        log.info('Started %d worker processes', self.processes)
+
+    def new_worker(self, slot):
+        initargs = list(self.initargs)
+        if self.slot_initargs:
+            initargs.extend(self.slot_initargs(slot))
+        return Worker(self.func, self.initializer, initargs,
+                      self.max_rss, self.address_space, self.batch_done)
+
+    def replace(self, worker, kill=False):
+        #worker is stopped before new one is started, so they never
+        #use slot's resources at the same time
+        if kill:
+            worker.kill()
+        else:
+            worker.stop()
+        slot = self.workers.index(worker)
+        self.workers[slot] = self.new_worker(slot)
+
+    def batch_size(self):
+        if not self.batch_time or self.task_time is None:
+            return 1
+        if not self.task_time:
+            return self.max_batch_size
+        return max(1, min(self.max_batch_size,
+                          int(self.batch_time/self.task_time)))
+
+    def update_task_time(self, batch_len, elapsed):
+        task_time = elapsed/batch_len
+        if self.task_time is None:
+            self.task_time = task_time
+        else:
+            #exponential moving average, recent batches matter most
+            self.task_time = 0.8*self.task_time + 0.2*task_time
+
+    def imap_unordered(self, tasks):
+        """ Run tasks and return generator that produces (task,
+        result, error) tuples as workers finish tasks. Error is
+        exception raised by `func`, `TaskTimedOut` or `WorkerDied`,
+        result is None if there was an error.
+        """
+        tasks = iter(tasks)
+        #tasks from batches that were not finished
+        retry = deque()
+        exhausted = False
+        while True:
+            for worker in self.workers:
+                if not worker.idle:
+                    continue
+                batch = []
+                batch_size = self.batch_size()
+                while retry and len(batch) < batch_size:
+                    batch.append(retry.popleft())
+                if not exhausted:
+                    batch.extend(islice(tasks, batch_size - len(batch)))
+                    if len(batch) < batch_size:
+                        exhausted = True
+                if not batch:
+                    break
+                worker.send(batch)
+            busy = [worker for worker in self.workers if worker.busy]
+            if not busy and exhausted and not retry:
+                break
+            #task time is counted after worker is initialized
+            starting = [worker for worker in self.workers if not worker.ready]
+            if self.timeout and busy:
+                next_deadline = min(worker.task_start
+                                    for worker in busy) + self.timeout
+                wait = max(next_deadline - time.time(), 0)
+            else:
+                wait = None
+            ready, _, _ = select.select(busy + starting, [], [], wait)
+            #consumer may keep generator suspended for a long time while
+            #results are produced, timeouts are checked as of select
+            #time so that worker that finished meanwhile is not killed
+            now = time.time()
+            for worker in ready:
+                batch, batch_start = worker.batch, worker.batch_start
+                if worker.busy:
+                    task, done, rest = worker.current
+                try:
+                    status, results, retire, info = worker.recv()
+                except (EOFError, IOError):
+                    if not worker.ready:
+                        raise WorkerDied('%s failed to start' % worker.name)
+                    log.error('%s (pid %s) died while running %r',
+                              worker.name, worker.process.pid, task)
+                    self.replace(worker, kill=True)
+                    retry.extend(done + rest)
+                    yield task, None, WorkerDied(task)
+                    continue
+                if status == 'ready':
+                    worker.ready = True
+                    continue
+                self.update_task_time(len(results),
+                                      time.time() - batch_start)
+                if self.on_batch_done:
+                    self.on_batch_done(info)
+                if retire:
+                    log.info('%s (pid %s) retired after %d tasks, '
+                             'memory limit reached', worker.name,
+                             worker.process.pid, worker.task_count)
+                    self.retired_count += 1
+                    self.replace(worker)
+                elif (self.max_tasks and
+                      worker.task_count >= self.max_tasks):
+                    log.debug('Replacing %s after %d tasks',
+                              worker.name, worker.task_count)
+                    self.replace(worker)
+                #tasks not run if worker stopped early (out of memory)
+                retry.extend(batch[len(results):])
+                for result in results:
+                    yield result
+            if self.timeout:
+                for worker in self.workers:
+                    if (worker.busy and worker not in ready and
+                        now - worker.task_start > self.timeout):
+                        task, done, rest = worker.current
+                        log.warn('%s (pid %s) timed out running %r, '
+                                 'replacing it', worker.name,
+                                 worker.process.pid, task)
+                        self.replace(worker, kill=True)
+                        #results of tasks done before are lost with
+                        #the worker, so they need to run again
+                        retry.extend(done + rest)
+                        yield task, None, TaskTimedOut(task)
+
+    def close(self):
+        for worker in self.workers:
+            if worker.busy:
+                worker.kill()
+            else:
+                worker.stop()
+        self.workers = []
+
+    def terminate(self):
+        for worker in self.workers:
+            worker.kill()
+        self.workers = []
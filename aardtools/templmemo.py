@@ -0,0 +1,150 @@
+# This file is part of Aard Dictionary Tools <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2008-2009  Igor Tkach
+
+""" Memoization of template expansion results. Template invocations
+with the same name and the same (expanded) arguments are expanded
+once, subsequent invocations reuse the result. Result is only reused
+if expansion was pure: it didn't use magic words or parser functions
+whose result depends on the page being expanded or on current time and
+didn't add tags to article's uniquifier.
+"""
+
+import time
+
+from mwlib import lrucache
+from mwlib.templ import nodes, magics, magic_nodes, evaluate
+
+#magic words that depend on the page being expanded or on current time
+IMPURE_MAGIC = frozenset(
+    [name for cls in (magics.TimeMagic, magics.LocaltimeMagic)
+     for name in dir(cls) if name.isupper()] +
+    ['PAGENAME', 'PAGENAMEE', 'FULLPAGENAME', 'FULLPAGENAMEE',
+     'SUBPAGENAME', 'SUBPAGENAMEE', 'BASEPAGENAME', 'BASEPAGENAMEE',
+     'NAMESPACE', 'NAMESPACEE', 'TALKPAGENAME', 'TALKPAGENAMEE',
+     'SUBJECTPAGENAME', 'SUBJECTPAGENAMEE', 'TALKSPACE', 'TALKSPACEE',
+     'SUBJECTSPACE', 'SUBJECTSPACEE', 'REVISIONID', 'DEFAULTSORT',
+     'DISPLAYTITLE'])
+
+#parser functions that depend on the page or current time or change
+#expander state
+IMPURE_NODES = ('#time', '#rel2abs', 'displaytitle')
+
+memo = None
+
+
+def normalize_name(name):
+    """
+    >>> normalize_name(u' flag_icon ')
+    u'Flag icon'
+    """
+    name = name.replace(u'_', u' ').strip()
+    return name[:1].upper() + name[1:]
+
+
+class TemplateMemo(object):
+    """ Bounded LRU mapping of template invocations to expansion
+    results. If `allowlist` is not empty only templates with these
+    names are memoized.
+    """
+
+    def __init__(self, size, allowlist=()):
+        self.results = lrucache.lrucache(size)
+        self.allowlist = frozenset(normalize_name(name) for name in allowlist)
+        self.hits = 0
+        self.misses = 0
+        #expansion time of reused results less time spent on
+        #expanding arguments to look up results, in seconds
+        self.saved_time = 0.0
+        #number of impure operations seen so far
+        self.impure = 0
+
+
+def install(size, allowlist=()):
+    """ Start memoizing template expansions in this process. """
+    global memo
+    memo = TemplateMemo(size, allowlist)
+    return memo
+
+
+_flatten = nodes.Template._flatten
+
+def flatten_template(self, expander, variables, res):
+    if memo is None or not isinstance(self[0], basestring):
+        return _flatten(self, expander, variables, res)
+    name = self[0]
+    #parser functions, magic words and relative names are not memoized
+    if u':' in name or name.strip().startswith(u'/'):
+        return _flatten(self, expander, variables, res)
+    name = normalize_name(name)
+    if memo.allowlist and name not in memo.allowlist:
+        return _flatten(self, expander, variables, res)
+    t0 = time.time()
+    args = []
+    for arg in self[1]:
+        tmp = []
+        evaluate.flatten(arg, expander, variables, tmp)
+        args.append(u''.join(tmp))
+    key = (name, tuple(args))
+    lookup_time = time.time() - t0
+    try:
+        pieces, expand_time = memo.results[key]
+    except KeyError:
+        pass
+    else:
+        res.extend(pieces)
+        memo.hits += 1
+        memo.saved_time += expand_time - lookup_time
+        return
+    memo.misses += 1
+    memo.saved_time -= lookup_time
+    impure = memo.impure
+    uniq_count = len(expander.uniquifier.uniq2repl)
+    start = len(res)
+    t0 = time.time()
+    _flatten(self, expander, variables, res)
+    expand_time = time.time() - t0
+    if (memo.impure == impure and
+        len(expander.uniquifier.uniq2repl) == uniq_count):
+        memo.results[key] = (res[start:], expand_time)
+
+nodes.Template._flatten = flatten_template
+
+
+_resolve = magics.MagicResolver.__call__
+
+def resolve(self, name, args):
+    if memo is not None:
+        try:
+            upper = str(name).upper()
+        except UnicodeEncodeError:
+            upper = None
+        if (upper in IMPURE_MAGIC or
+            (self.local_values and upper in self.local_values)):
+            memo.impure += 1
+    return _resolve(self, name, args)
+
+magics.MagicResolver.__call__ = resolve
+
+
+def impure_node(klass):
+    class ImpureNode(klass):
+        def flatten(self, expander, variables, res):
+            if memo is not None:
+                memo.impure += 1
+            return klass.flatten(self, expander, variables, res)
+    ImpureNode.__name__ = klass.__name__
+    return ImpureNode
+
+for name in IMPURE_NODES:
+    magic_nodes.registry[name] = impure_node(magic_nodes.registry[name])
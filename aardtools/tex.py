@@ -6,10 +6,13 @@ This code is based on eqhtml module from `mt-math`_
 """
 from __future__ import with_statement
 import os
+import glob
 import tempfile
 import binascii
 import re
 import shutil
+import signal
+import threading
 import xml.etree.ElementTree as etree
 
 from subprocess import Popen, PIPE
@@ -162,6 +165,10 @@ latex_doc = r'''\documentclass{article}
 
 emptylines = re.compile(r'[\r\n]{2,}')
 
+#maximum time in seconds renderer command may run for one equation,
+#None means no limit
+timeout = None
+
 
 class MathRenderingFailed(Exception):
 
@@ -176,12 +183,56 @@ class MathRenderingFailed(Exception):
                 % (self.equation, self.cmd, self.error))
 
 
+class MathRenderingTimedOut(Exception):
+
+    def __init__(self, equation, cmd, timeout):
+        Exception.__init__(self, equation, cmd, timeout)
+        self.equation = equation
+        self.cmd = cmd
+        self.timeout = timeout
+
+    def __str__(self):
+        return ("Couldn't convert equation %r in %.1fs (cmd: %r)"
+                % (self.equation, self.timeout, self.cmd))
+
+
+def run(cmd, equation, input=None, count=1):
+    """ Run renderer command and return (returncode, output, error)
+    tuple. Command rendering `count` equations is killed if it runs
+    longer than `timeout` per equation.
+    """
+    if not timeout:
+        sub = Popen(cmd, stdout=PIPE, stdin=PIPE, stderr=PIPE)
+        output, error = sub.communicate(input)
+        return sub.returncode, output, error
+    #command runs in its own process group so that processes it
+    #started are killed too
+    sub = Popen(cmd, stdout=PIPE, stdin=PIPE, stderr=PIPE,
+                preexec_fn=os.setsid)
+    killed = []
+    def kill():
+        killed.append(True)
+        try:
+            os.killpg(sub.pid, signal.SIGKILL)
+        except OSError:
+            #already finished
+            pass
+    timer = threading.Timer(timeout*count, kill)
+    timer.start()
+    try:
+        output, error = sub.communicate(input)
+    finally:
+        timer.cancel()
+    if killed:
+        raise MathRenderingTimedOut(equation, ' '.join(cmd), timeout*count)
+    return sub.returncode, output, error
+
+
 
 def mkpng_texvc(workdir, equation):
     cmd = ['texvc', workdir, workdir, equation, "UTF-8", "72"]
-    sub = Popen(cmd, stdout=PIPE, stdin=PIPE, stderr=PIPE)
-    (result, error) = sub.communicate()
-    if sub.returncode != 0:
+    returncode, result, error = run(cmd, equation)
+    if returncode != 0:
         raise MathRenderingFailed(equation, ' '.join(cmd), error)
     else:
         png_fn = os.path.join(workdir, result[1:33] + '.png')
@@ -190,9 +241,8 @@ def mkpng_texvc(workdir, equation):
 def mkpng_blahtex(workdir, equation):
     tex_cmd = ['blahtexml', '--texvc-compatible-commands', '--png',
                '--temp-directory', workdir, '--png-directory', workdir]
-    sub = Popen(tex_cmd, stdout=PIPE, stdin=PIPE, stderr=PIPE)
-    result, error = sub.communicate(equation)
-    if sub.returncode != 0:
+    returncode, result, error = run(tex_cmd, equation, equation)
+    if returncode != 0:
         raise MathRenderingFailed(equation, ' '.join(tex_cmd), error)
     e = etree.fromstring(result)
     png_fn = e.findtext('png/md5')
@@ -201,39 +251,83 @@ def mkpng_blahtex(workdir, equation):
         raise MathRenderingFailed(equation, ' '.join(tex_cmd), error)
     return os.path.join(workdir, os.path.extsep.join((png_fn, 'png')))
 
-def mkpng_latex(workdir, equation):
-    tex_file = os.path.join(workdir, 'eq.tex')
-
+def latex_equation(equation):
     equation = emptylines.sub('\n', equation)
     eq_stripped = equation.strip().lower()
     if not (eq_stripped.startswith(r'\begin') or
             eq_stripped.startswith('$') or
             eq_stripped.startswith('\\[')):
         equation = '\\[%s\\]' % equation
+    return equation
 
-    doc_text = latex_doc % equation
+def run_latex(workdir, equations, name):
+    """ Render each of `equations` on a separate page of one latex
+    document, convert pages to PNG files and return their names.
+    """
+    tex_file = os.path.join(workdir, name + '.tex')
+
+    #empty box makes sure every equation produces a page
+    pages = ['\\mbox{}%s' % latex_equation(equation) for equation in equations]
+    doc_text = latex_doc % '\n\\clearpage\n'.join(pages)
     with open(tex_file, 'w+') as f:
         f.write(doc_text)
 
+    failed_equation = equations[0] if len(equations) == 1 else equations
+
     tex_cmd = ['latex', '-halt-on-error', '-output-directory', workdir, tex_file]
-    sub = Popen(tex_cmd, stdout=PIPE, stdin=PIPE, stderr=PIPE)
-    error = sub.communicate()[1]
-    if sub.returncode != 0:
-        raise MathRenderingFailed(equation, ' '.join(tex_cmd), error)
+    returncode, _, error = run(tex_cmd, failed_equation,
+                               count=len(equations))
+    if returncode != 0:
+        raise MathRenderingFailed(failed_equation, ' '.join(tex_cmd), error)
 
-    dvi_file = os.path.join(workdir, 'eq.dvi')
-    png_file = os.path.join(workdir, 'eq.png')
+    dvi_file = os.path.join(workdir, name + '.dvi')
+    png_pattern = os.path.join(workdir, name + '-%d.png')
 
     png_cmd = ['dvipng', '-T', 'tight', '-x', '1200', '-z', '9',
-               '-bg', 'Transparent', '-o', png_file, dvi_file]
+               '-bg', 'Transparent', '-o', png_pattern, dvi_file]
+
+    returncode, _, error = run(png_cmd, failed_equation,
+                               count=len(equations))
+    if returncode != 0:
+        raise MathRenderingFailed(failed_equation, ' '.join(png_cmd), error)
+    #equation that is not a well formed latex fragment may produce
+    #more or less than one page
+    page_count = len(glob.glob(os.path.join(workdir, name + '-*.png')))
+    if page_count != len(equations):
+        raise MathRenderingFailed(failed_equation, ' '.join(png_cmd),
+                                  '%d pages for %d equations' %
+                                  (page_count, len(equations)))
+    return [png_pattern % (i + 1) for i in range(len(equations))]
+
+def mkpngs_latex(workdir, equations, name='eq'):
+    """ Render `equations` with one latex and one dvipng run and
+    return list of PNG file names, with `MathRenderingFailed` or
+    `MathRenderingTimedOut` exceptions for equations that latex can't
+    render. If rendering fails or times out equations are split in
+    halves and each half is rendered separately until failed
+    equations are found.
+    """
+    try:
+        return run_latex(workdir, equations, name)
+    except (MathRenderingFailed, MathRenderingTimedOut), e:
+        if len(equations) == 1:
+            return [e]
+        half = len(equations)/2
+        return (mkpngs_latex(workdir, equations[:half], name + 'a') +
+                mkpngs_latex(workdir, equations[half:], name + 'b'))
 
-    sub = Popen(png_cmd, stdout=PIPE, stdin=PIPE, stderr=PIPE)
-    error = sub.communicate()[1]
-    if sub.returncode != 0:
-        raise MathRenderingFailed(equation, ' '.join(png_cmd), error)
+def mkpng_latex(workdir, equation):
+    png_file, = mkpngs_latex(workdir, [equation])
+    if isinstance(png_file, Exception):
+        raise png_file
     return png_file
 
 
+def read_img(png_file):
+    with open(png_file, 'rb') as png:
+        png_data = png.read()
+    return binascii.b2a_base64(png_data).replace('\n', '')
+
 def toimg(equation, cmd='latex', keeptemp=False):
     try:
         workdir = tempfile.mkdtemp(prefix='math-')
@@ -243,11 +337,39 @@ def toimg(equation, cmd='latex', keeptemp=False):
 
         png_file = globals()['mkpng_'+cmd](workdir, equation)
 
-        with open(png_file, 'rb') as png:
-            png_data = png.read()
+        return read_img(png_file)
+    finally:
+        if not keeptemp:
+            shutil.rmtree(workdir)
+
+def toimgs(equations, cmd='latex', keeptemp=False):
+    """ Render `equations` and return list of base64 encoded PNG
+    images, with exceptions in place of images for equations that
+    couldn't be rendered. Latex renders all equations at once (see
+    `mkpngs_latex`), other renderers - one by one.
+    """
+    try:
+        workdir = tempfile.mkdtemp(prefix='math-')
 
-        imgdata = binascii.b2a_base64(png_data).replace('\n', '')
-        return imgdata
+        equations = [equation.encode('utf8')
+                     if isinstance(equation, unicode) else equation
+                     for equation in equations]
+
+        if cmd == 'latex':
+            try:
+                png_files = mkpngs_latex(workdir, equations)
+            except Exception, e:
+                png_files = [e]*len(equations)
+        else:
+            png_files = []
+            for equation in equations:
+                try:
+                    png_files.append(globals()['mkpng_'+cmd](workdir, equation))
+                except Exception, e:
+                    png_files.append(e)
+
+        return [png_file if isinstance(png_file, Exception)
+                else read_img(png_file) for png_file in png_files]
     finally:
         if not keeptemp:
             shutil.rmtree(workdir)
@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+# This file is part of Aard Dictionary Tools <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2008-2009  Igor Tkach
+
+""" Conversion of TeX math (common subset of what texvc accepts) to
+MathML. Constructs that are not supported (environments, matrices,
+unknown commands) raise `UnsupportedTeX`, such math needs to be
+rendered as image.
+"""
+
+import re
+import xml.etree.ElementTree as ET
+
+MATHML_NS = 'http://www.w3.org/1998/Math/MathML'
+
+TOKEN = re.compile(r'''
+    (?P<cmd>\\[a-zA-Z]+) |
+    (?P<sym>\\[^a-zA-Z]) |
+    (?P<num>[0-9]+(?:\.[0-9]+)?) |
+    (?P<space>\s+) |
+    (?P<char>.)
+    ''', re.VERBOSE | re.DOTALL | re.UNICODE)
+
+IDENTIFIERS = {
+    'alpha': u'α', 'beta': u'β', 'gamma': u'γ',
+    'delta': u'δ', 'epsilon': u'ϵ', 'varepsilon': u'ε',
+    'zeta': u'ζ', 'eta': u'η', 'theta': u'θ',
+    'vartheta': u'ϑ', 'iota': u'ι', 'kappa': u'κ',
+    'lambda': u'λ', 'mu': u'μ', 'nu': u'ν', 'xi': u'ξ',
+    'pi': u'π', 'varpi': u'ϖ', 'rho': u'ρ',
+    'varrho': u'ϱ', 'sigma': u'σ', 'varsigma': u'ς',
+    'tau': u'τ', 'upsilon': u'υ', 'phi': u'ϕ',
+    'varphi': u'φ', 'chi': u'χ', 'psi': u'ψ',
+    'omega': u'ω',
+    'Gamma': u'Γ', 'Delta': u'Δ', 'Theta': u'Θ',
+    'Lambda': u'Λ', 'Xi': u'Ξ', 'Pi': u'Π',
+    'Sigma': u'Σ', 'Upsilon': u'Υ', 'Phi': u'Φ',
+    'Psi': u'Ψ', 'Omega': u'Ω',
+    'infty': u'∞', 'infin': u'∞', 'partial': u'∂',
+    'part': u'∂', 'nabla': u'∇', 'emptyset': u'∅',
+    'empty': u'∅', 'varnothing': u'∅', 'aleph': u'ℵ',
+    'alef': u'ℵ', 'alefsym': u'ℵ', 'hbar': u'ℏ',
+    'ell': u'ℓ', 'wp': u'℘', 'weierp': u'℘',
+    'Re': u'ℜ', 'real': u'ℜ', 'Im': u'ℑ', 'image': u'ℑ',
+    'imath': u'ı', 'jmath': u'ȷ',
+    'R': u'ℝ', 'Reals': u'ℝ', 'reals': u'ℝ',
+    'Z': u'ℤ', 'N': u'ℕ', 'natnums': u'ℕ',
+    'Complex': u'ℂ', 'cnums': u'ℂ',
+    }
+
+OPERATORS = {
+    'pm': u'±', 'plusmn': u'±', 'mp': u'∓',
+    'times': u'×', 'div': u'÷', 'cdot': u'⋅',
+    'sdot': u'⋅', 'ast': u'∗', 'star': u'⋆',
+    'circ': u'∘', 'bullet': u'∙', 'bull': u'∙',
+    'oplus': u'⊕', 'ominus': u'⊖', 'otimes': u'⊗',
+    'cap': u'∩', 'cup': u'∪', 'setminus': u'∖',
+    'wedge': u'∧', 'land': u'∧', 'and': u'∧',
+    'vee': u'∨', 'lor': u'∨', 'or': u'∨',
+    'neg': u'¬', 'lnot': u'¬',
+    'leq': u'≤', 'le': u'≤', 'geq': u'≥', 'ge': u'≥',
+    'neq': u'≠', 'ne': u'≠', 'll': u'≪', 'gg': u'≫',
+    'approx': u'≈', 'sim': u'∼', 'simeq': u'≃',
+    'cong': u'≅', 'equiv': u'≡', 'propto': u'∝',
+    'in': u'∈', 'isin': u'∈', 'notin': u'∉', 'ni': u'∋',
+    'subset': u'⊂', 'sub': u'⊂', 'supset': u'⊃',
+    'subseteq': u'⊆', 'sube': u'⊆', 'supseteq': u'⊇',
+    'supe': u'⊇', 'perp': u'⊥', 'mid': u'∣',
+    'parallel': u'∥',
+    'forall': u'∀', 'exists': u'∃', 'exist': u'∃',
+    'to': u'→', 'rightarrow': u'→', 'rarr': u'→',
+    'leftarrow': u'←', 'gets': u'←', 'larr': u'←',
+    'leftrightarrow': u'↔', 'harr': u'↔', 'lrarr': u'↔',
+    'Rightarrow': u'⇒', 'Rarr': u'⇒', 'rArr': u'⇒',
+    'implies': u'⇒', 'Leftarrow': u'⇐', 'Larr': u'⇐',
+    'lArr': u'⇐', 'Leftrightarrow': u'⇔', 'iff': u'⇔',
+    'Harr': u'⇔', 'Lrarr': u'⇔', 'lrArr': u'⇔',
+    'mapsto': u'↦', 'uparrow': u'↑', 'downarrow': u'↓',
+    'ldots': u'…', 'dots': u'…', 'cdots': u'⋯',
+    'vdots': u'⋮', 'ddots': u'⋱',
+    'prime': u'′', 'angle': u'∠', 'ang': u'∠',
+    'triangle': u'△',
+    'langle': u'⟨', 'lang': u'⟨', 'rangle': u'⟩',
+    'rang': u'⟩', 'lfloor': u'⌊', 'rfloor': u'⌋',
+    'lceil': u'⌈', 'rceil': u'⌉', 'vert': u'|',
+    'Vert': u'‖', 'lbrace': u'{', 'rbrace': u'}',
+    'colon': u':',
+    }
+
+#operators with limits written under and over them
+LARGE_OPERATORS = {
+    'sum': u'∑', 'prod': u'∏', 'coprod': u'∐',
+    'bigcup': u'⋃', 'bigcap': u'⋂', 'bigoplus': u'⨁',
+    'bigotimes': u'⨂', 'bigvee': u'⋁', 'bigwedge': u'⋀',
+    }
+
+#operators with limits written as scripts
+INTEGRALS = {
+    'int': u'∫', 'iint': u'∬', 'iiint': u'∭',
+    'oint': u'∮',
+    }
+
+FUNCTIONS = frozenset((
+    'arccos', 'arcsin', 'arctan', 'arg', 'cos', 'cosh', 'cot', 'coth',
+    'csc', 'deg', 'dim', 'exp', 'gcd', 'hom', 'ker', 'lg', 'ln', 'log',
+    'Pr', 'sec', 'sin', 'sinh', 'tan', 'tanh', 'arccot', 'arcsec',
+    'arccsc', 'sgn'))
+
+#functions with limits written under them
+LIMIT_FUNCTIONS = frozenset(('lim', 'liminf', 'limsup', 'max', 'min',
+                             'sup', 'inf', 'det'))
+
+ESCAPED = {'{': u'{', '}': u'}', '|': u'‖', '%': u'%', '$': u'$',
+           '#': u'#', '&': u'&', '_': u'_'}
+
+SPACES = {'\\,': '0.167em', '\\:': '0.222em', '\\>': '0.222em',
+          '\\;': '0.278em', '\\!': '-0.167em', '\\ ': '0.333em',
+          'quad': '1em', 'qquad': '2em'}
+
+FRACTIONS = frozenset(('frac', 'dfrac', 'tfrac', 'cfrac'))
+
+FONTS = {'mathrm': 'normal', 'rm': 'normal', 'mathbf': 'bold',
+         'bf': 'bold', 'mathit': 'italic', 'it': 'italic',
+         'mathbb': 'double-struck', 'mathcal': 'script',
+         'mathfrak': 'fraktur', 'mathsf': 'sans-serif',
+         'mathtt': 'monospace', 'boldsymbol': 'bold-italic',
+         'bm': 'bold-italic'}
+
+TEXT = frozenset(('text', 'mbox', 'textrm', 'textit', 'textbf', 'hbox',
+                  'textsf', 'texttt', 'emph'))
+
+#(character, tag) for accents, tag is mover or munder
+ACCENTS = {'hat': (u'^', 'mover'), 'widehat': (u'^', 'mover'),
+           'bar': (u'¯', 'mover'), 'overline': (u'¯', 'mover'),
+           'vec': (u'→', 'mover'), 'dot': (u'˙', 'mover'),
+           'ddot': (u'¨', 'mover'), 'tilde': (u'~', 'mover'),
+           'widetilde': (u'~', 'mover'), 'underline': (u'_', 'munder')}
+
+#commands that only affect size or style, ignored
+IGNORED = frozenset(('displaystyle', 'textstyle', 'scriptstyle',
+                     'scriptscriptstyle', 'limits', 'nolimits'))
+
+SIZES = frozenset(('big', 'Big', 'bigg', 'Bigg', 'bigl', 'bigr', 'Bigl',
+                   'Bigr', 'biggl', 'biggr', 'Biggl', 'Biggr'))
+
+CHAR_OPERATORS = {u'+': u'+', u'-': u'−', u'=': u'=', u'<': u'<',
+                  u'>': u'>', u'(': u'(', u')': u')', u'[': u'[',
+                  u']': u']', u'|': u'|', u'/': u'/', u',': u',',
+                  u';': u';', u':': u':', u'.': u'.', u'!': u'!',
+                  u'*': u'∗', u"'": u'′', u'?': u'?'}
+
+
+class UnsupportedTeX(ValueError): pass
+
+
+def tokenize(tex):
+    """
+    >>> tokenize(u'\\\\frac{1}{x_2} \\\\, 3.5')
+    [('cmd', u'frac'), ('char', u'{'), ('num', u'1'), ('char', u'}'), ('char', u'{'), ('char', u'x'), ('char', u'_'), ('num', u'2'), ('char', u'}'), ('space', u' '), ('sym', u'\\\\,'), ('space', u' '), ('num', u'3.5')]
+    """
+    tokens = []
+    for m in TOKEN.finditer(tex):
+        kind = m.lastgroup
+        text = m.group(kind)
+        if kind == 'cmd':
+            text = text[1:]
+        tokens.append((kind, text))
+    return tokens
+
+
+def element(tag, text=None, **attrs):
+    e = ET.Element(tag, **attrs)
+    e.text = text
+    return e
+
+def mrow(children):
+    if len(children) == 1:
+        return children[0]
+    e = ET.Element('mrow')
+    e.extend(children)
+    return e
+
+
+class Parser(object):
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        """ Return next token that is not a space or None. """
+        while self.pos < len(self.tokens):
+            token = self.tokens[self.pos]
+            if token[0] != 'space':
+                return token
+            self.pos += 1
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise UnsupportedTeX('Unexpected end of input')
+        self.pos += 1
+        return token
+
+    def expect(self, expected):
+        token = self.next()
+        if token != expected:
+            raise UnsupportedTeX('Expected %r, got %r' % (expected, token))
+
+    def parse_row(self, end=()):
+        """ Parse elements until one of `end` tokens (not consumed)
+        or end of input.
+        """
+        children = []
+        while True:
+            token = self.peek()
+            if token is None or token in end:
+                return children
+            if token in (('char', u'^'), ('char', u'_')):
+                base = ET.Element('mrow')
+                limits = False
+            else:
+                base, limits = self.parse_atom()
+                if base is None:
+                    continue
+            children.append(self.parse_scripts(base, limits))
+
+    def parse_scripts(self, base, limits):
+        sub = sup = None
+        while True:
+            token = self.peek()
+            if token == ('char', u'_') and sub is None:
+                self.next()
+                sub = self.parse_argument()
+            elif token == ('char', u'^') and sup is None:
+                self.next()
+                sup = self.parse_argument()
+            else:
+                break
+        if sub is None and sup is None:
+            return base
+        if limits:
+            tags = ('munder', 'mover', 'munderover')
+        else:
+            tags = ('msub', 'msup', 'msubsup')
+        if sup is None:
+            e = ET.Element(tags[0])
+            e.extend((base, sub))
+        elif sub is None:
+            e = ET.Element(tags[1])
+            e.extend((base, sup))
+        else:
+            e = ET.Element(tags[2])
+            e.extend((base, sub, sup))
+        return e
+
+    def parse_argument(self):
+        """ Parse command argument or script: group or single atom. """
+        token = self.peek()
+        if token is not None and token[0] == 'num' and len(token[1]) > 1:
+            #argument without braces is a single digit, as in \frac12
+            self.tokens[self.pos] = ('num', token[1][1:])
+            return element('mn', token[1][0])
+        if token == ('char', u'{'):
+            self.next()
+            children = self.parse_row([('char', u'}')])
+            self.expect(('char', u'}'))
+            return mrow(children)
+        atom, limits = self.parse_atom()
+        if atom is None:
+            raise UnsupportedTeX('Missing argument')
+        return atom
+
+    def parse_text(self):
+        """ Parse text argument and return it as string. """
+        self.expect(('char', u'{'))
+        text = []
+        depth = 0
+        while self.pos < len(self.tokens):
+            kind, value = self.tokens[self.pos]
+            self.pos += 1
+            if (kind, value) == ('char', u'{'):
+                depth += 1
+            elif (kind, value) == ('char', u'}'):
+                if depth == 0:
+                    return u''.join(text)
+                depth -= 1
+            elif kind == 'cmd':
+                raise UnsupportedTeX('Command %r in text' % value)
+            elif kind == 'sym':
+                if value == u'\\ ':
+                    text.append(u' ')
+                elif value[1] in ESCAPED:
+                    text.append(value[1])
+                else:
+                    raise UnsupportedTeX('Command %r in text' % value)
+            else:
+                text.append(value)
+        raise UnsupportedTeX('Unexpected end of input')
+
+    def parse_delimiter(self):
+        kind, value = self.next()
+        if kind == 'char' and value in u'()[]|/.':
+            return value if value != u'.' else u''
+        if kind == 'cmd' and value in OPERATORS:
+            return OPERATORS[value]
+        if kind == 'sym' and value[1] in ESCAPED:
+            return ESCAPED[value[1]]
+        raise UnsupportedTeX('Bad delimiter %r' % value)
+
+    def parse_atom(self):
+        """ Parse next element, return (element, limits) pair where
+        limits is True if scripts are to be written under and over
+        the element. Element is None for tokens that produce nothing.
+        """
+        kind, value = self.next()
+        if kind == 'num':
+            return element('mn', value), False
+        if kind == 'char':
+            if value == u'{':
+                children = self.parse_row([('char', u'}')])
+                self.expect(('char', u'}'))
+                return mrow(children), False
+            if value.isalpha():
+                return element('mi', value), False
+            if value in CHAR_OPERATORS:
+                return element('mo', CHAR_OPERATORS[value]), False
+            if value == u'~':
+                return element('mspace', width='0.333em'), False
+            raise UnsupportedTeX('Unsupported character %r' % value)
+        if kind == 'sym':
+            if value in SPACES:
+                return element('mspace', width=SPACES[value]), False
+            if value[1] in ESCAPED:
+                return element('mo', ESCAPED[value[1]]), False
+            raise UnsupportedTeX('Unsupported command %r' % value)
+        return self.parse_command(value)
+
+    def parse_command(self, name):
+        if name in IDENTIFIERS:
+            return element('mi', IDENTIFIERS[name]), False
+        if name in OPERATORS:
+            return element('mo', OPERATORS[name]), False
+        if name in LARGE_OPERATORS:
+            return element('mo', LARGE_OPERATORS[name]), True
+        if name in INTEGRALS:
+            return element('mo', INTEGRALS[name]), False
+        if name in FUNCTIONS:
+            return element('mi', name), False
+        if name in LIMIT_FUNCTIONS:
+            return element('mi', name), True
+        if name in SPACES:
+            return element('mspace', width=SPACES[name]), False
+        if name in IGNORED:
+            return None, False
+        if name in FRACTIONS:
+            e = ET.Element('mfrac')
+            e.extend((self.parse_argument(), self.parse_argument()))
+            return e, False
+        if name == 'binom':
+            e = ET.Element('mfrac', linethickness='0')
+            e.extend((self.parse_argument(), self.parse_argument()))
+            return mrow([element('mo', u'('), e, element('mo', u')')]), False
+        if name == 'sqrt':
+            if self.peek() == ('char', u'['):
+                self.next()
+                index = mrow(self.parse_row([('char', u']')]))
+                self.expect(('char', u']'))
+                e = ET.Element('mroot')
+                e.extend((self.parse_argument(), index))
+            else:
+                e = ET.Element('msqrt')
+                e.append(self.parse_argument())
+            return e, False
+        if name == 'left':
+            opening = self.parse_delimiter()
+            children = self.parse_row([('cmd', 'right')])
+            self.expect(('cmd', 'right'))
+            closing = self.parse_delimiter()
+            return mrow([element('mo', opening, fence='true')] + children +
+                        [element('mo', closing, fence='true')]), False
+        if name in SIZES:
+            return element('mo', self.parse_delimiter()), False
+        if name in FONTS:
+            arg = self.parse_argument()
+            for e in arg.getiterator():
+                if e.tag in ('mi', 'mn'):
+                    e.set('mathvariant', FONTS[name])
+            return arg, False
+        if name in TEXT:
+            return element('mtext', self.parse_text()), False
+        if name == 'operatorname':
+            return element('mi', self.parse_text()), False
+        if name in ACCENTS:
+            char, tag = ACCENTS[name]
+            e = ET.Element(tag, accent='true')
+            e.extend((self.parse_argument(), element('mo', char)))
+            return e, False
+        if name in ('overset', 'stackrel', 'underset'):
+            e = ET.Element('munder' if name == 'underset' else 'mover')
+            script = self.parse_argument()
+            e.extend((self.parse_argument(), script))
+            return e, False
+        raise UnsupportedTeX('Unsupported command %r' % name)
+
+
+def tomathml(tex):
+    """ Return MathML element for TeX math `tex` or raise
+    `UnsupportedTeX` if it can't be converted.
+
+    >>> def t(tex): print ET.tostring(tomathml(tex))
+    >>> t(u'x^2')
+    <math xmlns="http://www.w3.org/1998/Math/MathML"><msup><mi>x</mi><mn>2</mn></msup></math>
+    >>> t(u'\\\\frac{1}{\\\\sqrt{a+b}}')
+    <math xmlns="http://www.w3.org/1998/Math/MathML"><mfrac><mn>1</mn><msqrt><mrow><mi>a</mi><mo>+</mo><mi>b</mi></mrow></msqrt></mfrac></math>
+    >>> t(u'\\\\sum_{i=1}^n i')
+    <math xmlns="http://www.w3.org/1998/Math/MathML"><mrow><munderover><mo>&#8721;</mo><mrow><mi>i</mi><mo>=</mo><mn>1</mn></mrow><mi>n</mi></munderover><mi>i</mi></mrow></math>
+    >>> t(u'\\\\mathrm{d}x')
+    <math xmlns="http://www.w3.org/1998/Math/MathML"><mrow><mi mathvariant="normal">d</mi><mi>x</mi></mrow></math>
+    >>> t(u'\\\\begin{matrix} a \\\\end{matrix}')
+    Traceback (most recent call last):
+    ...
+    UnsupportedTeX: Unsupported command u'begin'
+    >>> t(u'x^{2')
+    Traceback (most recent call last):
+    ...
+    UnsupportedTeX: Unexpected end of input
+    """
+    parser = Parser(tokenize(tex))
+    children = parser.parse_row()
+    if parser.peek() is not None:
+        raise UnsupportedTeX('Unexpected %r' % (parser.peek(),))
+    e = ET.Element('math', xmlns=MATHML_NS)
+    e.append(mrow(children))
+    return e
+
+def supported(tex):
+    try:
+        tomathml(tex)
+    except UnsupportedTeX:
+        return False
+    return True
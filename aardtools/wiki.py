@@ -17,6 +17,11 @@ from __future__ import with_statement
 import functools
 import logging
 import os
+import random
+import re
+import struct
+import time
+import zlib
 from itertools import islice
 
 try:
@@ -32,19 +37,25 @@ from mwlib import lrucache, expr
 expr._cache = lrucache.mt_lrucache(100)
 
 from mwlib.templ.evaluate import Expander
-Expander.parsedTemplateCache = lrucache.lrucache(100)
 
 tojson = functools.partial(json.dumps, ensure_ascii=False)
 
 import multiprocessing
-from multiprocessing import Pool, TimeoutError
 from mwlib.cdbwiki import WikiDB
+from mwlib import cdb
 from mwlib._version import version as mwlib_version
 import mwlib.siteinfo
 
-import gc
-
+import aardtools
 import mwaardhtmlwriter as writer
+from compiler import (sortkey, compress_article, parse_size, new_shard,
+                      shard_name, TitleHashSet)
+from cache import (ArticleCache, TemplateCache, MathCache, new_segment_name,
+                   update_cache)
+from supervisor import SupervisedPool, TaskTimedOut
+import templmemo
+import tex
+from mathservice import MathService, MathClient
 
 lic_dir = os.path.join(os.path.dirname(__file__), 'licenses')
 
@@ -54,16 +65,93 @@ known_licenses = {"Creative Commons Attribution-Share Alike 3.0 Unported":
                   os.path.join(lic_dir, "gfdl-1.2.txt")}
 
 wikidb = None
+shard = None
+cache = None
+template_cache = None
+lang_links_langs = frozenset()
+title_index = None
+#article conversion timeout in worker pool
+timeout = None
 log = logging.getLogger('wiki')
 
+#share of article conversion timeout article worker may spend waiting
+#for math rendered by math rendering service
+MATH_WAIT_SHARE = 0.9
+#default time limit for rendering one equation with math rendering
+#service, renderer that hangs would keep service's process busy
+MATH_SERVICE_TIMEOUT = 2.0
+
 def _create_wikidb(cdbdir, lang, rtl):
     global wikidb
     wikidb = Wiki(cdbdir, lang, rtl)
 
-def _init_process(cdbdir, lang, rtl):
-    global log
+def _init_process(cdbdir, lang, rtl, shard_dir=None, cache_dir=None,
+                  segment_dir=None, template_cache_dir=None,
+                  template_cache_size=1000, template_memo_size=0,
+                  template_memo_allowlist=(), lang_links=frozenset(),
+                  titles=None, math_cache_dir=None, math_timeout=None,
+                  math_service_address=None, math_format='png',
+                  math_wait=None, article_timeout=None,
+                  shard_slot=None, shard_count=0):
+    global log, shard, cache, template_cache, lang_links_langs, title_index
+    global timeout
     log = multiprocessing.get_logger()
     _create_wikidb(cdbdir, lang, rtl)
+    lang_links_langs = lang_links
+    title_index = titles
+    template_cache = TemplateCache(template_cache_dir,
+                                   '.'.join(str(v) for v in mwlib_version),
+                                   template_cache_size)
+    expr._cache = lrucache.mt_lrucache(template_cache_size)
+    if template_memo_size:
+        templmemo.install(template_memo_size, template_memo_allowlist)
+    if math_cache_dir:
+        writer.math_cache = MathCache(math_cache_dir)
+    tex.timeout = math_timeout
+    if math_service_address:
+        writer.math_service = MathClient(math_service_address, math_wait)
+    timeout = article_timeout
+    writer.math_format = math_format
+    if shard_dir:
+        shard = new_shard(shard_dir, shard_slot, shard_count)
+    if cache_dir:
+        segment_name = new_segment_name(segment_dir) if segment_dir else None
+        cache = ArticleCache(cache_dir, cache_version(lang, rtl, math_format),
+                             segment_name)
+
+def cache_version(lang, rtl, math_format='png'):
+    """ Return string identifying conversion settings and versions of
+    code that affect converted articles, it is part of article cache
+    keys.
+    """
+    return '%s %s %s %s %s' % (aardtools.__version__,
+                               '.'.join(str(v) for v in mwlib_version),
+                               lang, 'rtl' if rtl else 'ltr', math_format)
+
+_parse_raw_template = Expander._parse_raw_template
+
+def parse_raw_template(expander, name, raw):
+    """ Parse template source with `Expander._parse_raw_template`,
+    reuse parsed templates from template cache. Expander only keeps
+    parsed templates while it expands one article.
+    """
+    key = template_cache.key(name, raw)
+    parsed = template_cache.get(key)
+    if parsed is None:
+        uniq_count = len(expander.uniquifier.uniq2repl)
+        parsed = _parse_raw_template(expander, name, raw)
+        #tags such as <ref> are replaced with markers that refer to
+        #this article's uniquifier, templates with such tags can't be
+        #used for other articles
+        if len(expander.uniquifier.uniq2repl) == uniq_count:
+            template_cache.add(key, parsed)
+    return parsed
+
+Expander._parse_raw_template = parse_raw_template
+
+def _commit_shard():
+    shard.flush()
+    return shard.name, len(shard)
 
 class ConvertError(Exception):
 
@@ -94,10 +182,35 @@ class EmptyArticleError(ConvertError): pass
 
 def mkredirect(title, redirect_target):
     meta = {u'r': redirect_target}
-    return title, tojson(('', [], meta)), True, None
+    compressed, codec = compress_article(tojson(('', [], meta)).encode('utf8'))
+    return title, compressed, codec, True, None, sortkey(title)
 
 def convert(title):
-    gc.collect()
+    """ Convert article and return (result, cache counts) pair, cache
+    counts are arguments for `Compiler.count_cached`.
+    """
+    hits, misses = template_cache.hits, template_cache.misses
+    memo = templmemo.memo
+    if memo:
+        memo_hits, memo_misses = memo.hits, memo.misses
+        saved_time = memo.saved_time
+    result, cached = convert_article(title)
+    counts = (cached, template_cache.hits - hits,
+              template_cache.misses - misses)
+    if memo:
+        counts += (memo.hits - memo_hits, memo.misses - memo_misses,
+                   memo.saved_time - saved_time)
+    return result, counts
+
+def convert_article(title):
+    """ Convert article and return (result, cached) pair, `cached` is
+    True if converted article was found in article cache, False if
+    it wasn't and None if article is a redirect or there's no cache.
+    """
+    if writer.math_service and timeout:
+        #worker is killed if article is not converted in time
+        writer.math_service.deadline = (time.time() +
+                                        MATH_WAIT_SHARE*timeout)
     try:
         text = wikidb.reader[title]
 
@@ -106,7 +219,13 @@ def convert(title):
 
         redirect = wikidb.get_redirect(text)
         if redirect:
-            return mkredirect(title, redirect)
+            return stored(mkredirect(title, redirect)), None
+
+        if cache:
+            key = cache.key(title, text)
+            value = cache.get(key)
+            if value is not None:
+                return stored(from_cached(title, value)), True
 
         mwobject = uparser.parseString(title=title,
                                        raw=text,
@@ -114,21 +233,96 @@ def convert(title):
                                        lang=wikidb.lang,
                                        magicwords=wikidb.siteinfo['magicwords'])
         xhtmlwriter.preprocess(mwobject)
-        text, tags, languagelinks = writer.convert(mwobject, rtl=wikidb.rtl)
-    except EmptyArticleError:
+        (text, tags, languagelinks,
+         math_complete) = writer.convert(mwobject, rtl=wikidb.rtl)
+    except (EmptyArticleError, MemoryError):
         raise
     except Exception:
         log.exception('Failed to process article %s', title.encode('utf8'))
         raise ConvertError(title)
     else:
-        return title, tojson((text.rstrip(), tags)), False, languagelinks
+        #writer returns utf-8 encoded text
+        serialized = tojson((text.rstrip().decode('utf8'), tags)).encode('utf8')
+        compressed, codec = compress_article(serialized)
+        #math may render next time (renderer timed out or math
+        #rendering service didn't reply in time)
+        if cache and math_complete:
+            cache.add(key, to_cached(compressed, codec, languagelinks))
+        return stored((title, compressed, codec, False,
+                       languagelinks, sortkey(title))), False if cache else None
+
+def to_cached(compressed, codec, languagelinks):
+    return tojson((codec, languagelinks)).encode('utf8') + '\n' + compressed
+
+def from_cached(title, value):
+    header, compressed = value.split('\n', 1)
+    codec, languagelinks = json.loads(header)
+    return (title, compressed, str(codec), False,
+            [tuple(link) for link in languagelinks], sortkey(title))
+
+def stored(result):
+    """ Replace language links in converted article with titles of
+    language link redirects (see `language_link_titles`). If this
+    process writes articles to a shard store append converted article
+    to it and return (title, codec, redirect, language link titles,
+    compressed size) instead of converted article.
+    """
+    title, compressed, codec, redirect, languagelinks, sort_key = result
+    if languagelinks:
+        languagelinks = language_link_titles(title, languagelinks)
+    if shard is None:
+        return (title, compressed, codec, redirect,
+                languagelinks, sort_key)
+    shard.append(title.encode('utf8'), compressed, sort_key)
+    return title, codec, redirect, languagelinks, len(compressed)
+
+
+def language_link_titles(title, languagelinks):
+    """ Return titles of redirects to be added for article's language
+    links to selected languages: titles that link to this article
+    from other language and don't exist in this wiki.
+    """
+    targets = set()
+    for namespace, target in languagelinks:
+        if namespace in lang_links_langs:
+            log.debug('Language link for %s: %s (%s)',
+                      title.encode('utf8'), target.encode('utf8'),
+                      namespace.encode('utf8'))
+            i = target.find(namespace+u':')
+            if i > -1:
+                unqualified_target = target[len(namespace)+1:]
+                if unqualified_target.encode('utf8') not in title_index:
+                    targets.add(unqualified_target)
+            else:
+                log.warn('Invalid language link "%s"', target.encode('utf8'))
+    return [wikidb.nshandler.get_fqname(target) for target in targets]
+
+def make_title_index(reader):
+    """ Return set of all titles in wiki cdb `reader` (`TitleHashSet`
+    of utf8 encoded titles).
+    """
+    return TitleHashSet(cdb.Cdb.iterkeys(reader))
 
 
 class BadRedirect(ConvertError): pass
 
 
-def parse_redirect(text, aliases):
+def redirect_matcher(aliases):
+    """ Return compiled pattern that matches any of redirect
+    `aliases` (case insensitive).
     """
+    if not aliases:
+        return re.compile(u'(?!)')
+    #longest alias is tried first
+    aliases = sorted(aliases, key=len, reverse=True)
+    return re.compile(u'|'.join(re.escape(alias) for alias in aliases),
+                      re.IGNORECASE | re.UNICODE)
+
+def parse_redirect(text, aliases, matcher=None):
+    """ Return redirect target if `text` starts with one of redirect
+    `aliases`, otherwise None. `matcher` is `redirect_matcher`
+    for `aliases`, it is compiled if not specified.
+
     >>> aliases = [u"#PATRZ", u"#PRZEKIERUJ", u"#TAM", u"#REDIRECT"]
     >>> parse_redirect(u'#PATRZ [[Zmora]]', aliases)
     u'Zmora'
@@ -148,6 +342,9 @@ def parse_redirect(text, aliases):
     ...                 u"#\u043f\u0435\u0440\u0435\u043d\u0430\u043f\u0440".upper()])
     u'\u0430\u0431\u0432'
 
+    >>> parse_redirect(u'#redirect [[Abc]]', aliases, redirect_matcher(aliases))
+    u'Abc'
+
     >>> parse_redirect(u'abc', aliases)
 
     >>> parse_redirect(u'#REDIRECT [[abc', aliases)
@@ -166,17 +363,23 @@ def parse_redirect(text, aliases):
     BadRedirect: ConvertError: абв
 
     """
-    for alias in aliases:
-        if text.startswith(alias) or text.upper().startswith(alias):
-            text = text[len(alias):].lstrip()
-            begin = text.find('[[')
-            if begin < 0:
-                raise BadRedirect(text)
-            end = text.find(']]')
-            if end < 0:
-                raise BadRedirect(text)
-            return text[begin+2:end]
-    return None
+    if matcher is None:
+        matcher = redirect_matcher(aliases)
+    match = matcher.match(text)
+    if not match:
+        return None
+    text = text[match.end():].lstrip()
+    begin = text.find('[[')
+    if begin < 0:
+        raise BadRedirect(text)
+    end = text.find(']]')
+    if end < 0:
+        raise BadRedirect(text)
+    return text[begin+2:end]
+
+#number of characters of article text decompressed to find out if
+#article is a redirect
+REDIRECT_PREFIX_SIZE = 1024
 
 class Wiki(WikiDB):
 
@@ -193,13 +396,41 @@ class Wiki(WikiDB):
             self.redirect_aliases.add(alias)
             self.redirect_aliases.add(alias.lower())
             self.redirect_aliases.add(alias.upper())
+        self.redirect_pattern = redirect_matcher(self.redirect_aliases)
+        self.text_file = None
 
     def get_redirect(self, text):
-        redirect = parse_redirect(text, self.redirect_aliases)
+        redirect = parse_redirect(text, self.redirect_aliases,
+                                  self.redirect_pattern)
         if redirect:
             redirect = self.nshandler.get_fqname(redirect)
         return redirect
 
+    def read_prefix(self, title, size):
+        """ Return (text, complete) pair, where text is at most `size`
+        bytes from the beginning of article text and complete is True if
+        it is the whole text. Only this part of the text is decompressed.
+        """
+        location = cdb.Cdb.__getitem__(self.reader, title.encode('utf8'))
+        pos, length = map(int, location.split())
+        if self.text_file is None:
+            self.text_file = open(self.reader.datapath, 'rb')
+        self.text_file.seek(pos)
+        compressed = self.text_file.read(length)
+        text = zlib.decompressobj().decompress(compressed, size)
+        return text.decode('utf8', 'ignore'), len(text) < size
+
+    def get_title_redirect(self, title):
+        """ Return redirect target if article `title` is a redirect,
+        otherwise None.
+        """
+        text, complete = self.read_prefix(title, REDIRECT_PREFIX_SIZE)
+        if not self.redirect_pattern.match(text):
+            return None
+        if not complete and (u'[[' not in text or u']]' not in text):
+            text = self.reader[title]
+        return self.get_redirect(text)
+
     def getURL(self, title):
         return ''
 
@@ -241,6 +472,47 @@ def total(inputfile, options):
     except:
         return 0
 
+#number of cdb records sampled to estimate total
+ESTIMATE_SAMPLE_SIZE = 2000
+
+def estimate(inputfile, options):
+    """ Estimate number of articles from number of records in wiki
+    cdb (known from cdb hash tables size) and share of main namespace
+    titles in a sample of records. Sampled record positions are read
+    from random hash table slots.
+    """
+    load_siteinfo(options.siteinfo)
+    w = Wiki(inputfile, options.wiki_lang)
+    reader = w.reader
+    slot_format = '<LL'
+    slot_size = struct.calcsize(slot_format)
+    slot_count = sum(struct.unpack(slot_format,
+                                   reader.map[i:i+slot_size])[1]
+                     for i in xrange(0, 256*slot_size, slot_size))
+    #each hash table has twice as many slots as records
+    record_count = slot_count/2
+    sampled = 0
+    articles = 0
+    rnd = random.Random(0)
+    for i in xrange(ESTIMATE_SAMPLE_SIZE*4):
+        if sampled >= min(ESTIMATE_SAMPLE_SIZE, record_count):
+            break
+        slot = rnd.randrange(slot_count)*slot_size + reader.eod
+        pos = struct.unpack(slot_format, reader.map[slot:slot+slot_size])[1]
+        if not pos:
+            continue
+        klen = struct.unpack('<L', reader.map[pos:pos+4])[0]
+        title = reader.map[pos+8:pos+8+klen].decode('utf8')
+        sampled += 1
+        if w.nshandler.splitname(title)[0] == 0:
+            articles += 1
+    reader.close()
+    if not sampled:
+        return 0
+    count = int(record_count*float(articles)/sampled)
+    if options.end is not None:
+        count = min(count, options.end)
+    return max(count - options.start, 0)
 
 def make_input(input_file_name):
     return input_file_name
@@ -248,6 +520,8 @@ def make_input(input_file_name):
 def collect_articles(input_file, options, compiler):
     p = WikiParser(options, compiler)
     p.parse(input_file)
+    if p.segment_dir:
+        update_cache(options.article_cache, p.segment_dir)
 
 siteinfo_loaded = False
 
@@ -345,9 +619,7 @@ class WikiParser():
         self.consumer.add_metadata('mwlib',
                                    '.'.join(str(v) for v in mwlib_version))
         self.processes = options.processes if options.processes else None
-        self.pool = None
         self.timeout = options.timeout
-        self.timedout_count = 0
         self.start = options.start
         self.end = options.end
         if options.nomp:
@@ -356,6 +628,9 @@ class WikiParser():
         else:
             self.parse = self.parse_mp
         self.mp_chunk_size = options.mp_chunk_size
+        self.mp_batch_time = options.mp_batch_time
+        self.worker_memory = parse_size(options.worker_memory)
+        self.worker_address_space = parse_size(options.worker_address_space)
 
         if options.lang_links:
             self.lang_links_langs = frozenset(l.strip().lower()
@@ -367,35 +642,115 @@ class WikiParser():
 
         self.requested_article_count = options.article_count
 
-
-    def articles(self, f):
+        self.article_cache = options.article_cache
+        #cache is updated with converted articles only if all of them
+        #are converted
+        if (self.article_cache and not self.start and options.end is None
+            and not self.requested_article_count):
+            self.segment_dir = self.consumer.session_dir
+        else:
+            self.segment_dir = None
+        if self.article_cache:
+            log.info('Using article cache in %s', self.article_cache)
+        self.template_cache = options.template_cache
+        self.template_cache_size = options.template_cache_size
+        if self.template_cache:
+            log.info('Using template cache in %s', self.template_cache)
+        self.template_memo_size = options.template_memo_size
+        if options.template_memo_allowlist:
+            self.template_memo_allowlist = [
+                name.strip().decode('utf8')
+                for name in options.template_memo_allowlist.split(',')
+                if name.strip()]
+        else:
+            self.template_memo_allowlist = []
+        if self.template_memo_size:
+            log.info('Memoizing up to %d template expansions%s',
+                     self.template_memo_size,
+                     ' for %s' % options.template_memo_allowlist
+                     if self.template_memo_allowlist else '')
+        self.math_cache = options.math_cache
+        if self.math_cache:
+            log.info('Using math cache in %s', self.math_cache)
+        self.math_processes = 0 if options.nomp else options.math_processes
+        self.math_timeout = options.math_timeout
+        if self.math_timeout is None and self.math_processes:
+            self.math_timeout = MATH_SERVICE_TIMEOUT
+        self.math_wait = options.math_wait
+        if self.math_wait is None and self.math_timeout:
+            #renderers are tried in turn, each may take math timeout
+            self.math_wait = self.math_timeout*len(writer.mathcmds)
+        self.math_format = options.math_format
+
+
+    def articles(self, f, redirects=True):
+        """ Return generator that produces titles of articles to
+        convert. Redirects don't need conversion, they are added here
+        (unless `redirects` is False) instead.
+        """
         if self.start > 0:
             log.info('Skipping to article %d', self.start)
         _create_wikidb(f, self.lang, self.rtl)
         for title in islice(wikidb.articles(), self.start, self.end):
+            #articles are converted in no particular order, so when
+            #compilation is resumed titles processed before are skipped
+            if self.consumer.is_done(title):
+                continue
+            try:
+                redirect = wikidb.get_title_redirect(title)
+            except BadRedirect, e:
+                log.warn('Bad redirect %s: %s', title.encode('utf8'),
+                         e.title.encode('utf8'))
+                self.consumer.fail_article(title)
+                continue
+            except Exception:
+                #corrupt or missing record fails this article only
+                log.exception('Failed to read article %s',
+                              title.encode('utf8'))
+                self.consumer.fail_article(title)
+                continue
+            if redirect:
+                if redirects:
+                    self.add_redirect(title, redirect)
+                continue
             log.debug('Yielding "%s" for processing', title.encode('utf8'))
             yield title
-            gc.collect()
 
-    def reset_pool(self, cdbdir, terminate=True):
-        if self.pool and terminate:
-            log.info('Terminating current worker pool')
-            self.pool.terminate()
-        log.info('Creating new worker pool with wiki cdb at %s', cdbdir)
+    def add_redirect(self, title, target):
+        (title, compressed, codec, redirect,
+         langugagelinks, sort_key) = mkredirect(title, target)
+        self.consumer.add_compressed_article(title, compressed, codec,
+                                             redirect, sort_key=sort_key)
 
-        self.pool = Pool(processes=self.processes,
-                         initializer=_init_process,
-                         initargs=[cdbdir, self.lang, self.rtl])
+    def title_index(self, f):
+        """ Return set of titles to check language links against if
+        language links are requested, otherwise None.
+        """
+        if not self.lang_links_langs:
+            return None
+        log.info('Indexing titles')
+        _create_wikidb(f, self.lang, self.rtl)
+        titles = make_title_index(wikidb.reader)
+        log.info('Indexed %d titles', len(titles))
+        return titles
 
     def parse_simple(self, f):
-        _init_process(f, self.lang, self.rtl)
+        _init_process(f, self.lang, self.rtl, None, self.article_cache,
+                      self.segment_dir, self.template_cache,
+                      self.template_cache_size, self.template_memo_size,
+                      self.template_memo_allowlist, self.lang_links_langs,
+                      self.title_index(f), self.math_cache,
+                      self.math_timeout, None, self.math_format)
         self.consumer.add_metadata('article_format', 'html')
         articles = self.articles(f)
         for a in articles:
             try:
-                result = convert(a)
-                title, serialized, redirect, langugagelinks = result
-                self.consumer.add_article(title, serialized, redirect)
+                result, counts = convert(a)
+                self.consumer.count_cached(*counts)
+                (title, compressed, codec, redirect,
+                 langugagelinks, sort_key) = result
+                self.consumer.add_compressed_article(title, compressed, codec,
+                                                     redirect, sort_key=sort_key)
                 self.process_languagelinks(title, langugagelinks)
             except EmptyArticleError, e:
                 self.consumer.empty_article(e.title)
@@ -403,87 +758,115 @@ class WikiParser():
                 self.consumer.fail_article(e.title)
 
     def parse_mp(self, f):
+        if not self.math_processes:
+            self.convert_mp(f)
+            return
+        service = MathService(self.math_processes, self.math_cache,
+                              self.math_timeout)
+        try:
+            self.convert_mp(f, service.address)
+        finally:
+            service.stop()
+
+    def convert_mp(self, f, math_service_address=None):
+        self.consumer.add_metadata('article_format', 'html')
+        #redirects are not needed if only some articles are used
+        articles = self.articles(f, not self.requested_article_count)
+        log.info('Creating worker pool with wiki cdb at %s', f)
+        #workers write articles to their own stores unless only some of
+        #the converted articles are going to be used
+        use_shards = not self.requested_article_count
+        if use_shards:
+            shard_dir = self.consumer.session_dir
+            batch_done = _commit_shard
+            on_batch_done = lambda info: self.consumer.add_shard(*info)
+            #worker that replaces another one continues its shard
+            #after articles registered so far
+            slot_initargs = lambda slot: [slot, self.consumer.shards.get(
+                    shard_name(shard_dir, slot), 0)]
+        else:
+            shard_dir = batch_done = on_batch_done = slot_initargs = None
+        pool = SupervisedPool(convert,
+                              processes=self.processes,
+                              initializer=_init_process,
+                              initargs=[f, self.lang, self.rtl, shard_dir,
+                                        self.article_cache, self.segment_dir,
+                                        self.template_cache,
+                                        self.template_cache_size,
+                                        self.template_memo_size,
+                                        self.template_memo_allowlist,
+                                        self.lang_links_langs,
+                                        self.title_index(f),
+                                        self.math_cache,
+                                        self.math_timeout,
+                                        math_service_address,
+                                        self.math_format,
+                                        self.math_wait,
+                                        self.timeout],
+                              timeout=self.timeout,
+                              max_tasks=self.mp_chunk_size,
+                              max_rss=self.worker_memory,
+                              address_space=self.worker_address_space,
+                              batch_time=self.mp_batch_time,
+                              batch_done=batch_done,
+                              on_batch_done=on_batch_done,
+                              slot_initargs=slot_initargs)
+        real_article_count = 0
         try:
-            self.consumer.add_metadata('article_format', 'html')
-            articles = self.articles(f)
-            self.reset_pool(f)
-            iter_count = 1
-            real_article_count = 0
-            while True:
-                if iter_count:
-                    chunk = islice(articles, self.mp_chunk_size)
-                    iter_count = 0
-                else:
-                    break
-
-                resulti = self.pool.imap_unordered(convert, chunk)
-                while True:
-                    try:
-                        result = resulti.next(self.timeout)
-                        iter_count += 1
-                        title, serialized, redirect, langugagelinks  = result
-
-                        if self.requested_article_count:
-                            if  not redirect:
-                                real_article_count += 1
-                                self.consumer.add_article(title, serialized, redirect)
-                                self.process_languagelinks(title, langugagelinks)
-                                if real_article_count >= self.requested_article_count:
-                                    try:
-                                        self.pool.terminate()
-                                    except:
-                                        log.exception()
-                                    finally:
-                                        return
-                        else:
-                            self.consumer.add_article(title, serialized, redirect)
-                            self.process_languagelinks(title, langugagelinks)
-                    except StopIteration:
+            for title, result, error in pool.imap_unordered(articles):
+                if error:
+                    if isinstance(error, TaskTimedOut):
+                        self.consumer.timedout(title)
+                    elif isinstance(error, EmptyArticleError):
+                        self.consumer.empty_article(error.title)
+                    elif isinstance(error, ConvertError):
+                        self.consumer.fail_article(error.title)
+                    else:
+                        log.error('Failed to process article %s: %s',
+                                  title.encode('utf8'), error)
+                        self.consumer.fail_article(title)
+                    continue
+                result, counts = result
+                self.consumer.count_cached(*counts)
+                if use_shards:
+                    title, codec, redirect, langugagelinks, size = result
+                    self.consumer.add_shard_article(title, codec, redirect)
+                    self.process_languagelinks(title, langugagelinks)
+                    continue
+                (title, compressed, codec, redirect,
+                 langugagelinks, sort_key) = result
+                if self.requested_article_count and redirect:
+                    continue
+                self.consumer.add_compressed_article(
+                    title, compressed, codec, redirect,
+                    sort_key=sort_key)
+                self.process_languagelinks(title, langugagelinks)
+                if self.requested_article_count:
+                    real_article_count += 1
+                    if real_article_count >= self.requested_article_count:
                         break
-                    except TimeoutError:
-                        log.warn('Worker pool timed out')
-                        self.consumer.timedout(count=len(multiprocessing.active_children()))
-                        self.reset_pool(f)
-                        resulti = self.pool.imap_unordered(convert, chunk)
-                    except AssertionError:
-                        log.exception()
-                    except EmptyArticleError, e:
-                        self.consumer.empty_article(e.title)
-                    except ConvertError, e:
-                        self.consumer.fail_article(e.title)
-                    except KeyboardInterrupt:
-                        log.error('Keyboard interrupt: '
-                                  'terminating worker pool')
-                        self.pool.terminate()
-                        raise
-
-                self.pool.close()
-                self.reset_pool(f, terminate=False)
+        except KeyboardInterrupt:
+            log.error('Keyboard interrupt: '
+                      'terminating worker pool')
+            pool.terminate()
+            raise
         finally:
-            self.pool.close()
-            self.pool.join()
+            if pool.retired_count:
+                log.info('%d worker(s) retired after reaching memory limit',
+                         pool.retired_count)
+            pool.close()
 
     def process_languagelinks(self, title, languagelinks):
+        """ Add redirects to article `title` for language link
+        titles found by worker (see `language_link_titles`).
+        """
         if not languagelinks:
             return
-        targets = set()
-        for namespace, target in languagelinks:
-            if namespace in self.lang_links_langs:
-                log.debug('Language link for %s: %s (%s)',
-                          title.encode('utf8'), target.encode('utf8'),
-                          namespace.encode('utf8'))
-                i = target.find(namespace+u':')
-                if i > -1:
-                    unqualified_target = target[len(namespace)+1:]
-                    try:
-                        wikidb.reader[unqualified_target]
-                    except KeyError:
-                        targets.add(unqualified_target)
-                else:
-                    log.warn('Invalid language link "%s"', target.encode('utf8'))
-        for target in targets:
-            (l_title, l_serialized,
-             l_redirect, l_langugagelinks) = mkredirect(wikidb.nshandler.get_fqname(target), title)
-            self.consumer.add_article(l_title, l_serialized,
-                                      redirect=True, count=False)
+        for target in languagelinks:
+            (l_title, l_compressed, l_codec, l_redirect,
+             l_langugagelinks,
+             l_sort_key) = mkredirect(target, title)
+            self.consumer.add_compressed_article(l_title, l_compressed, l_codec,
+                                                 redirect=True, count=False,
+                                                 sort_key=l_sort_key)
 
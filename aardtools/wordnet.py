@@ -33,10 +33,15 @@ ref = re.compile(r"`(\w+)'")
 
 wordnet = None
 
-def total(inputfile, options):
+def prepare(inputfile):
     global wordnet
-    wordnet = WordNet(inputfile)
-    wordnet.prepare()
+    if wordnet is None or wordnet.wordnetdir != inputfile:
+        wordnet = WordNet(inputfile)
+        wordnet.prepare()
+    return wordnet
+
+def total(inputfile, options):
+    wordnet = prepare(inputfile)
     count = 0
     for title in wordnet.collector:
         has_article = False
@@ -50,8 +55,12 @@ def total(inputfile, options):
     return count
 
 
+#prepared data is needed for conversion anyway, so counting
+#articles takes no extra pass
+estimate = total
+
 def collect_articles(input_file, options, compiler):
-    wordnet.process(compiler)
+    prepare(input_file).process(compiler)
 
 def make_input(input_file_name):
     return input_file_name #this should be wordnet dir, leave it alone
@@ -17,6 +17,7 @@ import sys
 import logging
 import functools
 from copy import deepcopy
+from StringIO import StringIO
 
 try:
     from xml.etree import cElementTree as etree
@@ -58,9 +59,51 @@ tojson = functools.partial(json.dumps, ensure_ascii=False)
 
 
 def total(inputfile, options):
+    return sum(article_key_counts(etree.iterparse(inputfile)))
+
+#number of bytes at the beginning of input used to estimate total
+ESTIMATE_SAMPLE_SIZE = 1024*1024
+
+def estimate(inputfile, options):
+    """ Estimate number of articles from number of keys in a sample
+    at the beginning of input and input size. Return None if input
+    size is not known or input is standard input (sample can't be
+    read without consuming it).
+    """
+    if inputfile is sys.stdin:
+        return None
+    if hasattr(inputfile, 'size'):
+        #tar archive member
+        size = inputfile.size
+    else:
+        try:
+            size = os.fstat(inputfile.fileno()).st_size
+        except (AttributeError, OSError):
+            return None
+    if not size:
+        #pipe or other special file
+        inputfile.close()
+        return None
+    sample = inputfile.read(ESTIMATE_SAMPLE_SIZE)
+    inputfile.close()
+    if not sample:
+        return None
     count = 0
-    for event, element in etree.iterparse(inputfile):
+    try:
+        for key_count in article_key_counts(etree.iterparse(StringIO(sample))):
+            count += key_count
+    except SyntaxError:
+        #sample ends in the middle of an article
+        pass
+    return int(count*float(size)/len(sample))
+
+def article_key_counts(events):
+    """ Generate number of keys (including key variants with
+    optional parts) for each article.
+    """
+    for event, element in events:
         if element.tag == 'ar':
+            count = 0
             keys = element.findall('k')
             for key_element in keys:
                 n_opts = len([c for c in key_element if c.tag == 'opt'])
@@ -70,9 +113,9 @@ def total(inputfile, options):
                             count += 1
                 else:
                     count += 1
+            yield count
         if element.tag != 'k':
             element.clear()
-    return count
 
 def make_input(input_file_name):
     if input_file_name == '-':
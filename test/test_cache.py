@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+from aardtools.cache import (ArticleCache, TemplateCache, MathCache,
+                             new_segment_name, update_cache)
+
+def setup():
+    global cache_dir, session_dir
+    cache_dir = tempfile.mkdtemp()
+    session_dir = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(cache_dir)
+    shutil.rmtree(session_dir)
+
+def test_cache():
+    cache = ArticleCache(cache_dir, '1', new_segment_name(session_dir))
+    key = cache.key(u'a', u'text a')
+    assert cache.get(key) is None
+    cache.add(key, 'converted a')
+    cache.add(cache.key(u'b', u'text b'), 'converted b')
+    cache.close()
+    assert update_cache(cache_dir, session_dir) == 2
+    assert not os.listdir(session_dir)
+
+    #articles found in cache are kept for next compilation
+    cache = ArticleCache(cache_dir, '1', new_segment_name(session_dir))
+    assert cache.get(cache.key(u'a', u'text a')) == 'converted a'
+    assert cache.get(cache.key(u'a', u'changed text')) is None
+    other_version = ArticleCache(cache_dir, '2')
+    assert other_version.get(other_version.key(u'a', u'text a')) is None
+    other_version.close()
+    cache.close()
+    assert update_cache(cache_dir, session_dir) == 1
+    assert len(os.listdir(cache_dir)) == 2
+
+def test_incomplete_segment():
+    cache = ArticleCache(cache_dir, '1', new_segment_name(session_dir))
+    cache.add(cache.key(u'a', u'text a'), 'converted a')
+    cache.add(cache.key(u'b', u'text b'), 'converted b')
+    cache.segment.truncate(os.path.getsize(cache.segment.name) - 1)
+    cache.close()
+    assert update_cache(cache_dir, session_dir) == 1
+
+def test_template_cache():
+    cache = TemplateCache(None, '1', 2)
+    key = cache.key(u'Infobox', u'{{{1}}}')
+    assert cache.get(key) is None
+    cache.add(key, (u'parsed',))
+    assert cache.get(key) == (u'parsed',)
+    assert cache.get(cache.key(u'Infobox', u'{{{2}}}')) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+def test_shared_template_cache():
+    cache = TemplateCache(cache_dir, '1', 10)
+    key = cache.key(u'Infobox', u'{{{1}}}')
+    cache.add(key, (u'parsed',))
+    #templates parsed by other process are read from cache dir
+    other = TemplateCache(cache_dir, '1', 10)
+    assert other.get(key) == (u'parsed',)
+    other_version = TemplateCache(cache_dir, '2', 10)
+    assert other_version.get(other_version.key(u'Infobox', u'{{{1}}}')) is None
+
+def test_math_cache():
+    cache = MathCache(cache_dir)
+    key = cache.key('latex', u'x^2')
+    assert cache.get(key) is None
+    cache.add(key, 'aW1hZ2U=')
+    cache.add(cache.key('blahtex', u'x^2'), '')
+    other = MathCache(cache_dir)
+    assert other.get(key) == 'aW1hZ2U='
+    #renderer failed
+    assert other.get(other.key('blahtex', u'x^2')) == ''
+    assert other.get(other.key('texvc', u'x^2')) is None
+    assert (other.hits, other.misses) == (2, 1)
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+from aardtools import compiler
+
+def setup():
+    global work_dir
+    work_dir = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(work_dir)
+
+def test_args_absolute_paths():
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        options, args = compiler.make_opt_parser().parse_args(
+            ['wiki', 'enwiki.cdb', '-o', 'out/enwiki.aar', '--timeout', '5'])
+        args = compiler.absolute_paths(options, args)
+        compiler.write_args(work_dir, options, args)
+    finally:
+        os.chdir(cwd)
+    #resumed from other directory
+    options, args = compiler.read_args(work_dir)
+    assert args == ['wiki', os.path.join(work_dir, 'enwiki.cdb')]
+    assert options.output_file == os.path.join(work_dir, 'out', 'enwiki.aar')
+    assert options.work_dir == work_dir
+    assert options.timeout == 5.0
+    assert isinstance(options.output_file, str)
+
+def test_rename_files_again():
+    base = os.path.join(work_dir, 'dict')
+    file_names = [base + '.aar.1', base + '.aar.2']
+    for file_name in file_names:
+        open(file_name, 'w').close()
+    compiler.rename_files(file_names)
+    #compilation interrupted after renaming is resumed
+    compiler.rename_files(file_names)
+    assert os.path.exists(base + '.1_of_2.aar')
+    assert os.path.exists(base + '.2_of_2.aar')
+
+def test_merge_sorted_shards():
+    from aardtools import merge
+    shards = [(['a', 'c', 'e'], {'_zlib': 2, 'none': 1}, 1),
+              (['b', 'c', 'd'], {'_bz2': 3}, 0)]
+    file_names = []
+    for n, (titles, counts, redirects) in enumerate(shards):
+        file_name = os.path.join(work_dir, '%d.shard' % n)
+        header = dict(metadata={'title': 'Dict'},
+                      articles=len(titles) - redirects,
+                      redirects=redirects,
+                      compress_counts=counts)
+        compiler.write_sorted_shard(file_name, header,
+                                    [(title.upper(), title, '%s%d' % (title, n))
+                                     for title in titles])
+        file_names.append(file_name)
+    session_dir = tempfile.mkdtemp(dir=work_dir)
+    c = compiler.Compiler(os.path.join(work_dir, 'dict.aar'), 2**31-1,
+                          session_dir)
+    counts_before = dict(compiler.compress_counts)
+    try:
+        assert merge.total(file_names[0], None) == 3
+        merge.collect_all_articles(file_names, None, c)
+        assert list(c.article_store.keyed_items()) == [
+            ('A', 'a', 'a0'), ('B', 'b', 'b1'), ('C', 'c', 'c0'),
+            ('C', 'c', 'c1'), ('D', 'd', 'd1'), ('E', 'e', 'e0')]
+        assert (c.stats.articles, c.stats.redirects) == (5, 1)
+        assert c.metadata['title'] == 'Dict'
+        for codec, count in (('_zlib', 2), ('none', 1), ('_bz2', 3)):
+            assert (compiler.compress_counts[codec] ==
+                    counts_before.get(codec, 0) + count)
+    finally:
+        c.article_store.close()
@@ -0,0 +1,48 @@
+import zlib
+import bz2
+import random
+import string
+
+from aardtools.compiler import (BestCompression, FastCompression,
+                                AutoCompression)
+
+decompress = {'_zlib': zlib.decompress,
+              '_bz2': bz2.decompress,
+              'none': lambda x: x}
+
+def random_text(length):
+    return ''.join(random.choice(string.letters[:4]) for i in range(length))
+
+def check_roundtrip(policy, texts):
+    codecs = set()
+    for text in texts:
+        compressed, codec = policy.compress(text)
+        assert decompress[codec](compressed) == text
+        codecs.add(codec)
+    return codecs
+
+def test_best():
+    codecs = check_roundtrip(BestCompression(),
+                             [random_text(2000) for i in range(20)])
+    assert codecs <= set(['_zlib', '_bz2', 'none'])
+
+def test_fast():
+    policy = FastCompression()
+    codecs = check_roundtrip(policy,
+                             [random_text(2000) for i in range(20)])
+    assert '_bz2' not in codecs
+    #bz2 is not run even to estimate saved time
+    assert '_bz2' not in policy.codec_time
+    assert policy.saved_time.value == 0
+
+def test_auto_small():
+    policy = AutoCompression()
+    for i in range(10):
+        text = random_text(policy.min_size - 1)
+        assert policy.compress(text) == (text, 'none')
+
+def test_auto_learns():
+    policy = AutoCompression()
+    texts = [random_text(3000) for i in range(2*policy.learn_count)]
+    check_roundtrip(policy, texts)
+    assert policy.saved_time.value > 0
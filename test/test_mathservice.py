@@ -0,0 +1,114 @@
+import threading
+import time
+from multiprocessing import Pipe
+from aardtools import mwaardhtmlwriter as writer
+from aardtools.mathservice import (MathService, MathClient, Dispatcher,
+                                   Handler, RENDER, CANCEL)
+
+def fake_render_math(equations, title):
+    return dict((equation, '%s image of %s' % (title, equation))
+                for equation in equations)
+
+def test_render():
+    render_math = writer.render_math
+    writer.render_math = fake_render_math
+    try:
+        service = MathService(1)
+    finally:
+        writer.render_math = render_math
+    try:
+        client = MathClient(service.address, 30)
+        client.submit([u'x^2', u'\\alpha'], u'Title')
+        assert client.result() == {u'x^2': u'Title image of x^2',
+                                   u'\\alpha': u'Title image of \\alpha'}
+        client.conn.close()
+    finally:
+        service.stop()
+
+def slow_render_math(equations, title):
+    time.sleep(0.2*len(equations))
+    return dict((equation, 'image') for equation in equations)
+
+def test_wait_per_equation():
+    render_math = writer.render_math
+    writer.render_math = slow_render_math
+    try:
+        service = MathService(1)
+    finally:
+        writer.render_math = render_math
+    try:
+        client = MathClient(service.address, 0.5)
+        #takes longer than client waits for one equation
+        client.submit([u'a', u'b', u'c', u'd'], u'Title')
+        assert client.result() == {u'a': 'image', u'b': 'image',
+                                   u'c': 'image', u'd': 'image'}
+        client.deadline = time.time() + 0.1
+        client.submit([u'e', u'f'], u'Title')
+        assert client.result() is None
+        client.conn.close()
+    finally:
+        service.stop()
+
+class Pool(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def apply_async(self, func, args, callback):
+        self.calls.append((args, callback))
+
+def wait_for(condition):
+    for i in range(100):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError('Timed out')
+
+def test_cancelled_requests_dropped():
+    pool = Pool()
+    dispatcher = Dispatcher(pool, 1)
+    replies = []
+    requests = [([name], name, replies.append) for name in 'abc']
+    for request in requests:
+        dispatcher.submit(request)
+    wait_for(lambda: len(pool.calls) == 1)
+    dispatcher.cancel(requests[1])
+    args, callback = pool.calls[0]
+    callback({'a': 'image'})
+    wait_for(lambda: len(pool.calls) == 2)
+    time.sleep(0.05)
+    assert [args for args, callback in pool.calls] == [(['a'], 'a'),
+                                                       (['c'], 'c')]
+    assert replies == [{'a': 'image'}]
+
+class FakeDispatcher(object):
+
+    def __init__(self):
+        self.requests = []
+
+    def submit(self, request):
+        self.requests.append(request)
+
+    def cancel(self, request):
+        pass
+
+def test_superseded_replies_dropped():
+    client, conn = Pipe()
+    dispatcher = FakeDispatcher()
+    thread = threading.Thread(target=Handler(conn, dispatcher).run)
+    thread.start()
+    try:
+        client.send((RENDER, 0, [u'a'], u'A'))
+        client.send((RENDER, 1, [u'b'], u'B'))
+        wait_for(lambda: len(dispatcher.requests) == 2)
+        client.send((CANCEL, 1))
+        client.send((RENDER, 2, [u'c'], u'C'))
+        wait_for(lambda: len(dispatcher.requests) == 3)
+        for equations, title, send in dispatcher.requests:
+            send({equations[0]: 'image'})
+        assert client.poll(1)
+        assert client.recv() == (2, {u'c': 'image'})
+        assert not client.poll(0.1)
+    finally:
+        client.close()
+        thread.join()
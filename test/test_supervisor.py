@@ -0,0 +1,173 @@
+import os
+import time
+from aardtools.supervisor import SupervisedPool, TaskTimedOut, WorkerDied
+
+def work(task):
+    if task == 'slow':
+        time.sleep(5)
+    if task == 'nap':
+        time.sleep(0.3)
+    if task == 'die':
+        os._exit(1)
+    if task == 'fail':
+        raise ValueError(task)
+    if task == 'oom':
+        raise MemoryError(task)
+    return task.upper(), os.getpid()
+
+def test_results():
+    pool = SupervisedPool(work, processes=2)
+    try:
+        results = sorted(pool.imap_unordered(['a', 'b', 'c']))
+    finally:
+        pool.close()
+    assert [(task, result[0], error)
+            for task, result, error in results] == [('a', 'A', None),
+                                                   ('b', 'B', None),
+                                                   ('c', 'C', None)]
+
+def test_errors():
+    pool = SupervisedPool(work, processes=2, timeout=0.5)
+    try:
+        results = dict((task, (result, error)) for task, result, error
+                       in pool.imap_unordered(['a', 'slow', 'fail', 'die', 'b']))
+    finally:
+        pool.close()
+    assert results['a'][0][0] == 'A'
+    assert results['b'][0][0] == 'B'
+    assert isinstance(results['slow'][1], TaskTimedOut)
+    assert results['slow'][1].task == 'slow'
+    assert isinstance(results['fail'][1], ValueError)
+    assert isinstance(results['die'][1], WorkerDied)
+
+def test_timeout_keeps_other_workers():
+    pool = SupervisedPool(work, processes=2, timeout=0.5)
+    try:
+        pids = set(result[1] for task, result, error
+                   in pool.imap_unordered(['a', 'b'])
+                   if result)
+        for task, result, error in pool.imap_unordered(['slow', 'c']):
+            if result:
+                pids.add(result[1])
+        assert len(pids) == 2, pids
+    finally:
+        pool.close()
+
+def test_suspended_consumer():
+    pool = SupervisedPool(work, processes=2, timeout=0.5)
+    try:
+        results = {}
+        for task, result, error in pool.imap_unordered(['a', 'nap']):
+            results[task] = error
+            #worker running nap finishes in time while consumer is busy
+            time.sleep(1)
+    finally:
+        pool.close()
+    assert results == {'a': None, 'nap': None}, results
+
+def test_max_tasks():
+    pool = SupervisedPool(work, processes=1, max_tasks=2)
+    try:
+        pids = set(result[1] for task, result, error
+                   in pool.imap_unordered(['a', 'b', 'c', 'd']))
+    finally:
+        pool.close()
+    assert len(pids) == 2, pids
+
+def test_memory_limit():
+    pool = SupervisedPool(work, processes=1, max_rss=1)
+    try:
+        pids = set(result[1] for task, result, error
+                   in pool.imap_unordered(['a', 'b', 'c']))
+    finally:
+        pool.close()
+    assert len(pids) == 3, pids
+    assert pool.retired_count == 3
+
+def test_out_of_memory():
+    pool = SupervisedPool(work, processes=1)
+    try:
+        results = list(pool.imap_unordered(['oom', 'a', 'b']))
+    finally:
+        pool.close()
+    assert isinstance(results[0][2], MemoryError)
+    assert pool.retired_count == 1
+    assert results[1][1][1] == results[2][1][1]
+
+def test_batches():
+    pool = SupervisedPool(work, processes=2, batch_time=1)
+    try:
+        tasks = [str(i) for i in range(1000)]
+        results = list(pool.imap_unordered(tasks))
+        assert pool.batch_size() == pool.max_batch_size
+    finally:
+        pool.close()
+    assert sorted(task for task, result, error in results) == sorted(tasks)
+    assert all(result[0] == task for task, result, error in results)
+
+def test_timeout_in_batch():
+    pool = SupervisedPool(work, processes=1, batch_time=1, timeout=0.5)
+    try:
+        list(pool.imap_unordered(['a', 'b', 'c']))
+        tasks = ['d', 'e', 'slow', 'f', 'fail', 'g']
+        results = list(pool.imap_unordered(tasks))
+    finally:
+        pool.close()
+    assert sorted(task for task, result, error in results) == sorted(tasks)
+    results = dict((task, (result, error)) for task, result, error in results)
+    assert isinstance(results['slow'][1], TaskTimedOut)
+    assert isinstance(results['fail'][1], ValueError)
+    for task in ('d', 'e', 'f', 'g'):
+        assert results[task][0][0] == task.upper()
+
+shard = None
+
+def init_shard(work_dir, slot, count):
+    global shard
+    from aardtools.compiler import new_shard
+    shard = new_shard(work_dir, slot, count)
+
+def write_to_shard(task):
+    shard.append(task, 'article ' + task)
+    if task == 'slow':
+        shard.flush()
+        time.sleep(5)
+    return task
+
+def commit_shard():
+    shard.flush()
+    return shard.name, len(shard)
+
+def test_worker_restarts_reuse_shards():
+    import glob, shutil, tempfile
+    from aardtools.compiler import TempArticleStore, shard_name
+    work_dir = tempfile.mkdtemp()
+    counts = {}
+    def on_batch_done(info):
+        name, count = info
+        counts[name] = count
+    slot_initargs = lambda slot: [slot, counts.get(shard_name(work_dir, slot),
+                                                   0)]
+    #every task is run by new worker, some workers are killed
+    pool = SupervisedPool(write_to_shard, processes=2, timeout=0.5,
+                          max_tasks=1, initializer=init_shard,
+                          initargs=[work_dir], batch_done=commit_shard,
+                          on_batch_done=on_batch_done,
+                          slot_initargs=slot_initargs)
+    store = TempArticleStore(work_dir)
+    try:
+        tasks = ['%03d' % i for i in range(60)]
+        tasks[10] = tasks[40] = 'slow'
+        results = list(pool.imap_unordered(tasks))
+        pool.close()
+        assert len(results) == 60
+        assert len(glob.glob(os.path.join(work_dir, 'shard-*.index'))) == 2
+        for name, count in counts.iteritems():
+            store.add_shard(name, count)
+        expected = [(task, 'article ' + task) for task in sorted(tasks)
+                    if task != 'slow']
+        assert list(store.sorted()) == expected
+    finally:
+        pool.close()
+        store.close()
+        shutil.rmtree(work_dir)
@@ -27,3 +27,139 @@ def test_with_key():
     actual = list(store.sorted(key=lambda x: ''.join(reversed(x))))
     expected = sorted(data, key=lambda x: ''.join(reversed(x[0])))
     assert actual == expected, 'actual:\n%r\nexpected:\n%r\n' % (actual, expected)
+
+def test_external_sort():
+    external_store = TempArticleStore(max_sort_memory=256)
+    for title, article in data:
+        external_store.append(title, article)
+    try:
+        actual = list(external_store.sorted())
+        expected = sorted(data, key=lambda x: x[0])
+        assert actual == expected, 'actual:\n%r\nexpected:\n%r\n' % (actual, expected)
+    finally:
+        external_store.close()
+
+def test_stored_keys():
+    keyed_store = TempArticleStore()
+    for title, article in data:
+        keyed_store.append(title, article, ''.join(reversed(title)))
+    try:
+        actual = list(keyed_store.sorted())
+        expected = sorted(data, key=lambda x: ''.join(reversed(x[0])))
+        assert actual == expected, 'actual:\n%r\nexpected:\n%r\n' % (actual, expected)
+    finally:
+        keyed_store.close()
+
+def test_items_range():
+    store.sort()
+    expected = sorted(data, key=lambda x: x[0])
+    assert list(store.items(10, 20)) == expected[10:20]
+    assert list(store.items(90)) == expected[90:]
+
+def test_sizes():
+    store.sort()
+    expected = [(len(title), len(article),
+                 article if len(article) <= 20 else None)
+                for title, article in sorted(data, key=lambda x: x[0])]
+    assert list(store.sizes(20)) == expected
+
+def test_shards():
+    import tempfile, shutil
+    from aardtools.compiler import new_shard
+    work_dir = tempfile.mkdtemp()
+    main_store = TempArticleStore(work_dir)
+    try:
+        shards = [new_shard(work_dir, i) for i in range(2)]
+        for i, (title, article) in enumerate(data):
+            if i % 3:
+                shards[i % 3 - 1].append(title, article)
+            else:
+                main_store.append(title, article)
+        #articles appended after shard was registered are not included
+        for shard in shards:
+            shard.flush()
+            main_store.add_shard(shard.name, len(shard))
+            shard.append('extra', 'extra article')
+            shard.flush()
+        assert len(main_store) == len(data)
+        assert list(main_store.sorted()) == sorted(data, key=lambda x: x[0])
+    finally:
+        main_store.close()
+        shutil.rmtree(work_dir)
+
+def test_reopen_shard():
+    import tempfile, shutil
+    from aardtools.compiler import new_shard
+    work_dir = tempfile.mkdtemp()
+    main_store = TempArticleStore(work_dir)
+    try:
+        half = len(data)/2
+        shard = new_shard(work_dir, 0)
+        for title, article in data[:half]:
+            shard.append(title, article, title)
+        shard.flush()
+        count = len(shard)
+        #articles not registered before worker is replaced are discarded
+        shard.append('extra', 'extra article', 'extra')
+        shard.flush()
+        reopened = new_shard(work_dir, 0, count)
+        assert reopened.name == shard.name
+        assert len(reopened) == half
+        for title, article in data[half:]:
+            reopened.append(title, article, title)
+        reopened.flush()
+        main_store.add_shard(reopened.name, len(reopened))
+        assert list(main_store.sorted()) == sorted(data, key=lambda x: x[0])
+    finally:
+        main_store.close()
+        shutil.rmtree(work_dir)
+
+def test_reopen():
+    reopened = None
+    partial_store = TempArticleStore()
+    try:
+        half = len(data)/2
+        for title, article in data[:half]:
+            partial_store.append(title, article, title)
+        state = partial_store.state()
+        #articles appended after state was taken are discarded
+        partial_store.append('extra', 'extra article')
+        partial_store.flush()
+        reopened = TempArticleStore.reopen(state)
+        assert len(reopened) == half
+        for title, article in data[half:]:
+            reopened.append(title, article, title)
+        assert list(reopened.sorted()) == sorted(data, key=lambda x: x[0])
+    finally:
+        (reopened or partial_store).close()
+
+def test_sorted_shard():
+    import os, tempfile
+    from aardtools.compiler import write_sorted_shard, read_sorted_shard
+    keyed_store = TempArticleStore()
+    fd, file_name = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        for title, article in data:
+            keyed_store.append(title, article, ''.join(reversed(title)))
+        keyed_store.sort()
+        write_sorted_shard(file_name, {'articles': len(data)},
+                           keyed_store.keyed_items())
+        header, records = read_sorted_shard(file_name)
+        assert header == {'articles': len(data)}
+        expected = sorted((''.join(reversed(title)), title, article)
+                          for title, article in data)
+        assert list(records) == expected
+    finally:
+        keyed_store.close()
+        os.remove(file_name)
+
+def test_presorted():
+    presorted_store = TempArticleStore()
+    try:
+        for title, article in sorted(data):
+            presorted_store.append(title, article)
+        presorted_store.sort(presorted=True)
+        assert list(presorted_store.items()) == sorted(data)
+    finally:
+        presorted_store.close()
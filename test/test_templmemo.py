@@ -0,0 +1,55 @@
+from aardtools import templmemo
+from mwlib.siteinfo import get_siteinfo
+from mwlib.templ.evaluate import Expander
+
+templates = {u'Echo': u'({{{1}}})',
+             u'Page': u'{{{1}}} on {{PAGENAME}}',
+             u'Ref': u'{{{1}}}<ref>note</ref>'}
+
+class Page(object):
+
+    def __init__(self, rawtext):
+        self.rawtext = rawtext
+
+class WikiDB(object):
+
+    def normalize_and_get_page(self, name, ns):
+        return Page(templates[templmemo.normalize_name(name)])
+
+    def get_siteinfo(self):
+        return get_siteinfo('en')
+
+def expand(text, pagename):
+    return Expander(text, pagename=pagename, wikidb=WikiDB()).expandTemplates()
+
+def setup():
+    global memo
+    memo = templmemo.install(100)
+
+def teardown():
+    templmemo.memo = None
+
+def test_pure():
+    assert expand(u'{{echo|a}} {{Echo|a}}', u'A') == u'(a) (a)'
+    assert expand(u'{{Echo|a}}', u'B') == u'(a)'
+    assert (memo.hits, memo.misses) == (2, 1)
+
+def test_page_dependent():
+    hits = memo.hits
+    assert expand(u'{{Page|x}}', u'A') == u'x on A'
+    assert expand(u'{{Page|x}}', u'B') == u'x on B'
+    assert memo.hits == hits
+
+def test_uniquifier():
+    hits = memo.hits
+    expand(u'{{Ref|x}}', u'A')
+    expand(u'{{Ref|x}}', u'B')
+    assert memo.hits == hits
+
+def test_allowlist():
+    allowlist_memo = templmemo.install(100, [u'echo'])
+    try:
+        assert expand(u'{{Echo|b}} {{Echo|b}} {{Page|b}}', u'A') == u'(b) (b) b on A'
+        assert (allowlist_memo.hits, allowlist_memo.misses) == (1, 1)
+    finally:
+        templmemo.memo = memo
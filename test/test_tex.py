@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+from aardtools import tex, mwaardhtmlwriter as writer
+from aardtools.cache import MathCache
+
+def setup():
+    global workdir
+    workdir = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(workdir)
+
+def fake_run_latex(workdir, equations, name):
+    runs.append(list(equations))
+    if 'bad' in equations:
+        failed = equations[0] if len(equations) == 1 else equations
+        raise tex.MathRenderingFailed(failed, 'latex', 'error')
+    return [name + '-' + equation for equation in equations]
+
+def test_bad_equation_isolated():
+    global runs
+    runs = []
+    run_latex = tex.run_latex
+    tex.run_latex = fake_run_latex
+    try:
+        results = tex.mkpngs_latex(workdir, ['a', 'b', 'bad', 'c', 'd'])
+    finally:
+        tex.run_latex = run_latex
+    assert isinstance(results[2], tex.MathRenderingFailed)
+    assert results[2].equation == 'bad'
+    assert results[:2] + results[3:] == ['eqa-a', 'eqa-b', 'eqbb-c', 'eqbb-d']
+    assert runs == [['a', 'b', 'bad', 'c', 'd'], ['a', 'b'],
+                    ['bad', 'c', 'd'], ['bad'], ['c', 'd']]
+
+def fake_run(cmd, equation, input=None, count=1):
+    """ Pretend to run latex and dvipng, each equation makes one page
+    except equations with page break.
+    """
+    if cmd[0] == 'dvipng':
+        name = cmd[-1][:-len('.dvi')]
+        with open(name + '.tex') as f:
+            doc = f.read()
+        pages = doc.count('\\clearpage') + doc.count('\\newpage') + 1
+        for i in range(pages):
+            open('%s-%d.png' % (name, i + 1), 'w').close()
+    return 0, '', ''
+
+def test_page_count_checked():
+    run = tex.run
+    tex.run = fake_run
+    try:
+        results = tex.mkpngs_latex(workdir, ['a', 'b \\newpage c', 'd'])
+    finally:
+        tex.run = run
+    assert isinstance(results[1], tex.MathRenderingFailed)
+    for result in (results[0], results[2]):
+        assert os.path.exists(result), result
+
+def fake_toimgs(equations, cmd='latex', keeptemp=False):
+    calls.append((cmd, list(equations)))
+    results = []
+    for equation in equations:
+        if cmd == 'latex' and equation.startswith('hard'):
+            results.append(tex.MathRenderingFailed(equation, cmd, 'error'))
+        elif equation == 'hard but not for blahtex' and cmd == 'blahtex':
+            results.append('%s image of %s' % (cmd, equation))
+        elif equation.startswith('hard'):
+            results.append(OSError('%s is not installed' % cmd))
+        else:
+            results.append('%s image of %s' % (cmd, equation))
+    return results
+
+def test_render_math_fallback():
+    global calls
+    calls = []
+    toimgs = tex.toimgs
+    tex.toimgs = fake_toimgs
+    writer.math_cache = MathCache(workdir)
+    try:
+        equations = ['x', 'hard but not for blahtex', 'hard', 'y', 'x']
+        images = writer.render_math(equations, u'Title')
+        assert images == {'x': 'latex image of x',
+                          'y': 'latex image of y',
+                          'hard but not for blahtex':
+                          'blahtex image of hard but not for blahtex',
+                          'hard': None}
+        #renderers only get equations previous ones couldn't render
+        assert calls == [('latex', ['hard', 'hard but not for blahtex',
+                                    'x', 'y']),
+                         ('blahtex', ['hard', 'hard but not for blahtex']),
+                         ('texvc', ['hard'])]
+        calls = []
+        images = writer.render_math(equations, u'Title')
+        assert images['x'] == 'latex image of x'
+        #latex failure is cached, other errors are not
+        assert calls == [('blahtex', ['hard']), ('texvc', ['hard'])]
+    finally:
+        tex.toimgs = toimgs
+        writer.math_cache = None
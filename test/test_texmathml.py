@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import xml.etree.ElementTree as ET
+
+from aardtools.texmathml import tomathml, supported
+
+def tostring(tex):
+    return ET.tostring(tomathml(tex), encoding='utf-8')
+
+def test_scripts():
+    assert '<msubsup><mi>x</mi><mn>1</mn><mn>2</mn></msubsup>' in tostring(u'x_1^2')
+    assert ('<munder><mi>lim</mi><mrow><mi>x</mi><mo>→</mo><mn>0</mn></mrow>'
+            '</munder>') in tostring(u'\\lim_{x \\to 0} f(x)')
+
+def test_fences():
+    assert tostring(u'\\left( \\frac{a}{b} \\right.').endswith(
+        '<mrow><mo fence="true">(</mo><mfrac><mi>a</mi><mi>b</mi></mfrac>'
+        '<mo fence="true" /></mrow></math>')
+
+def test_text():
+    assert '<mtext>if </mtext>' in tostring(u'x \\text{if } y')
+
+def test_unsupported():
+    assert supported(u'\\sqrt[3]{x} + \\hat{y}')
+    assert not supported(u'\\begin{matrix} a & b \\end{matrix}')
+    assert not supported(u'a \\\\ b')
+    assert not supported(u'\\unknowncommand')
+    assert not supported(u'x^')
+    assert not supported(u'{x')
+
+def test_functions():
+    assert tostring(u'\\deg x').endswith(
+        '<mrow><mi>deg</mi><mi>x</mi></mrow></math>')
+
+def test_single_digit_arguments():
+    fraction = '<mfrac><mn>1</mn><mn>2</mn></mfrac></math>'
+    assert tostring(u'\\frac12').endswith(fraction)
+    assert tostring(u'\\tfrac12').endswith(fraction)
+    assert tostring(u'\\frac123').endswith(
+        '<mrow><mfrac><mn>1</mn><mn>2</mn></mfrac><mn>3</mn></mrow></math>')
+    assert tostring(u'x^23').endswith(
+        '<mrow><msup><mi>x</mi><mn>2</mn></msup><mn>3</mn></mrow></math>')
+    assert tostring(u'x^{23}').endswith(
+        '<msup><mi>x</mi><mn>23</mn></msup></math>')
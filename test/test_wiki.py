@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import zlib
+import bz2
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from mwlib.siteinfo import get_siteinfo
+from mwlib import nshandling
+from aardtools import wiki
+
+decompress = {'_zlib': zlib.decompress,
+              '_bz2': bz2.decompress,
+              'none': lambda x: x}
+
+class WikiDB(object):
+
+    lang = 'en'
+    rtl = False
+
+    def __init__(self, articles):
+        self.reader = articles
+        self.siteinfo = get_siteinfo('en')
+        self.nshandler = nshandling.nshandler(self.siteinfo)
+
+    def get_siteinfo(self):
+        return self.siteinfo
+
+    def get_redirect(self, text):
+        return None
+
+    def normalize_and_get_page(self, name, defaultns):
+        return None
+
+def setup():
+    global wikidb
+    wikidb = wiki.wikidb
+
+def teardown():
+    wiki.wikidb = wikidb
+
+def test_convert_non_ascii():
+    title = u'Café'
+    wiki.wikidb = WikiDB({title: u"'''Café''' — кофейня"})
+    result, cached = wiki.convert_article(title)
+    converted_title, compressed, codec, redirect = result[:4]
+    assert converted_title == title
+    assert not redirect
+    text, tags = json.loads(decompress[codec](compressed).decode('utf8'))
+    assert u'Café' in text
+    assert u'кофейня' in text
+
+class RedirectWikiDB(object):
+
+    def articles(self):
+        return iter([u'A', u'Corrupt', u'Missing', u'R', u'B'])
+
+    def get_title_redirect(self, title):
+        if title == u'Corrupt':
+            raise zlib.error('Error -3 while decompressing data')
+        if title == u'Missing':
+            raise KeyError(title)
+        if title == u'R':
+            return u'A'
+        return None
+
+class Consumer(object):
+
+    def __init__(self):
+        self.failed = []
+
+    def is_done(self, title):
+        return False
+
+    def fail_article(self, title):
+        self.failed.append(title)
+
+class WikiParser(wiki.WikiParser):
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.start, self.end = 0, None
+        self.lang, self.rtl = 'en', False
+
+def test_unreadable_titles_fail():
+    create_wikidb = wiki._create_wikidb
+    def fake_create_wikidb(cdbdir, lang, rtl):
+        wiki.wikidb = RedirectWikiDB()
+    wiki._create_wikidb = fake_create_wikidb
+    try:
+        parser = WikiParser(Consumer())
+        titles = list(parser.articles(None, redirects=False))
+    finally:
+        wiki._create_wikidb = create_wikidb
+    assert titles == [u'A', u'B']
+    assert parser.consumer.failed == [u'Corrupt', u'Missing']
+
+class Cache(object):
+
+    def __init__(self):
+        self.added = []
+
+    def key(self, title, text):
+        return title
+
+    def get(self, key):
+        return None
+
+    def add(self, key, value):
+        self.added.append(key)
+
+def test_unrendered_math_not_cached():
+    from aardtools import mwaardhtmlwriter as writer
+    render_math = writer.render_math
+    writer.render_math = lambda equations, title: dict(
+        (equation, None if equation == u'y' else 'image')
+        for equation in equations)
+    wiki.wikidb = WikiDB({u'A': u'<math>x</math>',
+                          u'B': u'<math>x</math> <math>y</math>'})
+    wiki.cache = Cache()
+    try:
+        wiki.convert_article(u'A')
+        wiki.convert_article(u'B')
+        assert wiki.cache.added == [u'A']
+    finally:
+        writer.render_math = render_math
+        wiki.cache = None
+
+def test_mathml_converted_once():
+    from aardtools import mwaardhtmlwriter as writer
+    calls = []
+    def tomathml(tex):
+        calls.append(tex)
+        return tomathml_(tex)
+    tomathml_, render_math = writer.tomathml, writer.render_math
+    writer.tomathml = tomathml
+    writer.render_math = lambda equations, title: dict(
+        (equation, 'image') for equation in equations)
+    writer.math_format = 'mathml'
+    wiki.wikidb = WikiDB({u'A': u'<math>x^2</math> <math>x^2</math> '
+                          u'<math>a \\\\ b</math>'})
+    try:
+        result, cached = wiki.convert_article(u'A')
+    finally:
+        writer.tomathml, writer.render_math = tomathml_, render_math
+        writer.math_format = 'png'
+    compressed, codec = result[1:3]
+    text, tags = json.loads(decompress[codec](compressed).decode('utf8'))
+    assert sorted(calls) == [u'a \\\\ b', u'x^2']
+    assert text.count(u'<msup>') == 2
+    assert text.count(u'class="tex"') == 1
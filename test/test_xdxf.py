@@ -77,3 +77,53 @@ def test_opt_and_nu_together():
     parser.parse(StringIO(xdxf_xml))
     assert 'abcdef' in compiler.articles
     assert 'abcdefg' in compiler.redirects
+
+count_xml = """<?xml version="1.0" encoding="UTF-8" ?>
+<xdxf lang_from="ENG" lang_to="ENG" format="visual">
+<ar><k><opt>1</opt>a<opt>2</opt></k>
+</ar>
+<ar><k>b</k><k>c</k>
+</ar>
+</xdxf>
+"""
+
+def test_total():
+    assert xdxf.total(StringIO(count_xml), None) == 6
+
+def test_estimate():
+    import tempfile
+    f = tempfile.TemporaryFile()
+    f.write(count_xml)
+    f.seek(0)
+    assert xdxf.estimate(f, None) == 6
+
+def test_estimate_sample():
+    import tempfile
+    f = tempfile.TemporaryFile()
+    f.write(count_xml)
+    f.seek(0)
+    sample_size = xdxf.ESTIMATE_SAMPLE_SIZE
+    xdxf.ESTIMATE_SAMPLE_SIZE = count_xml.index('<ar><k>b')
+    try:
+        #only first article is complete in the sample
+        assert xdxf.estimate(f, None) == int(4*float(len(count_xml))/
+                                             xdxf.ESTIMATE_SAMPLE_SIZE)
+    finally:
+        xdxf.ESTIMATE_SAMPLE_SIZE = sample_size
+
+def test_estimate_unknown_size():
+    assert xdxf.estimate(StringIO(count_xml), None) is None
+
+def test_estimate_pipe():
+    import os
+    r, w = os.pipe()
+    os.write(w, '<xdxf><ar><k>abc</k></ar></xdxf>')
+    os.close(w)
+    inputfile = os.fdopen(r)
+    #size of a pipe is not known
+    assert xdxf.estimate(inputfile, None) is None
+
+def test_estimate_stdin():
+    import sys
+    assert xdxf.estimate(sys.stdin, None) is None
+    assert not sys.stdin.closed